@@ -6,7 +6,6 @@ import os, time, sys
 
 from django.conf import settings
 from django.contrib.auth.decorators import login_required
-from django.contrib.contenttypes.models import ContentType
 from django.core.paginator import Paginator, EmptyPage, InvalidPage
 from django.core.urlresolvers import reverse
 from django.http import HttpResponse, Http404
@@ -21,7 +20,8 @@ from haystack.query import SearchQuerySet
 
 from apps.authority.forms import AuthorityProfileForm
 from apps.backend import AppMessage, UnicodeWriter
-from apps.backend.models import TaggedItem, EventNotification
+from apps.backend.subscriptions import follow, unfollow, followed, \
+    is_following
 from apps.backend.utils import process_filter_request, update_user_message, \
     send_mail_managers, get_domain_name
 from apps.browser.forms import ModelSearchForm
@@ -206,16 +206,7 @@ def get_authority_info(request, slug, **kwargs):
         categories.append(category)
 
     # Check if the user is following the authority.
-    following = False
-    if not request.user.is_anonymous():
-        content_type_id = ContentType.objects.get_for_model(authority.__class__).id
-        try:
-            item = TaggedItem.objects.get(object_id=authority.id,
-                                         content_type_id=content_type_id)
-        except TaggedItem.DoesNotExist:
-            pass
-        else:
-            following = item.is_followed_by(request.user)
+    following = is_following(request.user, authority)
 
     # Fill requests list.
     initial, query, urlparams = process_filter_request(
@@ -241,6 +232,8 @@ def get_authority_info(request, slug, **kwargs):
                               {'authority': authority,
                                'following': following,
                                'page': results,
+                               'followed': followed(request.user,
+                                                    results.object_list),
                                'categories': categories,
                                'form': PIAFilterForm(initial=initial),
                                'user_message': user_message,
@@ -300,11 +293,9 @@ def add_authority(request, slug=None, **kwargs):
                     print >> sys.stderr, '[%s] %s' % (datetime.now().isoformat(), e)
 
                 # Create notifier.
-                item = TaggedItem.objects.create(name=authority.name,
-                                                content_object=authority)
-                evnt = EventNotification.objects.create(
-                    item=item, action='active', receiver=request.user,
-                    summary='Authority %s becomes active' % authority.name)
+                follow(request.user, authority, {
+                    'active': 'Authority %s becomes active' % authority.name},
+                    name=authority.name)
 
                 request.session['user_message'] = user_message
                 return redirect(reverse('display_authorities'))
@@ -332,19 +323,9 @@ def follow_authority(request, slug=None, **kwargs):
     except:
         raise Http404
 
-    # Create notifier.
-    try:
-        item = TaggedItem.objects.get(object_id=authority.id, name=authority.name,
-            content_type_id=ContentType.objects.get_for_model(authority.__class__).id)
-    except TaggedItem.DoesNotExist:
-        item = TaggedItem.objects.create(name=authority.name,
-                                        content_object=authority)
-    for k, v in authority_events(authority).iteritems():
-        try:
-            evnt, created = EventNotification.objects.get_or_create(
-                item=item, action=k, receiver=request.user, summary=v)
-        except:
-            pass # TO-DO: Log it!
+    # Create notifier (hourly or daily digest, if asked for).
+    follow(request.user, authority, authority_events(authority),
+           name=authority.name, delivery=request.GET.get('delivery'))
     return redirect(request.META.get('HTTP_REFERER'))
 
 @login_required
@@ -359,26 +340,7 @@ def unfollow_authority(request, slug=None, **kwargs):
     except:
         raise Http404
 
-    try: # to get notifier.
-        item = TaggedItem.objects.get(object_id=authority.id, name=authority.name,
-            content_type_id=ContentType.objects.get_for_model(authority.__class__).id)
-    except TaggedItem.DoesNotExist:
-        return redirect(request.META.get('HTTP_REFERER'))
-
-    for k, v in authority_events(authority).iteritems():
-        try:
-            evnt = EventNotification.objects.get(item=item, action=k,
-                                                receiver=request.user, summary=v)
-        except EventNotification.DoesNotExist:
-            continue
-        evnt.delete()
-
-    # Check if there is any notification connected to this item.
-    if not EventNotification.objects.filter(item=item):
-        try: # to wipe it out.
-            item.delete()
-        except:
-            pass
+    unfollow(request.user, authority, authority_events(authority).keys())
     return redirect(request.META.get('HTTP_REFERER'))
 
 def download_authority_list(request, ext=None, **kwargs):
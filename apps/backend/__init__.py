@@ -10,9 +10,14 @@ import csv
 import email
 import codecs
 import base64
+import select
+import hashlib
+import binascii
 import imaplib
 import cStringIO
+import time
 import mimetypes
+import threading
 from datetime import datetime
 
 from django.db import models
@@ -285,160 +290,606 @@ CountryField - end
 """
 MailImporter
 """
+# Idle IMAP connections, kept open between the mail checks:
+# {(host, port, login): [connection, ...]}
+IMAP_POOL= {}
+IMAP_POOL_LOCK= threading.Lock()
+IMAP_POOL_MAX_IDLE= 2 # Per mailbox.
+
+# Attachments are decoded and written to disk by chunks of this size.
+ATTACHMENT_CHUNK_SIZE= 64 * 1024
+
+class RawIMAP():
+    """
+    Direct access to the IMAP connection for IDLE (see `MailImporter.idle`),
+    which imaplib doesn't support: it waits for the tagged response to
+    every command, while IDLE is only completed after the client sends
+    DONE. This relies on the undocumented parts of imaplib.IMAP4
+    (`_new_tag`, `send`, `readline`, the buffer of `file`, `sslobj`),
+    which are used only here - check them when upgrading Python.
+    """
+    def __init__(self, connection):
+        self.connection= connection
+
+    def new_tag(self):
+        return self.connection._new_tag()
+
+    def send(self, line):
+        self.connection.send('%s\r\n' % line)
+
+    def readline(self):
+        response= self.connection.readline()
+        if not response:
+            raise imaplib.IMAP4.abort('socket error: EOF')
+        return response
+
+    def readable(self, timeout):
+        """
+        Waits until there is something to read from the connection.
+        """
+        # Data already read from the socket, but not consumed yet.
+        buffered= getattr(getattr(self.connection, 'file', None), '_rbuf', None)
+        if buffered is not None and buffered.tell():
+            return True
+        sslobj= getattr(self.connection, 'sslobj', None)
+        if sslobj is not None and sslobj.pending():
+            return True
+        return len(select.select([self.connection.socket()], [], [],
+                                 timeout)[0]) > 0
+
+
 class MailImporter():
     """
     `attachment_dir` is the main directory where to save attachments. 
-    `addr_template` is to create subdirectories in the `attachment_dir`.
+    `addr_template` (or AddressRouter in `router`) filters the messages:
+    only those with matching `to` field are imported.
+    `batch_size` turns on batched fetching: sizes of the messages are
+    fetched in chunks of this size, and if `addr_template` is given,
+    headers as well - the full message is downloaded only if its `to` field
+    matches. Full messages are fetched `batch_bytes` at a time at most.
+    `timeout` (in seconds) limits every socket operation on the connection.
+    `uidvalidity` and `last_uid` is the watermark left by the previous
+    import: if it is still valid, only messages with UID above `last_uid`
+    (and those in `retry_uids`, {uid: attempts}) are imported, otherwise -
+    unread ones. After the import both attributes contain the new
+    watermark, and `failed_uids` ({uid: attempts}) - messages which
+    failed to fetch or parse.
     """
     def __init__(self, connection_opts, **kwargs):
         self.connection_opts= connection_opts
         self.attachment_dir= kwargs.get('attachment_dir', '.')
+        self.router= kwargs.get('router', None)
         self.addr_template= kwargs.get('addr_template', None)
+        if self.router is not None:
+            self.addr_template= self.router.template
+            self.addr_pattern= self.router.pattern
+        elif self.addr_template:
+            self.addr_pattern= re.compile(self.addr_template)
+        else:
+            self.addr_pattern= None
+        self.batch_size= kwargs.get('batch_size', None)
+        self.batch_bytes= kwargs.get('batch_bytes', 0)
+        self.timeout= kwargs.get('timeout', None)
+        self.uidvalidity= kwargs.get('uidvalidity', None)
+        self.last_uid= kwargs.get('last_uid', None) or 0
+        self.retry_uids= kwargs.get('retry_uids', None) or {}
+        self.failed_uids= {}
+        self.sync_by_uid= False
         self.content_related= ['content-type', 'content-transfer-encoding', 'content-id', 'content-disposition']
         self.messages= []
 
-    def imap_connect(self):
+    def imap_connect(self, pooled=False):
         """
         Establish imap connection.
+        If `pooled`, an idle connection to the same mailbox left
+        by `imap_release` is reused (if it is still alive).
         """
         host= self.connection_opts['host']
         port= self.connection_opts['port']
         login= self.connection_opts['login']
         password= self.connection_opts['password']
 
+        connection= None
+        while pooled and (connection is None):
+            with IMAP_POOL_LOCK:
+                try:
+                    connection= IMAP_POOL.get((host, port, login), []).pop()
+                except IndexError:
+                    break
+            self._set_timeout(connection)
+            try:
+                connection.noop()
+            except Exception:
+                self.imap_discard(connection)
+                connection= None
+        if connection is not None:
+            return connection
+
         if self.connection_opts['use_ssl']:
             connection= imaplib.IMAP4_SSL(host, port)
         else:
             connection= imaplib.IMAP4(host, port)
+        self._set_timeout(connection)
 
         connection.login(login, password)
         return connection
 
+    def imap_release(self, connection):
+        """
+        Return the connection to the pool of idle connections.
+        """
+        key= (self.connection_opts['host'], self.connection_opts['port'],
+              self.connection_opts['login'])
+        with IMAP_POOL_LOCK:
+            idle= IMAP_POOL.setdefault(key, [])
+            if len(idle) < IMAP_POOL_MAX_IDLE:
+                idle.append(connection)
+                return
+        self.imap_discard(connection)
+
+    def imap_discard(self, connection):
+        """
+        Close the connection (broken or not needed any more).
+        """
+        try:
+            connection.logout()
+        except:
+            pass
+
+    def _set_timeout(self, connection):
+        for sock in (getattr(connection, 'sock', None),
+                     getattr(connection, 'sslobj', None)):
+            if sock is not None:
+                sock.settimeout(self.timeout)
+
+    def idle(self, connection, timeout=None):
+        """
+        Waits (IMAP IDLE, RFC 2177) until the server reports new messages
+        in the selected mailbox, or `timeout` seconds pass.
+        Returns True if there are new messages.
+        """
+        raw= RawIMAP(connection)
+        tag= raw.new_tag()
+        raw.send('%s IDLE' % tag)
+        response= raw.readline()
+        if not response.startswith('+'):
+            raise imaplib.IMAP4.error('IDLE failed: %s' % response.strip())
+
+        has_news= False
+        deadline= None if timeout is None else time.time() + timeout
+        while not has_news:
+            wait= None if deadline is None else deadline - time.time()
+            if (wait is not None) and (wait <= 0):
+                break
+            if not raw.readable(wait):
+                break
+            # Untagged responses such as `* 23 EXISTS`.
+            has_news= re.search(r'^\*\s+\d+\s+(EXISTS|RECENT)',
+                                raw.readline()) is not None
+
+        raw.send('DONE')
+        while not raw.readline().startswith(tag):
+            pass
+        return has_news
+
     def process_mails(self, connection, header_only=False):
         """
-        Loop over unread emails, if callback call succeed,
-        mark email as read.
+        Collect all unread emails in `self.messages`.
+
+        WARNING! Keeps every parsed message in memory,
+        use `iter_mails` for large mailboxes.
+        """
+        for message in self.iter_mails(connection, header_only):
+            self.messages.append(message)
+        return self.messages
+
+    def iter_mails(self, connection, header_only=False):
+        """
+        Loop over new emails (see `search_new`), yield parsed messages
+        one at a time. Fetched emails are marked as read.
         """
-        def _get_message_dirname(to):
-            """
-            Extract from `to` field what is defined by `addr_template`
-            """
-            try:
-                field_to= [t.strip() for t in to.split(',') if re.search(self.addr_template, t)][0]
-            except:
-                return ''
-            return field_to.split('@')[0].replace('.', '_')
-        
         connection.select()
-        _u, data= connection.search(None, 'UNSEEN')
+        msg_uids, uidnext= self.search_new(connection)
+
+        if self.batch_size:
+            fetched= self._fetch_batched(connection, msg_uids)
+        else:
+            fetched= self._fetch_single(connection, msg_uids)
 
-        for msg_num in data[0].split():
+        for msg_uid, msg_data in fetched:
             header= None
             try:
-                _u, msg_data= connection.fetch(msg_num, '(RFC822)')
-                header= self.extract_mail_header(msg_data)
-            except Exception as e:
-                exception= sys.exc_info()[1]
-                connection.store(msg_num, '-FLAGS', '\SEEN')
-                print >> sys.stderr, '[%s] %s' % (datetime.now().isoformat(), exception)
-                mail_managers(
-                    str(self.__class__),
-                    '[%s] %s' % (datetime.now().isoformat(), exception),
-                    fail_silently=True)
-            if header:
-                content, attachments, dir_name= None, None, ''
-                if self.addr_template:
-                    if not re.search(self.addr_template, header['to']):
+                header, content, attachment_parts= self.parse_mail(msg_data,
+                                                                   header_only)
+                if header and self.addr_pattern:
+                    if not self.addr_pattern.search(header['to']):
                         # Very important! If `addr_template` is given,
                         # then at this stage (reading mails), mail filtering
                         # happens: only those e-mails are being processed,
                         # whose `to` field satisfy the template's pattern.
                         # Otherwise - ignore the message.
-                        continue
-                if not header_only:
-                    dir_name= _get_message_dirname(header['to']) + '/'
-                    content, attachments= self.extract_mail_content(msg_data,
-                        dir_name=dir_name)
-                self.messages.append({'header': header, 'content': content,
-                                      'attachments': attachments})
-        return self.messages
+                        header= None
+                attachments= None
+                if header and not header_only:
+                    attachments= self.save_attachments(attachment_parts)
+            except Exception:
+                header= None
+                self._report_failure(connection, msg_uid)
+            if header:
+                yield {'header': header, 'content': content,
+                       'attachments': attachments, 'uid': int(msg_uid)}
+            if self.sync_by_uid:
+                self.last_uid= max(self.last_uid, int(msg_uid))
 
-    def extract_mail_header(self, message_data):
+        # Everything below UIDNEXT is either imported or ignored
+        # (messages read by somebody else before the very first import).
+        self.last_uid= max([self.last_uid, uidnext - 1] +
+                           [int(u) for u in msg_uids])
+
+    def search_new(self, connection):
         """
-        Returns message header.
+        Returns UIDs of the new messages in the selected mailbox and
+        UIDNEXT (or 0 if the server doesn't report it).
+
+        New messages are those with UID above `last_uid`, if UIDVALIDITY
+        of the mailbox is still the same as `uidvalidity`. Otherwise
+        (no watermark yet, or the mailbox was re-created) they are the
+        unread ones, and the watermark is started anew.
+        """
+        uidvalidity= self._get_response_code(connection, 'UIDVALIDITY')
+        uidnext= self._get_response_code(connection, 'UIDNEXT') or 0
+        self.sync_by_uid= (uidvalidity is not None) and \
+            (uidvalidity == self.uidvalidity)
+        if self.sync_by_uid:
+            # `n:*` always includes the last message, even if its UID < n.
+            _u, data= connection.uid('SEARCH', None,
+                                     'UID', '%d:*' % (self.last_uid + 1))
+            msg_uids= [u for u in data[0].split() if int(u) > self.last_uid]
+            if self.retry_uids:
+                # Those which are still in the mailbox.
+                _u, data= connection.uid('SEARCH', None, 'UID',
+                                         self._message_set(self.retry_uids))
+                msg_uids= sorted(set(msg_uids) | set(
+                    [u for u in data[0].split() if int(u) in self.retry_uids]),
+                    key=int)
+        else:
+            # Failed messages are left unread, so they are retried as well.
+            _u, data= connection.uid('SEARCH', None, 'UNSEEN')
+            msg_uids= data[0].split()
+            self.uidvalidity, self.last_uid, self.retry_uids= uidvalidity, 0, {}
+        return msg_uids, uidnext
+
+    def _get_response_code(self, connection, code):
+        """
+        Integer value of the response code (such as UIDVALIDITY)
+        received when selecting the mailbox, or None.
+        """
+        try:
+            return long(connection.response(code)[1][-1])
+        except (TypeError, ValueError, IndexError):
+            return None
+
+    def _fetch_single(self, connection, msg_uids):
+        """
+        Fetch messages one by one, yield (msg_uid, msg_data).
+        """
+        for msg_uid in msg_uids:
+            try:
+                _u, msg_data= connection.uid('FETCH', msg_uid, '(RFC822)')
+            except Exception:
+                self._report_failure(connection, msg_uid)
+                continue
+            yield msg_uid, msg_data
+
+    def _fetch_batched(self, connection, msg_uids):
+        """
+        Fetch messages in chunks of `batch_size`, yield (msg_uid, msg_data).
+
+        Only the sizes (and, if `addr_template` is given, TO, FROM and
+        SUBJECT) are fetched for the whole chunk, without setting \Seen flag.
+        Full RFC822 bodies are downloaded only for the messages whose `to`
+        field matches the template, and no more than `batch_bytes` at
+        a time (see `_size_limited`), so that the chunk is never held
+        in memory. Those that don't match are simply marked as seen - the
+        same as it happens to them when fetched one by one.
+        """
+        for i in range(0, len(msg_uids), self.batch_size):
+            chunk= msg_uids[i:i + self.batch_size]
+            sizes= {}
+            try:
+                if self.addr_pattern:
+                    _u, header_data= connection.uid('FETCH',
+                        self._message_set(chunk),
+                        '(RFC822.SIZE BODY.PEEK[HEADER.FIELDS (TO FROM SUBJECT)])')
+                    matching, skipped= [], []
+                    for msg_uid, response_part in self._split_fetch_response(header_data):
+                        sizes[msg_uid]= self._get_size(response_part[0])
+                        header= self.extract_mail_header([response_part])
+                        if self.addr_pattern.search(header.get('to', '')):
+                            matching.append(msg_uid)
+                        else:
+                            skipped.append(msg_uid)
+                    if skipped:
+                        connection.uid('STORE', self._message_set(skipped),
+                                       '+FLAGS', '\\Seen')
+                    chunk= matching
+                else:
+                    _u, size_data= connection.uid('FETCH',
+                        self._message_set(chunk), '(RFC822.SIZE)')
+                    for response_part in size_data:
+                        found= re.search(r'UID (\d+)', response_part or '')
+                        if found:
+                            sizes[found.group(1)]= self._get_size(response_part)
+            except Exception:
+                # Something is wrong with the chunk - fall back
+                # to fetching its messages one by one.
+                for fetched in self._fetch_single(connection, chunk):
+                    yield fetched
+                continue
+            for sub_chunk in self._size_limited(chunk, sizes):
+                try:
+                    _u, msg_data= connection.uid('FETCH',
+                        self._message_set(sub_chunk), '(RFC822)')
+                except Exception:
+                    for fetched in self._fetch_single(connection, sub_chunk):
+                        yield fetched
+                    continue
+                for msg_uid, response_part in self._split_fetch_response(msg_data):
+                    yield msg_uid, [response_part]
+                del msg_data
+
+    def _get_size(self, response_text):
+        """
+        RFC822.SIZE reported in the FETCH response, or None.
+        """
+        found= re.search(r'RFC822\.SIZE (\d+)', response_text)
+        if found:
+            return int(found.group(1))
+        return None
+
+    def _size_limited(self, msg_uids, sizes):
+        """
+        Split `msg_uids` into chunks of no more than `batch_bytes` in total
+        by their `sizes` ({msg_uid: size}). The message which is larger
+        (or of unknown size) is fetched on its own.
+        """
+        chunk, total= [], 0
+        for msg_uid in msg_uids:
+            size= sizes.get(msg_uid) or self.batch_bytes
+            if chunk and total + size > self.batch_bytes:
+                yield chunk
+                chunk, total= [], 0
+            chunk.append(msg_uid)
+            total += size
+        if chunk:
+            yield chunk
+
+    def _split_fetch_response(self, data):
+        """
+        Split the response to UID FETCH of a message set into
+        (msg_uid, response_part) pairs.
+        """
+        for i, response_part in enumerate(data):
+            if isinstance(response_part, tuple):
+                # UID can be reported either before the literal:
+                # ('1 (UID 12 RFC822 {345}', '...'), or after it: ' UID 12)'
+                found= re.search(r'UID (\d+)', response_part[0])
+                if (found is None) and (i + 1 < len(data)) and \
+                       isinstance(data[i + 1], basestring):
+                    found= re.search(r'UID (\d+)', data[i + 1])
+                if found:
+                    yield found.group(1), response_part
+
+    def _message_set(self, msg_uids):
         """
-        messageHeader= {}
+        Compress the list of message UIDs into IMAP message set,
+        e.g. ['1', '2', '3', '7'] -> '1:3,7'
+        """
+        ranges= []
+        for num in sorted(int(n) for n in msg_uids):
+            if ranges and num == ranges[-1][1] + 1:
+                ranges[-1][1]= num
+            else:
+                ranges.append([num, num])
+        return ','.join([str(a) if a == b else '%d:%d' % (a, b) for a, b in ranges])
+
+    def _report_failure(self, connection, msg_uid):
+        """
+        Leave the message unread, add it to `failed_uids` and report
+        the error to managers.
+        """
+        exception= sys.exc_info()[1]
+        self.failed_uids[int(msg_uid)]= self.retry_uids.get(int(msg_uid), 0) + 1
+        try:
+            connection.uid('STORE', msg_uid, '-FLAGS', '\\SEEN')
+        except:
+            pass
+        print >> sys.stderr, '[%s] %s' % (datetime.now().isoformat(), exception)
+        mail_managers(
+            str(self.__class__),
+            '[%s] %s' % (datetime.now().isoformat(), exception),
+            fail_silently=True)
+
+    def parse_mail(self, message_data, header_only=False):
+        """
+        Parses the message once and walks its MIME tree once.
+
+        Returns a tuple (header, text content, attachment parts). Attachment
+        parts are not decoded here - pass them to `save_attachments`, which
+        decodes each payload exactly once. If `header_only`, the content is
+        not extracted at all.
+        """
+        header, content, attachment_parts= {}, '', []
         for response_part in message_data:
             if isinstance(response_part, tuple):
                 msg= email.message_from_string(response_part[1])
                 for part in msg.walk():
                     for k, v in part.items():
                         if k.lower() not in self.content_related:
-                            messageHeader.update({k.lower().strip(): self._clean_text_encoded(v)})
-        return messageHeader
+                            header.update({k.lower().strip(): self._clean_text_encoded(v)})
+                    if header_only or part.is_multipart():
+                        continue
+                    if part.get_params(None, 'Content-Disposition'):
+                        attachment_parts.append(part)
+                    elif len(content) == 0:
+                        # Update `content` only if it isn't updated yet.
+                        content= self._extract_text(part)
+        if header_only:
+            content= None
+        return header, content, attachment_parts
+
+    def extract_mail_header(self, message_data):
+        """
+        Returns message header.
+        """
+        return self.parse_mail(message_data, header_only=True)[0]
 
     def extract_mail_content(self, message_data, **kwargs):
         """
         Returns text message content.
         """
-        msg_plain_text, msg_attachments= '', []
-        for response_part in message_data:
-            if isinstance(response_part, tuple):
-                msg= email.message_from_string(response_part[1])
-                for part in msg.walk():
-                    if part.is_multipart():
-                        continue
-                    attachment_part= part.get_params(None, 'Content-Disposition')
-                    if attachment_part:
-                        attachment_size= len(part.get_payload(decode=True))
-                        attachment_name= self._process_attachment(part, **kwargs)
-                        if attachment_name:
-                            msg_attachments.append({'filename': attachment_name,
-                                                    'filesize': attachment_size})
-                    else:
-                        # Process message text.
-                        # Update `msg_plain_text` only if it isn't updated yet.
-                        if len(msg_plain_text) == 0:
-                            if str(part.get_content_type()) == 'text/plain':
-                                msg_plain_text= unicode(part.get_payload(decode=True),
-                                                        part.get_content_charset(), 'ignore').encode('utf8','replace')
-                            elif str(part.get_content_type()) == 'text/html':
-                                msg_plain_text= unicode(html2text(part.get_payload(decode=True)),
-                                                        part.get_content_charset(), 'ignore').encode('utf8','replace')
-        return msg_plain_text, msg_attachments
+        _u, content, attachment_parts= self.parse_mail(message_data)
+        return content, self.save_attachments(attachment_parts, **kwargs)
+
+    def save_attachments(self, attachment_parts, **kwargs):
+        """
+        Saves attachment parts collected by `parse_mail`.
+        Returns the list of saved attachments' names, paths, sizes and
+        SHA-256 hex digests (see `_process_attachment`).
+        """
+        msg_attachments= []
+        for part in attachment_parts:
+            attachment= self._process_attachment(part, **kwargs)
+            if attachment:
+                msg_attachments.append(attachment)
+        return msg_attachments
+
+    def _extract_text(self, part):
+        """
+        Returns plain text of the message part (text/plain or text/html).
+        """
+        content_type= str(part.get_content_type())
+        if content_type not in ('text/plain', 'text/html'):
+            return ''
+        payload= part.get_payload(decode=True)
+        if content_type == 'text/html':
+            payload= html2text(payload)
+        return unicode(payload, part.get_content_charset() or 'utf8',
+                       'ignore').encode('utf8','replace')
 
     def _process_attachment(self, part, **kwargs):
         """
-        Processes the Content-Disposition part of the current message.
+        Processes the Content-Disposition part of the current message:
+        decodes it to the content-addressed store in `attachment_dir`
+        (identical files are stored once).
+        Returns {'filename': <file name>, 'path': <path relative to
+        `attachment_dir`>, 'filesize': <decoded size>,
+        'sha256': <hex digest>} or None.
         """
-        dir_name= kwargs.get('dir_name', '')
+        from apps.backend.utils import open_store_tmp, put_to_store
+
         now= datetime.strftime(datetime.utcnow().replace(
             tzinfo=utc), '%d-%m-%Y_%H-%M')
         ext= mimetypes.guess_extension(part.get_content_type())
-        filename= self._clean_text_encoded(part.get_filename())
+        filename= self._clean_text_encoded(part.get_filename() or '')
         if not filename:
             if not ext: # Use a generic bag-of-bits extension.
                 ext= '.bin'
             filename= 'part_%s%s' % (now, ext)
         else:
-            if ext not in filename:
-                filename= '.'.join([filename, ext])
-        message_dir= self.ensure_directory(self.attachment_dir + dir_name + now)
-        fp= open(os.path.join(message_dir, filename), 'wb')
+            if ext and (ext not in filename):
+                filename= ''.join([filename, ext])
         try:
-            fp.write(part.get_payload(decode=True))
-            fp.close()
+            fp, tmp_path= open_store_tmp(self.attachment_dir)
+            try:
+                filesize, digest= self.decode_to_file(part, fp)
+            finally:
+                fp.close()
 
-            # Returns not the full path, but only what was created.
+            # Returns not the full path, but only the path in the store.
             # The full path is not necessary, the access URL will be
             # constructed with use of MEDIA_ROOT
-            return dir_name + now + '/' + filename
+            return {'filename': filename,
+                    'path': put_to_store(tmp_path, digest,
+                        self.attachment_dir, os.path.splitext(filename)[1]),
+                    'filesize': filesize, 'sha256': digest}
+        except binascii.Error:
+            # Broken payload - the message fails (see `iter_mails`).
+            os.remove(tmp_path)
+            raise
         except Exception as e:
             print >> sys.stderr, '[%s] %s' % (
                 datetime.now().isoformat(),
                 AppMessage('CantSaveAttachmnt').message % {'filename': filename, 'error': e})
             return None
 
+    def decode_to_file(self, part, fp):
+        """
+        Decodes the payload of the message part into the file `fp`
+        by chunks, so that the decoded content is never kept in memory
+        as a whole. Returns (decoded size, SHA-256 hex digest).
+        """
+        cte= str(part.get('content-transfer-encoding', '')).strip().lower()
+        payload= part.get_payload()
+        if cte == 'base64':
+            chunks= self._iter_base64(payload)
+        elif cte == 'quoted-printable':
+            chunks= self._iter_lines(payload, binascii.a2b_qp)
+        elif cte in ('x-uuencode', 'uuencode', 'uue', 'x-uue'):
+            chunks= [part.get_payload(decode=True)] # Rare, not worth it.
+        else:
+            chunks= self._iter_lines(payload)
+        filesize, sha= 0, hashlib.sha256()
+        for chunk in chunks:
+            fp.write(chunk)
+            sha.update(chunk)
+            filesize += len(chunk)
+        return filesize, sha.hexdigest()
+
+    def _iter_base64(self, payload):
+        """
+        Decode base64 `payload` by chunks. As `get_payload(decode=True)`
+        does, ignores characters outside of the alphabet. Padding ends
+        the encoded piece (concatenated pieces are decoded one by one),
+        the unpadded end of the payload is padded. Raises binascii.Error
+        if the payload can't be decoded.
+        """
+        tail= ''
+        for i in range(0, len(payload), ATTACHMENT_CHUNK_SIZE):
+            pieces= re.split(r'=+', tail + re.sub(r'[^A-Za-z0-9+/=]', '',
+                payload[i:i + ATTACHMENT_CHUNK_SIZE]))
+            # Only complete quadruples of the last piece can be decoded,
+            # the rest is carried over to the next chunk.
+            tail= pieces.pop()
+            cut= len(tail) - len(tail) % 4
+            pieces.append(tail[:cut])
+            tail= tail[cut:]
+            for piece in pieces:
+                if piece:
+                    yield self._decode_base64_piece(piece)
+        if tail:
+            yield self._decode_base64_piece(tail)
+
+    def _decode_base64_piece(self, piece):
+        """
+        Decode base64 `piece` without its padding. A single character
+        left over from a quadruple is not valid - binascii.Error.
+        """
+        return binascii.a2b_base64(piece + '=' * (-len(piece) % 4))
+
+    def _iter_lines(self, payload, decode=None):
+        """
+        Yield chunks of `payload` cut at the line ends (so that
+        line-oriented encodings can be decoded chunk by chunk).
+        """
+        start= 0
+        while start < len(payload):
+            end= payload.find('\n', start + ATTACHMENT_CHUNK_SIZE)
+            end= len(payload) if end < 0 else end + 1
+            chunk= payload[start:end]
+            start= end
+            yield chunk if decode is None else decode(chunk)
+
     def _clean_text_encoded(self, input_text):
         """
         Cleaning and decoding input_text.
@@ -447,7 +898,7 @@ class MailImporter():
             encoding= None
             try:
                 input_text, encoding= email.Header.decode_header(input_text)[0]
-            except Exception as e:
+            except Exception:
                 input_text= None
             if encoding:
                 try:
@@ -470,6 +921,47 @@ MailImporter - end
 
 
 
+"""
+AddressRouter
+"""
+# Compiled routers by domain, see `get_address_router`.
+ADDRESS_ROUTERS= {}
+
+class AddressRouter():
+    """
+    Finds the id of the Request in the `to` field of an email: the first
+    address of the form <name>.<id>@<domain> or <name>-<id>@<domain>
+    (in a single pass of the pattern compiled once).
+    """
+    def __init__(self, domain):
+        self.domain= domain
+        # Domain should not continue, e.g. `sezam.pl.spammer.com`.
+        self.template= r'[\-\.](\d+)@%s(?![\w\.\-])' % re.escape(domain)
+        self.pattern= re.compile(self.template, re.IGNORECASE)
+
+    def route(self, to):
+        """
+        Returns the Request id (int) from the `to` field, or None.
+        """
+        found= self.pattern.search(to or '')
+        if found is None:
+            return None
+        return int(found.group(1))
+
+def get_address_router(domain):
+    """
+    AddressRouter for the domain, created once per process.
+    """
+    try:
+        return ADDRESS_ROUTERS[domain]
+    except KeyError:
+        return ADDRESS_ROUTERS.setdefault(domain, AddressRouter(domain))
+"""
+AddressRouter - end
+"""
+
+
+
 """
 APP_MESSAGES is a dictionary of all possible messages, with which
 any project module send a message to any other module or to front-end:
@@ -511,6 +1003,33 @@ APP_MESSAGES = {
     'CheckMailComplete': {
         'message': _(u'Email check complete, received %s messages')
         },
+    'AttachmentStoreCleaned': {
+        'message': _(u'Files removed from the attachment store: %d')
+        },
+    'CheckMailDispatched': {
+        'message': _(u'Email check started for mailboxes: %s')
+        },
+    'CheckMailboxComplete': {
+        'message': _(u'Mailbox %(mailbox)s checked: received %(received)s messages, processed %(processed)s, skipped %(skipped)s')
+        },
+    'MailListenerReconnect': {
+        'message': _(u'Mailbox %(mailbox)s listener lost connection (%(error)s), reconnecting in %(delay)s seconds')
+        },
+    'MailListenerFailed': {
+        'message': _(u'Mailbox %(mailbox)s listener failed (%(error)s), reconnecting in %(delay)s seconds')
+        },
+    'MailImportGaveUp': {
+        'message': _(u'Mailbox %(mailbox)s: message %(uid)s failed to import %(attempts)s times, left unread')
+        },
+    'CheckMailboxFailed': {
+        'message': _(u'Mailbox %(mailbox)s check interrupted after %(received)s messages: %(error)s')
+        },
+    'MailQueueFailed': {
+        'message': _(u'Mail to %(recipients)s failed after %(attempts)s attempts: %(error)s')
+        },
+    'MailQueueComplete': {
+        'message': _(u'Completed sending queued mail: %d sent.')
+        },
     'CheckOverdueComplete': {
         'message': _(u'Complete checking overdue requests. Total number of overdue requests: %s')
         },
@@ -532,6 +1051,9 @@ APP_MESSAGES = {
     'DraftRemoveFailed': {
         'message': _("Failed to remove a draft, while sending Request. System error is: %s"),
         },
+    'MassRequestStarted': {
+        'message': _(u'Your request is being sent to %(count)d authorities. It may take a while, you can <a href="%(url)s">check the progress</a> any time.'),
+        },
     'DraftSaveFailed': {
         'message': _("Failed to save a Request draft, while sending PIA Request. System error is: %s"),
         },
@@ -547,6 +1069,24 @@ APP_MESSAGES = {
     'NotificFailed': {
         'message': _(u'Error sending notification: %s')
         },        
+    'NotificGaveUp': {
+        'message': _(u'Notification about %(action)s (%(object)s) not sent to %(receiver)s after %(attempts)s attempts')
+        },
+    'NotificDigest': {
+        'message': _(u'Updates of the items you are following: %d')
+        },
+    'NotificDigestsComplete': {
+        'message': _(u'Completed sending notification digests: %d sent.')
+        },
+    'SearchIndexLocked': {
+        'message': _(u'Search index is being updated by another run, skipped.')
+        },
+    'SearchIndexComplete': {
+        'message': _(u'Completed updating search index: %d changes processed.')
+        },
+    'NotificEventsComplete': {
+        'message': _(u'Completed processing notification events: %d processed.')
+        },
     'AuthSavedInactive': {
         'message': _(u'Athority <strong>%s</strong> successfully saved in the db! <br/>It will remain inactive until our moderator finish reviewing and confirming the record. We will notify you upon this by email. <p>Thanks a lot for your participation!</p>'),
         },
@@ -1,11 +1,20 @@
 from django.contrib import admin
-from apps.backend.models import EventNotification
+from apps.backend.models import EventNotification, OutgoingMail
 
 class EventNotificationAdmin(admin.ModelAdmin):
-    list_display= ('item', 'action', 'awaiting', 'receiver', 'receiver_email',)
+    list_display= ('item', 'action', 'awaiting', 'delivery', 'receiver', 'receiver_email',)
     search_fields= ('item', 'receiver', 'receiver_email',)
-    list_filter= ('action', 'awaiting',)
-    fields= ('item', 'action', 'awaiting', 'receiver', 'receiver_email',)
+    list_filter= ('action', 'awaiting', 'delivery',)
+    fields= ('item', 'action', 'awaiting', 'delivery', 'receiver', 'receiver_email',)
     ordering= ('-created',)
 
 admin.site.register(EventNotification, EventNotificationAdmin)
+
+class OutgoingMailAdmin(admin.ModelAdmin):
+    list_display= ('recipients', 'subject', 'status', 'attempts', 'next_attempt', 'created',)
+    search_fields= ('recipients', 'subject',)
+    list_filter= ('status',)
+    readonly_fields= ('created', 'lastchanged', 'message', 'attachments', 'last_error',)
+    ordering= ('-created',)
+
+admin.site.register(OutgoingMail, OutgoingMailAdmin)
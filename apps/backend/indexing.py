@@ -0,0 +1,104 @@
+"""
+Incremental search indexing.
+
+Saving (or deleting) an indexed object only puts its id to the queue
+(IndexUpdate, see `queue_index_update`). The periodic task
+`update_search_index` takes the queue in batches and updates only those
+documents, in bulk (see `update_index_queue`). Its runs are not allowed
+to overlap (see `acquire_lock`). After the documents of a model are
+updated, `index_updated` is sent with their ids.
+"""
+import uuid
+from datetime import datetime, timedelta
+
+from django.contrib.contenttypes.models import ContentType
+from django.utils.timezone import utc
+from django.dispatch import Signal
+from django.conf import settings
+from haystack import connections
+from haystack.exceptions import NotHandled
+
+from apps.backend.models import IndexUpdate, TaskLock
+
+# Sent by `update_index_queue` with the model as a sender.
+index_updated= Signal(providing_args=['ids'])
+
+
+def queue_index_update(model, ids):
+    """
+    Put the objects of `model` with `ids` to the indexing queue
+    with one INSERT.
+    """
+    content_type= ContentType.objects.get_for_model(model)
+    IndexUpdate.objects.bulk_create([IndexUpdate(content_type=content_type,
+        object_id=object_id) for object_id in set(ids)])
+
+
+def update_index_queue(batch_size=None, using='default'):
+    """
+    Update the documents of the batch of queued objects: those which are
+    still in `index_queryset` are updated in bulk, the rest is removed
+    from the index.
+    Returns the number of processed queue entries.
+    """
+    batch_size= batch_size or settings.SEARCH_INDEX_BATCH_SIZE
+    now= datetime.utcnow().replace(tzinfo=utc)
+
+    # Entries of the run that was interrupted are queued again.
+    IndexUpdate.objects.filter(claimed__lt=now - timedelta(hours=1)).update(
+        claimed=None, claimed_by='')
+
+    claim= uuid.uuid4().hex
+    due= IndexUpdate.objects.filter(claimed_by='').order_by('pk').values_list(
+        'pk', flat=True)[:batch_size]
+    IndexUpdate.objects.filter(pk__in=list(due), claimed_by='').update(
+        claimed=now, claimed_by=claim)
+    entries= IndexUpdate.objects.filter(claimed_by=claim)
+    queued= {}
+    for content_type_id, object_id in entries.values_list('content_type',
+                                                          'object_id'):
+        queued.setdefault(content_type_id, set()).add(object_id)
+    if not queued:
+        return 0
+
+    unified_index= connections[using].get_unified_index()
+    backend= connections[using].get_backend()
+    for content_type_id, ids in queued.iteritems():
+        model= ContentType.objects.get_for_id(content_type_id).model_class()
+        try:
+            index= unified_index.get_index(model)
+        except NotHandled:
+            continue
+        objects= list(index.index_queryset().filter(pk__in=ids))
+        if objects:
+            backend.update(index, objects)
+        for object_id in ids - set(obj.pk for obj in objects):
+            backend.remove('%s.%s.%s' % (model._meta.app_label,
+                                         model._meta.module_name, object_id))
+        index_updated.send(sender=model, ids=ids)
+    count= entries.count()
+    entries.delete()
+    return count
+
+
+def acquire_lock(name, timeout):
+    """
+    Acquire the lock `name` for `timeout` seconds (it expires afterwards,
+    in case the run holding it is killed).
+    Returns the token for `release_lock`, or None if the lock is held.
+    """
+    now= datetime.utcnow().replace(tzinfo=utc)
+    token= uuid.uuid4().hex
+    TaskLock.objects.get_or_create(name=name)
+    acquired= TaskLock.objects.filter(name=name).exclude(
+        locked_by__gt='', expires__gt=now).update(locked_by=token,
+        expires=now + timedelta(seconds=timeout))
+    return token if acquired else None
+
+
+def release_lock(name, token):
+    """
+    Release the lock `name`, if it is still held by `token`.
+    """
+    TaskLock.objects.filter(name=name, locked_by=token).update(
+        locked_by='', expires=None)
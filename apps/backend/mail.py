@@ -0,0 +1,240 @@
+"""
+Outbound mail queue.
+
+With EMAIL_BACKEND = 'apps.backend.mail.QueuedEmailBackend' every message
+sent by the project is only stored in the db (OutgoingMail), so that the
+views don't wait for SMTP. The messages are sent by the periodic task
+`process_mail_queue` through MAIL_QUEUE_BACKEND: in batches over one
+connection (see `send_queued_mail`), with retries, recorded delivery
+status and the limit of messages per minute to every e-mail domain.
+
+Attachments are not stored in the queue: the files are put to the
+attachment store (once per content, however many messages they are
+attached to), the messages only refer to them.
+"""
+import os
+import sys
+import uuid
+import email
+import mimetypes
+from email.mime.multipart import MIMEMultipart
+from datetime import datetime, timedelta
+
+from django.core.mail import EmailMessage, get_connection
+from django.core.mail.backends.base import BaseEmailBackend
+from django.db.models import Count, Min
+from django.utils.timezone import utc
+from django.conf import settings
+
+from apps.backend.models import OutgoingMail
+from apps.backend.utils import mime_attachment, store_content
+from apps.backend import AppMessage
+
+
+class QueuedEmailBackend(BaseEmailBackend):
+    """
+    E-mail backend that puts messages to the outbound queue.
+    """
+    def send_messages(self, email_messages):
+        if not email_messages:
+            return 0
+        now= datetime.utcnow().replace(tzinfo=utc)
+        queued= []
+        for message in email_messages:
+            recipients= message.recipients()
+            if not recipients:
+                continue
+            try:
+                attachments= [self._store_attachment(attachment)
+                              for attachment in message.attachments]
+                queued.append(OutgoingMail(from_email=message.from_email,
+                    recipients='\n'.join(recipients),
+                    domain=recipients[0].rsplit('@', 1)[-1].lower()[:254],
+                    subject=message.subject[:255],
+                    message=self._render(message).decode('utf-8'),
+                    attachments='\n'.join(attachments),
+                    next_attempt=now))
+            except Exception:
+                if not self.fail_silently:
+                    raise
+        try:
+            OutgoingMail.objects.bulk_create(queued)
+        except Exception:
+            if not self.fail_silently:
+                raise
+            return 0
+        return len(queued)
+
+    def _render(self, message):
+        """
+        MIME message without attachments.
+        """
+        attachments, message.attachments= message.attachments, []
+        try:
+            return message.message().as_string()
+        finally:
+            message.attachments= attachments
+
+    def _store_attachment(self, attachment):
+        """
+        Put the attachment (MIME part, or (filename, content, mimetype))
+        to the attachment store, unless it is there already (`stored_path`
+        of the part, see `mime_attachment`).
+        Returns the reference: path in the store, mimetype and filename
+        separated by tabs.
+        """
+        if isinstance(attachment, tuple):
+            filename, content, mimetype= attachment
+            path= None
+        else:
+            filename= attachment.get_filename()
+            mimetype= attachment.get_content_type()
+            path= getattr(attachment, 'stored_path', None)
+            if path is None:
+                content= attachment.get_payload(decode=True)
+        filename= filename or 'attachment'
+        mimetype= mimetype or mimetypes.guess_type(filename)[0] or ''
+        if path is None:
+            path= store_content(content, settings.ATTACHMENT_DIR,
+                                os.path.splitext(filename)[1])
+        return '\t'.join([path, mimetype, filename.replace('\t', ' ')])
+
+
+class QueuedMessage(EmailMessage):
+    """
+    EmailMessage restored from the queue: the MIME message is already
+    rendered, only the envelope is needed for sending, and the attachments
+    are read from the store.
+    """
+    def __init__(self, mail, **kwargs):
+        super(QueuedMessage, self).__init__(subject=mail.subject,
+            from_email=mail.from_email, to=mail.recipients.split('\n'),
+            **kwargs)
+        self.mime= mail.message.encode('utf-8')
+        self.stored_attachments= [line.split('\t', 2) for line in
+                                  mail.attachments.splitlines() if line]
+
+    def message(self):
+        msg= email.message_from_string(self.mime)
+        if not self.stored_attachments:
+            return msg
+        # The same structure as EmailMessage makes: the body is the first
+        # part of multipart/mixed.
+        mixed= MIMEMultipart('mixed')
+        envelope= lambda name: not (name.lower().startswith('content-') or
+                                    name.lower() == 'mime-version')
+        for name, value in msg.items():
+            if envelope(name):
+                mixed[name]= value
+        for name in set(msg.keys()):
+            if envelope(name):
+                del msg[name]
+        mixed.attach(msg)
+        for path, mimetype, filename in self.stored_attachments:
+            with open(os.path.join(settings.ATTACHMENT_DIR, path), 'rb') as f:
+                mixed.attach(mime_attachment(filename, f.read(),
+                                             mimetype or None))
+        return mixed
+
+
+def send_queued_mail(batch_size=None):
+    """
+    Send the batch of queued messages due for sending over one connection.
+    No more than MAIL_DOMAIN_RATE_LIMIT messages are sent to the same domain
+    within a minute, the rest waits for the next run.
+    Failed messages are retried after MAIL_QUEUE_RETRY_DELAY, which doubles
+    after every attempt, until MAIL_QUEUE_MAX_ATTEMPTS is reached.
+    Returns the number of messages sent.
+    """
+    batch_size= batch_size or settings.MAIL_QUEUE_BATCH_SIZE
+    now= datetime.utcnow().replace(tzinfo=utc)
+
+    # Messages of the run that was interrupted (e.g. worker killed)
+    # are queued again.
+    OutgoingMail.objects.filter(status='sending',
+        lastchanged__lt=now - timedelta(hours=1)).update(
+        status='queued', claimed_by='', lastchanged=now)
+
+    # Claim the batch, so that concurrent runs don't send the same messages.
+    claim= uuid.uuid4().hex
+    due= _due_within_domain_limits(now, batch_size)
+    OutgoingMail.objects.filter(pk__in=due, status='queued').update(
+        status='sending', claimed_by=claim, lastchanged=now)
+    batch= list(OutgoingMail.objects.filter(claimed_by=claim,
+                                            status='sending'))
+    if not batch:
+        return 0
+
+    sent= 0
+    connection= get_connection(settings.MAIL_QUEUE_BACKEND)
+    try:
+        connection.open()
+    except Exception as e:
+        # Nothing can be sent now.
+        for mail in batch:
+            _retry(mail, e)
+        return 0
+    try:
+        for mail in batch:
+            try:
+                connection.send_messages([QueuedMessage(mail)])
+            except Exception as e:
+                _retry(mail, e)
+            else:
+                mail.status= 'sent'
+                mail.attempts += 1
+                mail.last_error= ''
+                mail.save()
+                sent += 1
+    finally:
+        try:
+            connection.close()
+        except Exception:
+            pass
+    return sent
+
+
+def _due_within_domain_limits(now, batch_size):
+    """
+    Ids of no more than `batch_size` messages due for sending, no more
+    than the domains of their recipients may receive now (see
+    MAIL_DOMAIN_RATE_LIMIT). The domains are taken in the order of their
+    oldest messages.
+    """
+    queued= OutgoingMail.objects.filter(status='queued', next_attempt__lte=now)
+    # Sent (or being sent) within the last minute.
+    recent= dict(OutgoingMail.objects.filter(status__in=('sent', 'sending'),
+        lastchanged__gte=now - timedelta(minutes=1)).order_by().values_list(
+        'domain').annotate(Count('pk')))
+    due= []
+    for domain, first in queued.order_by().values_list('domain').annotate(
+            first=Min('pk')).order_by('first'):
+        limit= min(settings.MAIL_DOMAIN_RATE_LIMIT - recent.get(domain, 0),
+                   batch_size - len(due))
+        if limit > 0:
+            due.extend(queued.filter(domain=domain).order_by('pk'
+                ).values_list('pk', flat=True)[:limit])
+        if len(due) >= batch_size:
+            break
+    return due
+
+
+def _retry(mail, error):
+    """
+    Put the message back to the queue with a delay, or mark it as failed.
+    """
+    mail.attempts += 1
+    mail.last_error= unicode(error)
+    if mail.attempts >= settings.MAIL_QUEUE_MAX_ATTEMPTS:
+        mail.status= 'failed'
+        print >> sys.stderr, '[%s] %s' % (datetime.now().isoformat(),
+            AppMessage('MailQueueFailed').message % {
+                'recipients': mail.recipients.replace('\n', ', '),
+                'attempts': mail.attempts, 'error': mail.last_error})
+    else:
+        mail.status= 'queued'
+        mail.next_attempt= datetime.utcnow().replace(tzinfo=utc) + \
+            timedelta(seconds=settings.MAIL_QUEUE_RETRY_DELAY *
+                      2 ** (mail.attempts - 1))
+    mail.claimed_by= ''
+    mail.save()
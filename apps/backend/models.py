@@ -7,9 +7,11 @@ from django.db.models import *
 from django.contrib.contenttypes.models import ContentType
 from django.contrib.contenttypes import generic
 from django.contrib.auth.models import User
+from django.db.models.signals import post_init, post_save, post_delete
+from django.dispatch import receiver
 from django.utils.translation import ugettext_lazy as _
 
-from apps.vocabulary.models import Vocabulary, SlugVocabulary
+from apps.vocabulary.models import Vocabulary, SlugVocabulary, AuthorityProfile
 
 
 ACTION= (
@@ -99,23 +101,37 @@ class TaggedItem(Vocabulary, SlugVocabulary):
         """
         Returns True if `usr` is subscribed to the updates of the Item.
         """
-        if self.notification.filter(receiver=usr).count() > 0:
-            return True
-        return False
+        return self.notification.filter(receiver=usr).exists()
 
     def __unicode__(self):
         return self.slug
 
 
+DELIVERY= (
+    ('immediate', _(u'Immediately')),
+    ('hourly', _(u'Hourly digest')),
+    ('daily', _(u'Daily digest')),
+    )
+
+
 class EventNotification(GenericEvent):
     """
     Notification about changes in the db.
+
+    With `delivery` other than 'immediate' the events are collected and
+    sent in one digest per receiver at the end of the period:
+    `pending_since` is the time of the first event since the last digest
+    (see apps.backend.notifications).
     """
     item= ForeignKey(TaggedItem, null=True, blank=True,
                      related_name='notification', verbose_name=_(u'Item'))
     action= CharField(max_length=50, choices=ACTION,
                       verbose_name=_(u'Notify about action'))
     awaiting= BooleanField(default=True, verbose_name=_(u'Awaiting'))
+    delivery= CharField(max_length=10, choices=DELIVERY, default='immediate',
+                        verbose_name=_(u'Delivery'))
+    pending_since= DateTimeField(null=True, blank=True, db_index=True,
+                                 verbose_name=_(u'Pending since'))
 
     # Should not depend on the registration in the system!
     # Notifications to the emails outside the system are possible.
@@ -134,3 +150,164 @@ class EventNotification(GenericEvent):
 
     def __unicode__(self):
         return '%s: %s' % (self.item.slug, self.action)
+
+
+class NotificationEvent(Model):
+    """
+    Event in the notification queue: `action` (one of ACTION) happened to
+    the object, which can be followed (see apps.backend.notifications).
+    `claimed_by` identifies the run of `send_pending_notifications`
+    that is processing the event. The event with `receiver_email` is only
+    for that follower: it is queued again (not before `next_attempt`)
+    for those who couldn't be notified, or kept for the digest
+    (`delivery` 'hourly' or 'daily', see `send_digests`).
+    """
+    content_type= ForeignKey(ContentType)
+    object_id= PositiveIntegerField()
+    action= CharField(max_length=50, choices=ACTION,
+                      verbose_name=_(u'Action'))
+    receiver_email= EmailField(max_length=254, blank=True,
+                               verbose_name=_(u'To e-mail'))
+    attempts= PositiveIntegerField(default=0, verbose_name=_(u'Attempts'))
+    next_attempt= DateTimeField(null=True, blank=True, db_index=True,
+                                verbose_name=_(u'Next attempt'))
+    delivery= CharField(max_length=10, choices=DELIVERY, blank=True,
+                        db_index=True, verbose_name=_(u'Delivery'))
+    created= DateTimeField(auto_now_add=True, db_index=True,
+                           verbose_name=_(u'Created'))
+    claimed= DateTimeField(null=True, blank=True, verbose_name=_(u'Claimed'))
+    claimed_by= CharField(max_length=32, blank=True, db_index=True,
+                          verbose_name=_(u'Claimed by'))
+
+    class Meta:
+        ordering= ('created',)
+
+    def __unicode__(self):
+        return '%s %s: %s' % (self.content_type, self.object_id, self.action)
+
+
+class IndexUpdate(Model):
+    """
+    Object, which is changed (or deleted) since it was put to the search
+    index. The queue is processed by `update_search_index` task (see
+    apps.backend.indexing).
+    """
+    content_type= ForeignKey(ContentType)
+    object_id= PositiveIntegerField()
+    created= DateTimeField(auto_now_add=True, verbose_name=_(u'Created'))
+    claimed= DateTimeField(null=True, blank=True, verbose_name=_(u'Claimed'))
+    claimed_by= CharField(max_length=32, blank=True, db_index=True,
+                          verbose_name=_(u'Claimed by'))
+
+    def __unicode__(self):
+        return '%s %s' % (self.content_type, self.object_id)
+
+
+class TaskLock(Model):
+    """
+    Lock, which prevents overlapping runs of a task: `locked_by` identifies
+    the run holding it, until `expires` (see apps.backend.indexing).
+    """
+    name= CharField(max_length=50, unique=True, verbose_name=_(u'Name'))
+    locked_by= CharField(max_length=32, blank=True, verbose_name=_(u'Locked by'))
+    expires= DateTimeField(null=True, blank=True, verbose_name=_(u'Expires'))
+
+    def __unicode__(self):
+        return self.name
+
+
+@receiver(post_init, sender=AuthorityProfile)
+def _authority_post_init(sender, instance, **kwargs):
+    """
+    Remember if the Authority was active (unless `active` is deferred).
+    """
+    instance._was_active= instance.__dict__.get('active')
+
+
+@receiver(post_save, sender=AuthorityProfile)
+def _authority_post_save(sender, instance, **kwargs):
+    """
+    Queue the event, when the Authority becomes active, so that only the
+    subscriptions to it are processed (see apps.backend.notifications).
+    Queue the update of the search index.
+    """
+    if instance.active and getattr(instance, '_was_active', None) is False:
+        NotificationEvent.objects.create(object_id=instance.pk,
+            content_type=ContentType.objects.get_for_model(sender),
+            action='active')
+    instance._was_active= instance.active
+    IndexUpdate.objects.create(object_id=instance.pk,
+        content_type=ContentType.objects.get_for_model(sender))
+
+
+@receiver(post_delete, sender=AuthorityProfile)
+def _authority_post_delete(sender, instance, **kwargs):
+    """
+    Queue the removal of the Authority from the search index.
+    """
+    IndexUpdate.objects.create(object_id=instance.pk,
+        content_type=ContentType.objects.get_for_model(sender))
+
+
+class MailboxState(Model):
+    """
+    Watermark of the mail import from the mailbox (key in MAILBOXES):
+    messages with UID up to `last_uid` are already imported, as long as
+    UIDVALIDITY of the mailbox remains the same. Except for `retry_uids`:
+    messages which failed to import, to be retried on the next import,
+    as `uid:attempts` separated by spaces.
+    """
+    mailbox= CharField(max_length=50, unique=True, verbose_name=_(u'Mailbox'))
+    uidvalidity= BigIntegerField(null=True, blank=True,
+                                 verbose_name=_(u'UIDVALIDITY'))
+    last_uid= BigIntegerField(default=0, verbose_name=_(u'Last imported UID'))
+    retry_uids= TextField(blank=True, default='',
+                          verbose_name=_(u'UIDs to retry'))
+    lastchanged= DateTimeField(auto_now=True, verbose_name=_(u'Last changed'))
+
+    def __unicode__(self):
+        return '%s: %s/%s' % (self.mailbox, self.uidvalidity, self.last_uid)
+
+
+MAIL_STATUS= (
+    ('queued', _(u'Queued')),
+    ('sending', _(u'Sending')),
+    ('sent', _(u'Sent')),
+    ('failed', _(u'Failed')),
+    )
+
+
+class OutgoingMail(Model):
+    """
+    E-mail message in the outbound queue (see QueuedEmailBackend).
+    `message` is the rendered MIME message without attachments,
+    `attachments` - references to the files in the attachment store,
+    attached at sending time (see `QueuedMessage`), one per line.
+    `recipients` - envelope recipients, one per line, `domain` - the domain
+    of the first of them. `claimed_by` identifies the run of
+    `send_queued_mail` that is sending the message.
+    """
+    created= DateTimeField(auto_now_add=True, verbose_name=_(u'Created'))
+    lastchanged= DateTimeField(auto_now=True, verbose_name=_(u'Last changed'))
+    from_email= CharField(max_length=254, verbose_name=_(u'From e-mail'))
+    recipients= TextField(verbose_name=_(u'Recipients'))
+    domain= CharField(max_length=254, blank=True, db_index=True,
+                      verbose_name=_(u'Recipient domain'))
+    subject= CharField(max_length=255, blank=True, verbose_name=_(u'Subject'))
+    message= TextField(verbose_name=_(u'Message'))
+    attachments= TextField(blank=True, verbose_name=_(u'Attachments'))
+    status= CharField(max_length=10, choices=MAIL_STATUS, default='queued',
+                      db_index=True, verbose_name=_(u'Status'))
+    attempts= PositiveIntegerField(default=0, verbose_name=_(u'Attempts'))
+    next_attempt= DateTimeField(null=True, blank=True, db_index=True,
+                                verbose_name=_(u'Next attempt'))
+    last_error= TextField(blank=True, verbose_name=_(u'Last error'))
+    claimed_by= CharField(max_length=32, blank=True, db_index=True,
+                          verbose_name=_(u'Claimed by'))
+
+    class Meta:
+        ordering= ('created',)
+
+    def __unicode__(self):
+        return '%s: %s (%s)' % (self.recipients.replace('\n', ', '),
+                                self.subject, self.status)
@@ -0,0 +1,306 @@
+"""
+Notification engine.
+
+Saving a message, an annotation, etc. only puts NotificationEvent rows
+to the queue (see `queue_events`), no mail is sent inline. The periodic
+task `process_notifications` takes the events in batches, finds
+the followers of all of them with one query and sends one message per
+receiver (see `send_pending_notifications`). The events are queued again
+for the receivers who couldn't be notified (see `requeue_events`).
+
+For subscriptions with hourly or daily delivery the events are queued
+again for their receivers, who get one digest of them at the end of the
+period (see `send_digests`).
+"""
+import sys
+import uuid
+from datetime import datetime, timedelta
+
+from django.core.mail import EmailMessage, get_connection
+from django.contrib.contenttypes.models import ContentType
+from django.template.loader import render_to_string
+from django.db.models import Q
+from django.db import transaction
+from django.utils.timezone import utc
+from django.conf import settings
+
+from apps.backend.models import NotificationEvent, EventNotification
+from apps.backend.utils import get_domain_name, notification_message, \
+    notification_item_name
+from apps.backend import AppMessage
+
+
+def queue_events(events):
+    """
+    Put the events to the queue with one INSERT.
+    `events` is a list of (model, object_id, action).
+    """
+    g= ContentType.objects.get_for_model # Cached by Django.
+    NotificationEvent.objects.bulk_create([NotificationEvent(
+        content_type_id=g(model).id, object_id=object_id, action=action)
+        for model, object_id, action in events])
+
+
+def send_pending_notifications(batch_size=None):
+    """
+    Notify the followers about the batch of queued events. Notifications
+    of the same receiver are sent in one message (digest). All messages
+    are sent over one connection, one by one: if the message to the
+    receiver cannot be built or sent, the events are queued again only
+    for that receiver.
+    Returns the number of processed events.
+    """
+    batch_size= batch_size or settings.NOTIFICATION_BATCH_SIZE
+    now= datetime.utcnow().replace(tzinfo=utc)
+
+    # Events of the run that was interrupted are queued again.
+    NotificationEvent.objects.filter(claimed__lt=now - timedelta(hours=1)
+        ).update(claimed=None, claimed_by='')
+
+    # Claim the batch, so that concurrent runs don't process the same events.
+    claim= uuid.uuid4().hex
+    due= NotificationEvent.objects.filter(Q(next_attempt__isnull=True) |
+        Q(next_attempt__lte=now), claimed_by='', delivery='').values_list(
+        'pk', flat=True)[:batch_size]
+    NotificationEvent.objects.filter(pk__in=list(due), claimed_by='').update(
+        claimed=now, claimed_by=claim)
+    events= list(NotificationEvent.objects.filter(claimed_by=claim))
+    if not events:
+        return 0
+
+    notifications= find_notifications(events)
+    receivers= group_by_receiver(n for n in notifications
+                                 if n.delivery == 'immediate')
+    failed= send_notification_messages(receivers)
+    EventNotification.objects.filter(pk__in=[n.pk for n in notifications
+        if n.action == 'active' and n.delivery == 'immediate' and
+        n.receiver_email not in failed]).update(awaiting=False)
+    # The rest waits for the digest.
+    digest= [n for n in notifications if n.delivery != 'immediate']
+    EventNotification.objects.filter(pk__in=[n.pk for n in digest],
+        pending_since__isnull=True).update(pending_since=now)
+    with transaction.commit_on_success():
+        requeue_events(events, dict((receiver_email, receivers[receiver_email])
+                                    for receiver_email in failed))
+        NotificationEvent.objects.bulk_create([NotificationEvent(
+            content_type_id=n.item.content_type_id,
+            object_id=n.item.object_id, action=n.action,
+            receiver_email=n.receiver_email, delivery=n.delivery)
+            for n in digest])
+        NotificationEvent.objects.filter(claimed_by=claim).delete()
+    return len(events)
+
+
+def send_notification_messages(receivers, digest=False):
+    """
+    Send the messages to the `receivers` of notifications (see
+    `notification_messages`) one by one over one connection.
+    Returns the set of e-mails of the receivers, whose message couldn't
+    be built or sent.
+    """
+    failed= set()
+    connection= get_connection()
+    try:
+        for receiver_email, message in notification_messages(receivers,
+                                                             digest=digest):
+            if message is not None:
+                try:
+                    connection.send_messages([message])
+                    continue
+                except Exception as e:
+                    print >> sys.stderr, '[%s] %s' % (
+                        datetime.now().isoformat(),
+                        AppMessage('NotificFailed').message % e)
+            failed.add(receiver_email)
+    finally:
+        try:
+            connection.close()
+        except Exception:
+            pass
+    return failed
+
+
+def requeue_events(events, receivers):
+    """
+    Queue the `events` again for the `receivers` ({receiver_email:
+    [notifications]}) only, after NOTIFICATION_RETRY_DELAY (doubled after
+    every attempt). Those which failed NOTIFICATION_MAX_ATTEMPTS times
+    are dropped.
+    """
+    by_key= {}
+    for event in events:
+        by_key.setdefault((event.content_type_id, event.object_id,
+                           event.action), []).append(event)
+    # {(content_type_id, object_id, action, receiver_email): attempts}
+    retry= {}
+    for receiver_email, notifications in receivers.iteritems():
+        for notification in notifications:
+            key= (notification.item.content_type_id,
+                  notification.item.object_id, notification.action)
+            for event in by_key.get(key, []):
+                if event.receiver_email in ('', receiver_email):
+                    retry[key + (receiver_email,)]= max(event.attempts + 1,
+                        retry.get(key + (receiver_email,), 0))
+
+    now= datetime.utcnow().replace(tzinfo=utc)
+    queued= []
+    for (content_type_id, object_id, action, receiver_email), attempts \
+            in retry.iteritems():
+        if attempts >= settings.NOTIFICATION_MAX_ATTEMPTS:
+            print >> sys.stderr, '[%s] %s' % (datetime.now().isoformat(),
+                AppMessage('NotificGaveUp').message % {'action': action,
+                    'object': '%s %s' % (content_type_id, object_id),
+                    'receiver': receiver_email, 'attempts': attempts})
+            continue
+        queued.append(NotificationEvent(content_type_id=content_type_id,
+            object_id=object_id, action=action, receiver_email=receiver_email,
+            attempts=attempts, next_attempt=now + timedelta(seconds=
+                settings.NOTIFICATION_RETRY_DELAY * 2 ** (attempts - 1))))
+    NotificationEvent.objects.bulk_create(queued)
+
+
+def send_digests(delivery, batch_size=None):
+    """
+    Send one digest of the events queued for the subscriptions with the
+    given `delivery` ('hourly' or 'daily') to every receiver, `batch_size`
+    receivers over one connection at a time. The subscriptions covered by
+    the digest are no longer pending.
+    Returns the number of digests sent.
+    """
+    batch_size= batch_size or settings.NOTIFICATION_BATCH_SIZE
+    now= datetime.utcnow().replace(tzinfo=utc)
+    receivers= list(NotificationEvent.objects.filter(delivery=delivery,
+        claimed_by='').order_by('receiver_email').values_list(
+        'receiver_email', flat=True).distinct())
+    sent= 0
+    for i in range(0, len(receivers), batch_size):
+        # Claim the events, as in `send_pending_notifications`.
+        claim= uuid.uuid4().hex
+        NotificationEvent.objects.filter(delivery=delivery, claimed_by='',
+            receiver_email__in=receivers[i:i + batch_size]).update(
+            claimed=now, claimed_by=claim)
+        events= list(NotificationEvent.objects.filter(claimed_by=claim))
+        grouped= digest_notifications(events, delivery)
+        # Those who failed get the events in the next digest.
+        failed= send_notification_messages(grouped, digest=True)
+        covered= [n.pk for receiver_email, notifications in grouped.iteritems()
+                  if receiver_email not in failed for n in notifications]
+        with transaction.commit_on_success():
+            EventNotification.objects.filter(pk__in=covered).update(
+                pending_since=None)
+            EventNotification.objects.filter(pk__in=covered,
+                action='active').update(awaiting=False)
+            NotificationEvent.objects.filter(claimed_by=claim,
+                receiver_email__in=failed).update(claimed=None, claimed_by='')
+            NotificationEvent.objects.filter(claimed_by=claim).delete()
+        sent += len(grouped) - len(failed)
+    return sent
+
+
+def digest_notifications(events, delivery):
+    """
+    Subscriptions with the given `delivery` to the `events` queued for
+    their receivers, grouped by receiver (see `group_by_receiver`):
+    one per event, in the order of the events. The events, whose
+    subscription is removed (or its delivery changed) are skipped.
+    """
+    notifications= {}
+    for notification in _with_items(EventNotification.objects.filter(
+            delivery=delivery, receiver_email__in=set(event.receiver_email
+                for event in events))):
+        notifications[(notification.item.content_type_id,
+                       notification.item.object_id, notification.action,
+                       notification.receiver_email)]= notification
+    receivers= {}
+    for event in events:
+        notification= notifications.get((event.content_type_id,
+            event.object_id, event.action, event.receiver_email))
+        if notification is not None:
+            receivers.setdefault(event.receiver_email, []).append(
+                notification)
+    return receivers
+
+
+def find_notifications(events):
+    """
+    Subscriptions (EventNotification) to the `events` with one query.
+    """
+    objects= {}
+    for event in events:
+        objects.setdefault(event.content_type_id, set()).add(event.object_id)
+    query= Q()
+    for content_type_id, object_ids in objects.iteritems():
+        query |= Q(item__content_type=content_type_id,
+                   item__object_id__in=object_ids)
+    # The event queued again is only for its receiver (see `requeue_events`).
+    keys= set((event.content_type_id, event.object_id, event.action,
+               event.receiver_email) for event in events)
+    notifications= _with_items(EventNotification.objects.filter(query,
+        action__in=set(event.action for event in events)).order_by('pk'))
+    # Notification about the record becoming 'active' is sent only once.
+    return [notification for notification in notifications
+            if ((notification.item.content_type_id, notification.item.object_id,
+                 notification.action, '') in keys or
+                (notification.item.content_type_id, notification.item.object_id,
+                 notification.action, notification.receiver_email) in keys) and
+               (notification.awaiting or notification.action != 'active')]
+
+
+def _with_items(notifications):
+    """
+    Fetch the items of `notifications` and their objects along with them.
+    """
+    return notifications.select_related('item', 'item__content_type'
+        ).prefetch_related('item__content_object')
+
+
+def group_by_receiver(notifications):
+    """
+    Group notifications by receiver's e-mail: {receiver_email: [notifications]}.
+    """
+    receivers= {}
+    for notification in notifications:
+        receivers.setdefault(notification.receiver_email, []).append(
+            notification)
+    return receivers
+
+
+def notification_messages(receivers, domain=None, digest=False):
+    """
+    Iterate over (receiver_email, EmailMessage) to the `receivers` of
+    notifications (see `group_by_receiver`): one per receiver, single
+    notification is sent as usual (unless `digest` is True), several -
+    as a digest. The message is None if it cannot be built.
+    """
+    domain= domain or get_domain_name()
+    for receiver_email, notifications in receivers.iteritems():
+        try:
+            if len(notifications) == 1 and not digest:
+                message= notification_message(notifications[0], domain)
+            else:
+                message= digest_message(receiver_email, notifications, domain)
+        except Exception:
+            print >> sys.stderr, '[%s] %s' % (datetime.now().isoformat(),
+                AppMessage('NotificFailed').message % receiver_email)
+            message= None
+        yield receiver_email, message
+
+
+def digest_message(receiver_email, notifications, domain):
+    """
+    EmailMessage with several notifications to the same receiver.
+    """
+    items= []
+    for notification in notifications:
+        item= notification.item
+        if item.content_type.model == 'authorityprofile':
+            url= '/authority/%s/' % item.content_object.slug
+        else:
+            url= '/request/%s/' % item.object_id
+        items.append({'action': notification.get_action_display(),
+                      'name': notification_item_name(notification),
+                      'url': url})
+    message_content= render_to_string('emails/notification_digest.txt',
+        {'items': items, 'domain': domain})
+    return EmailMessage(AppMessage('NotificDigest').message % len(items),
+        message_content, settings.SERVER_EMAIL, [receiver_email])
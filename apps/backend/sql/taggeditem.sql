@@ -0,0 +1,2 @@
+-- Subscriptions are looked up by the object (see apps.backend.subscriptions).
+CREATE INDEX backend_taggeditem_content_object ON backend_taggeditem (content_type_id, object_id);
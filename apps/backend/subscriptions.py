@@ -0,0 +1,93 @@
+"""
+Subscriptions of the Users to the updates of the objects (Requests,
+Authorities, etc.): the object is tagged with TaggedItem, every action
+the User follows is an EventNotification of that item.
+
+TaggedItem is looked up by (content_type, object_id), which is covered
+by the composite index (see sql/taggeditem.sql).
+"""
+from django.contrib.contenttypes.models import ContentType
+from django.db.models import Q
+
+from apps.backend.models import TaggedItem, EventNotification, DELIVERY
+
+
+def get_item(obj, name=None, create=False):
+    """
+    TaggedItem of `obj` (the first one, if there are several). If there
+    is none, it is created with `name` if `create` is True, otherwise
+    None is returned.
+    """
+    items= list(TaggedItem.objects.filter(object_id=obj.pk,
+        content_type=ContentType.objects.get_for_model(obj)).order_by('pk')[:1])
+    if items:
+        return items[0]
+    if create:
+        return TaggedItem.objects.create(name=name or unicode(obj),
+                                         content_object=obj)
+    return None
+
+
+def follow(user, obj, events, name=None, delivery=None):
+    """
+    Subscribe `user` to the `events` ({action: summary}) of `obj`.
+    `delivery` (one of DELIVERY) changes the delivery of the existing
+    subscriptions.
+    """
+    item= get_item(obj, name=name, create=True)
+    notifications= EventNotification.objects.filter(item=item,
+        receiver=user, action__in=events.keys())
+    if delivery in dict(DELIVERY):
+        notifications.exclude(delivery=delivery).update(delivery=delivery)
+    else:
+        delivery= 'immediate'
+    existing= set(notifications.values_list('action', flat=True))
+    EventNotification.objects.bulk_create([EventNotification(item=item,
+        action=action, summary=summary, receiver=user,
+        receiver_email=user.email, delivery=delivery)
+        for action, summary in events.iteritems() if action not in existing])
+    return item
+
+
+def unfollow(user, obj, actions=None):
+    """
+    Remove the subscriptions of `user` to the `actions` of `obj` (all of
+    them if not given). The item is removed with the last subscription.
+    """
+    item= get_item(obj)
+    if item is None:
+        return
+    notifications= EventNotification.objects.filter(item=item, receiver=user)
+    if actions is not None:
+        notifications= notifications.filter(action__in=actions)
+    notifications.delete()
+    if not EventNotification.objects.filter(item=item).exists():
+        item.delete()
+
+
+def followed(user, objects):
+    """
+    The list of `objects` (any models) `user` is subscribed to,
+    with one query.
+    """
+    if not objects or user is None or user.is_anonymous():
+        return []
+    g= ContentType.objects.get_for_model
+    ids= {}
+    for obj in objects:
+        ids.setdefault(g(obj).id, set()).add(obj.pk)
+    query= Q()
+    for content_type_id, object_ids in ids.iteritems():
+        query |= Q(item__content_type=content_type_id,
+                   item__object_id__in=object_ids)
+    keys= set(EventNotification.objects.filter(query, receiver=user
+        ).order_by().values_list('item__content_type', 'item__object_id'
+        ).distinct())
+    return [obj for obj in objects if (g(obj).id, obj.pk) in keys]
+
+
+def is_following(user, obj):
+    """
+    True if `user` is subscribed to the updates of `obj`.
+    """
+    return bool(followed(user, [obj]))
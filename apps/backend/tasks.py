@@ -4,43 +4,77 @@ from django.utils.translation import ugettext as _
 from django.core.mail import EmailMessage
 from django.conf import settings
 
-# from haystack.management.commands import update_index
-import subprocess
-
-from apps.backend.utils import send_notification
-from apps.backend.models import EventNotification
+from apps.backend.mail import send_queued_mail
+from apps.backend.indexing import update_index_queue, acquire_lock, \
+    release_lock
+from apps.backend.notifications import send_pending_notifications, \
+    send_digests
 from apps.backend import AppMessage
 
-@periodic_task(run_every=crontab(day_of_week="*", hour="*", minute="*/2"))
+@periodic_task(run_every=crontab(day_of_week="*", hour="*", minute="*"))
 def process_notifications():
     """
-    Checks for notifications about events.
-    """
-    notification_processed= 0
-    for notification in EventNotification.objects.filter(awaiting=True):
-        if notification.action == 'active':
-            # Process the notification of an element become 'active'.
-            is_active= False
-            try:
-                is_active= notification.item.content_object.active
-            except:
-                pass
-            if is_active:
-                if send_notification(notification):
-                    notification.awaiting= False
-                    notification.save()
-                    notification_processed += 1
-                else:
-                    print >> sys.stderr, '[%s] %s' % (datetime.now().isoformat(),
-                        AppMessage('NotificFailed').message % notification.__unicode__())
-    return "Completed processing notifications: %d sent." % notification_processed
-
-
-@periodic_task(run_every=crontab(day_of_week="*", hour="*/2", minute=0))
-def haystack_update_index():
-    """"""
+    Notifies the followers about the queued events
+    (see apps.backend.notifications) batch after batch: new messages,
+    annotations, Authorities that became active, etc.
+    """
+    total_processed= 0
+    while True:
+        processed= send_pending_notifications()
+        if processed == 0:
+            break
+        total_processed += processed
+    return AppMessage('NotificEventsComplete').message % total_processed
+
+
+@periodic_task(run_every=crontab(minute=0))
+def send_hourly_digests():
+    """
+    Sends the digests to the subscribers with hourly delivery.
+    """
+    return AppMessage('NotificDigestsComplete').message % send_digests('hourly')
+
+
+@periodic_task(run_every=crontab(minute=0,
+                                 hour=settings.NOTIFICATION_DIGEST_HOUR))
+def send_daily_digests():
+    """
+    Sends the digests to the subscribers with daily delivery.
+    """
+    return AppMessage('NotificDigestsComplete').message % send_digests('daily')
+
+
+@periodic_task(run_every=crontab(day_of_week="*", hour="*", minute="*"))
+def process_mail_queue():
+    """
+    Sends the outbound mail queue (see apps.backend.mail)
+    batch after batch, until nothing is due.
+    """
+    total_sent= 0
+    while True:
+        sent= send_queued_mail()
+        if sent == 0:
+            break
+        total_sent += sent
+    return AppMessage('MailQueueComplete').message % total_sent
+
+
+@periodic_task(run_every=crontab(day_of_week="*", hour="*", minute="*"))
+def update_search_index():
+    """
+    Updates the search index with the queued changes
+    (see apps.backend.indexing) batch after batch. Only one run at a time.
+    """
+    token= acquire_lock('search_index', settings.SEARCH_INDEX_LOCK_TIMEOUT)
+    if token is None:
+        return AppMessage('SearchIndexLocked').message
+    total_processed= 0
     try:
-        p= subprocess.Popen(['python', 'manage.py', 'update_index'])
-    except Exception as e:
-        return "ERROR starting subprocess. System message is:\n%s" % e
-    return "Index updated successfully."
+        while True:
+            processed= update_index_queue()
+            if processed == 0:
+                break
+            total_processed += processed
+    finally:
+        release_lock('search_index', token)
+    return AppMessage('SearchIndexComplete').message % total_processed
@@ -1,3 +1,4 @@
+# -*- coding: utf-8 -*-
 """
 This file demonstrates writing tests using the unittest module. These will pass
 when you run "manage.py test".
@@ -5,7 +6,25 @@ when you run "manage.py test".
 Replace this with more appropriate tests for your application.
 """
 
-from django.test import TestCase
+from django.test import TestCase, SimpleTestCase
+from django.contrib.auth.models import User
+from django.core import mail
+from django.utils.timezone import utc
+from django.conf import settings
+
+from datetime import datetime, timedelta
+import os, email, base64, binascii, quopri, cStringIO, hashlib, tempfile, shutil
+
+import apps.backend
+from apps.backend import MailImporter, AddressRouter, get_address_router
+from apps.backend.models import TaskLock, OutgoingMail, NotificationEvent, \
+    EventNotification
+from apps.backend.mail import _retry, _due_within_domain_limits
+from apps.backend.indexing import acquire_lock, release_lock
+from apps.backend.subscriptions import follow, followed, is_following
+from apps.backend.notifications import queue_events, \
+    send_pending_notifications, send_digests
+from apps.backend.utils import clean_text_for_search, downcode
 
 
 class SimpleTest(TestCase):
@@ -14,3 +33,378 @@ class SimpleTest(TestCase):
         Tests that 1 + 1 always equals 2.
         """
         self.assertEqual(1 + 1, 2)
+
+
+"""
+Mail import
+"""
+
+class AddressRouterTest(SimpleTestCase):
+    def setUp(self):
+        self.router= AddressRouter('sezam.pl')
+
+    def test_route(self):
+        self.assertEqual(self.router.route('odpowiedz.123@sezam.pl'), 123)
+        self.assertEqual(self.router.route('jan-kowalski-45@sezam.pl'), 45)
+        self.assertEqual(self.router.route('Jan <jan.7@SEZAM.PL>'), 7)
+
+    def test_first_address(self):
+        self.assertEqual(self.router.route(
+            'urzad@example.com, jan.8@sezam.pl, anna.9@sezam.pl'), 8)
+
+    def test_reject(self):
+        for to in ('jan.8@sezam.pl.evil.com', 'jan.8@sezam.pl-evil.com',
+                   'jan.8@sezamxpl', 'jan.8@evil.sezam.pl.com',
+                   'jan8@sezam.pl', 'jan.kowalski@sezam.pl', '', None):
+            self.assertEqual(self.router.route(to), None, to)
+
+    def test_once_per_domain(self):
+        self.assertTrue(get_address_router('sezam.pl') is
+                        get_address_router('sezam.pl'))
+
+
+class MessageSetTest(SimpleTestCase):
+    def setUp(self):
+        self.importer= MailImporter({})
+
+    def test_message_set(self):
+        self.assertEqual(self.importer._message_set(['1', '2', '3', '7']), '1:3,7')
+        self.assertEqual(self.importer._message_set(['7', '3', '1', '2']), '1:3,7')
+        self.assertEqual(self.importer._message_set(['5']), '5')
+        self.assertEqual(self.importer._message_set([10, 12, 11, 20, 21, 30]),
+                         '10:12,20:21,30')
+        self.assertEqual(self.importer._message_set([]), '')
+
+
+class DecodeToFileTest(SimpleTestCase):
+    """
+    Streaming decoding gives the same as `get_payload(decode=True)`,
+    whatever the chunk size.
+    """
+    content= ''.join(chr(i % 256) for i in range(5000)) + \
+        'Zażółć gęślą jaźń\n' * 40
+
+    def setUp(self):
+        self.importer= MailImporter({})
+        self.chunk_size= apps.backend.ATTACHMENT_CHUNK_SIZE
+
+    def tearDown(self):
+        apps.backend.ATTACHMENT_CHUNK_SIZE= self.chunk_size
+
+    def _part(self, cte, payload):
+        return email.message_from_string(
+            'Content-Type: application/octet-stream\n'
+            'Content-Transfer-Encoding: %s\n\n%s' % (cte, payload))
+
+    def _assert_decoded(self, part):
+        for chunk_size in (1, 3, 4, 77, 1000, 64 * 1024):
+            apps.backend.ATTACHMENT_CHUNK_SIZE= chunk_size
+            fp= cStringIO.StringIO()
+            size, digest= self.importer.decode_to_file(part, fp)
+            expected= part.get_payload(decode=True)
+            self.assertEqual(fp.getvalue(), expected, chunk_size)
+            self.assertEqual(size, len(expected))
+            self.assertEqual(digest, hashlib.sha256(expected).hexdigest())
+
+    def test_base64(self):
+        part= self._part('base64', base64.encodestring(self.content))
+        self._assert_decoded(part)
+        self.assertEqual(part.get_payload(decode=True), self.content)
+
+    def test_base64_garbage(self):
+        # Characters outside of the alphabet are ignored.
+        payload= base64.encodestring(self.content).replace('\n', ' \r\n\t!')
+        self._assert_decoded(self._part('base64', payload))
+
+    def test_quoted_printable(self):
+        part= self._part('quoted-printable', quopri.encodestring(self.content))
+        self._assert_decoded(part)
+        self.assertEqual(part.get_payload(decode=True), self.content)
+
+    def test_plain(self):
+        self._assert_decoded(self._part('8bit', self.content))
+
+    def test_iter_lines(self):
+        apps.backend.ATTACHMENT_CHUNK_SIZE= 4
+        self.assertEqual(list(self.importer._iter_lines('ab\ncdefgh\nij\nk')),
+                         ['ab\ncdefgh\n', 'ij\nk'])
+        self.assertEqual(list(self.importer._iter_lines('')), [])
+
+    def test_iter_base64(self):
+        apps.backend.ATTACHMENT_CHUNK_SIZE= 3
+        self.assertEqual(''.join(self.importer._iter_base64('YWJj\nZGVm\nZw==\n')),
+                         'abcdefg')
+
+    def test_iter_base64_remainder(self):
+        for chunk_size in (1, 3, 5, 1000):
+            apps.backend.ATTACHMENT_CHUNK_SIZE= chunk_size
+            # Missing padding.
+            self.assertEqual(''.join(self.importer._iter_base64('YWJj\nZGVm\nZw')),
+                             'abcdefg')
+            # Padding in the middle - concatenated pieces.
+            self.assertEqual(''.join(self.importer._iter_base64('YQ==\nYmM=\nZA==')),
+                             'abcd')
+
+    def test_iter_base64_broken(self):
+        for chunk_size in (1, 3, 1000):
+            apps.backend.ATTACHMENT_CHUNK_SIZE= chunk_size
+            self.assertRaises(binascii.Error, ''.join,
+                              self.importer._iter_base64('YWJj\nZGVm\nZ'))
+
+
+class ReportFailureTest(SimpleTestCase):
+    """
+    The message with broken attachment is left unread and retried.
+    """
+    message= ('To: jan.1@sezam.pl\n'
+        'Content-Type: multipart/mixed; boundary="b"\n\n'
+        '--b\nContent-Type: text/plain\n\nZalacznik\n'
+        '--b\nContent-Type: application/pdf\n'
+        'Content-Disposition: attachment; filename="a.pdf"\n'
+        'Content-Transfer-Encoding: base64\n\nYWJj\nZ\n'
+        '--b--\n')
+
+    class Connection(object):
+        def __init__(self, message):
+            self.message, self.commands= message, []
+
+        def select(self):
+            pass
+
+        def response(self, code):
+            return code, [None]
+
+        def uid(self, command, *args):
+            self.commands.append((command,) + args)
+            if command == 'SEARCH':
+                return 'OK', ['1']
+            if command == 'FETCH':
+                return 'OK', [('1 (UID 1 RFC822 {%d}' % len(self.message),
+                               self.message), ')']
+            return 'OK', [None]
+
+    def setUp(self):
+        self.attachment_dir= tempfile.mkdtemp()
+        self.importer= MailImporter({}, attachment_dir=self.attachment_dir)
+
+    def tearDown(self):
+        shutil.rmtree(self.attachment_dir)
+
+    def test_broken_attachment(self):
+        connection= self.Connection(self.message)
+        self.assertEqual(list(self.importer.iter_mails(connection)), [])
+        self.assertEqual(self.importer.failed_uids, {1: 1})
+        self.assertTrue(('STORE', '1', '-FLAGS', '\\SEEN') in connection.commands)
+        # Nothing is left in the store.
+        self.assertEqual(os.listdir(os.path.join(self.attachment_dir,
+                                                 'store', 'tmp')), [])
+"""
+Mail import - end
+"""
+
+
+"""
+Mail queue
+"""
+class MailQueueRetryTest(TestCase):
+    def setUp(self):
+        self.mail= OutgoingMail.objects.create(from_email='sezam@sezam.pl',
+            recipients='urzad@example.com', subject='Test', message='',
+            claimed_by='x')
+
+    def test_backoff(self):
+        delay= settings.MAIL_QUEUE_RETRY_DELAY
+        for attempt in range(1, settings.MAIL_QUEUE_MAX_ATTEMPTS):
+            before= datetime.utcnow().replace(tzinfo=utc)
+            _retry(self.mail, 'Connection refused')
+            self.assertEqual(self.mail.status, 'queued')
+            self.assertEqual(self.mail.attempts, attempt)
+            self.assertEqual(self.mail.claimed_by, '')
+            self.assertTrue(self.mail.next_attempt >=
+                before + timedelta(seconds=delay * 2 ** (attempt - 1)))
+            self.assertTrue(self.mail.next_attempt <
+                before + timedelta(seconds=delay * 2 ** attempt))
+
+    def test_failed(self):
+        self.mail.attempts= settings.MAIL_QUEUE_MAX_ATTEMPTS - 1
+        _retry(self.mail, 'User unknown')
+        mail= OutgoingMail.objects.get(pk=self.mail.pk)
+        self.assertEqual(mail.status, 'failed')
+        self.assertEqual(mail.last_error, 'User unknown')
+
+
+class MailQueueDomainLimitTest(TestCase):
+    def _queue(self, domain, count, **kwargs):
+        for i in range(count):
+            OutgoingMail.objects.create(from_email='sezam@sezam.pl',
+                recipients='urzad%d@%s' % (i, domain), domain=domain,
+                subject='Test', message='', **kwargs)
+
+    def test_limit(self):
+        now= datetime.utcnow().replace(tzinfo=utc)
+        limit= settings.MAIL_DOMAIN_RATE_LIMIT
+        self._queue('a.pl', limit + 10, next_attempt=now)
+        self._queue('b.pl', 5, next_attempt=now)
+        self._queue('c.pl', 5, next_attempt=now + timedelta(hours=1))
+        self._queue('b.pl', limit - 2, status='sent')
+        due= OutgoingMail.objects.filter(pk__in=_due_within_domain_limits(
+            now, limit * 10))
+        self.assertEqual(due.filter(domain='a.pl').count(), limit)
+        self.assertEqual(due.filter(domain='b.pl').count(), 2)
+        self.assertEqual(due.filter(domain='c.pl').count(), 0)
+
+    def test_batch_size(self):
+        now= datetime.utcnow().replace(tzinfo=utc)
+        self._queue('a.pl', 5, next_attempt=now)
+        self._queue('b.pl', 5, next_attempt=now)
+        due= _due_within_domain_limits(now, 7)
+        self.assertEqual(len(due), 7)
+        self.assertEqual(OutgoingMail.objects.filter(pk__in=due,
+                                                     domain='a.pl').count(), 5)
+"""
+Mail queue - end
+"""
+
+
+"""
+Search indexing
+"""
+class TaskLockTest(TestCase):
+    def test_lock(self):
+        token= acquire_lock('update_search_index', 60)
+        self.assertTrue(token)
+        self.assertEqual(acquire_lock('update_search_index', 60), None)
+        # Released only by the holder.
+        release_lock('update_search_index', 'other')
+        self.assertEqual(acquire_lock('update_search_index', 60), None)
+        release_lock('update_search_index', token)
+        self.assertTrue(acquire_lock('update_search_index', 60))
+
+    def test_expired(self):
+        self.assertTrue(acquire_lock('update_search_index', 60))
+        TaskLock.objects.filter(name='update_search_index').update(
+            expires=datetime.utcnow().replace(tzinfo=utc) - timedelta(seconds=1))
+        self.assertTrue(acquire_lock('update_search_index', 60))
+"""
+Search indexing - end
+"""
+
+
+"""
+Subscriptions
+"""
+class FollowedTest(TestCase):
+    def setUp(self):
+        self.user= User.objects.create_user('jan', 'jan@example.com', 'x')
+        self.others= [User.objects.create_user('user%d' % i,
+            'user%d@example.com' % i, 'x') for i in range(4)]
+
+    def test_followed(self):
+        follow(self.user, self.others[1], {'active': 'Active'})
+        follow(self.user, self.others[3], {'active': 'Active',
+                                           'new_message': 'New message'})
+        self.assertEqual(followed(self.user, self.others),
+                         [self.others[1], self.others[3]])
+        self.assertTrue(is_following(self.user, self.others[3]))
+        self.assertFalse(is_following(self.user, self.others[0]))
+
+    def test_followed_by_other(self):
+        follow(self.others[0], self.others[1], {'active': 'Active'})
+        self.assertEqual(followed(self.user, self.others), [])
+        self.assertEqual(followed(None, self.others), [])
+        self.assertEqual(followed(self.user, []), [])
+
+
+class DigestTest(TestCase):
+    def setUp(self):
+        self.user= User.objects.create_user('jan', 'jan@example.com', 'x')
+        self.other= User.objects.create_user('anna', 'anna@example.com', 'x')
+        follow(self.user, self.other, {'active': 'Active'}, delivery='daily')
+        self.notification= EventNotification.objects.get(receiver=self.user)
+
+    def test_digest(self):
+        queue_events([(User, self.other.pk, 'active')])
+        self.assertEqual(send_pending_notifications(), 1)
+        self.assertEqual(len(mail.outbox), 0)
+        # The event is kept for the digest.
+        self.assertEqual(NotificationEvent.objects.filter(delivery='daily',
+            receiver_email='jan@example.com').count(), 1)
+        self.assertEqual(send_digests('hourly'), 0)
+
+        self.assertEqual(send_digests('daily'), 1)
+        self.assertEqual(mail.outbox[0].to, ['jan@example.com'])
+        notification= EventNotification.objects.get(pk=self.notification.pk)
+        self.assertEqual(notification.pending_since, None)
+        self.assertFalse(notification.awaiting)
+        self.assertEqual(NotificationEvent.objects.count(), 0)
+        self.assertEqual(send_digests('daily'), 0)
+"""
+Subscriptions - end
+"""
+
+
+
+"""
+Search text
+"""
+class DowncodeTest(SimpleTestCase):
+    def test_polish(self):
+        self.assertEqual(downcode(u'Zażółć gęślą jaźń'), u'Zazolc gesla jazn')
+        # Upper-case Ę and Ó are mapped to lower-case letters, as indexed.
+        self.assertEqual(downcode(u'ĄĆĘŁŃÓŚŹŻ ąćęłńóśźż'),
+                         u'ACeLNoSZZ acelnoszz')
+        self.assertEqual(downcode(u'Łódź, ul. Piotrkowska 12'),
+                         u'Lodz, ul. Piotrkowska 12')
+
+    def test_other_scripts(self):
+        self.assertEqual(downcode(u'Straße'), u'Strasse')
+        self.assertEqual(downcode(u'Привет'), u'Privet')
+        self.assertEqual(downcode(u'Ελληνικά'), u'Ellhnika')
+
+    def test_unchanged(self):
+        self.assertEqual(downcode(u''), u'')
+        self.assertEqual(downcode('ascii only'), u'ascii only')
+        # Punctuation outside of the table is left as is.
+        self.assertEqual(downcode(u'Gdańsk — „Kraków”'), u'Gdansk — „Krakow”')
+
+    def test_cached(self):
+        # Short strings are cached, long ones are not - the result
+        # is the same.
+        for text in (u'Wrocław', u'Wrocław ' * 100):
+            self.assertEqual(downcode(text), downcode(text))
+            self.assertEqual(downcode(text), text.replace(u'ł', u'l'))
+
+
+class CleanTextForSearchTest(SimpleTestCase):
+    def test_empty(self):
+        self.assertEqual(clean_text_for_search(u''), u' ')
+
+    def test_polish(self):
+        text= u'Urząd Miasta Łodzi, wniosek nr 12/2013'
+        self.assertEqual(clean_text_for_search(text),
+                         u'Urząd Miasta Łodzi, wniosek nr 12/2013 ')
+        self.assertEqual(clean_text_for_search(text, downcoded=True),
+                         u'Urzad Miasta Lodzi, wniosek nr 12/2013 ')
+
+    def test_punctuation(self):
+        # Runs of punctuation between words are squeezed.
+        self.assertEqual(clean_text_for_search(
+            u'Dzień dobry!!! Proszę o odpowiedź...  Dziękuję.',
+            downcoded=True), u'Dzien dobry! Prosze o odpowiedz Dziekuje ')
+        self.assertEqual(clean_text_for_search(
+            u'Kwota: 1 234,56 zł (brutto) -- termin: 14 dni.'),
+            u'Kwota: 1 234,56 zł (brutto) termin: 14 dni. ')
+
+    def test_url(self):
+        text= u'Zobacz http://www.bip.gov.pl/artykuly/123.html i odpowiedz.'
+        self.assertEqual(clean_text_for_search(text), text + u' ')
+
+    def test_quotes_and_whitespace(self):
+        self.assertEqual(clean_text_for_search(
+            u'> cytat\n>> starszy cytat\nNowa linia\r\ntekst'),
+            u'cytat starszy cytat Nowa linia tekst ')
+        self.assertEqual(clean_text_for_search(u'gęślą\tjaźń\n\nkoniec',
+            downcoded=True), u'gesla jazn koniec ')
+"""
+Search text - end
+"""
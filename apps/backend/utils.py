@@ -4,30 +4,34 @@
 Functions used in other modules.
 """
 from django.core.paginator import Paginator, Page, EmptyPage, PageNotAnInteger
-from django.core.mail.message import EmailMessage
-from django.core.files.storage import default_storage
-from django.core.files.base import ContentFile
+from django.core.mail.message import EmailMessage, SafeMIMEText, \
+    DEFAULT_ATTACHMENT_MIME_TYPE
 from django.template.loader import render_to_string, get_template
 from django.template.defaultfilters import filesizeformat
 from django.template.defaultfilters import slugify
 from django.contrib.contenttypes.models import ContentType
 from django.contrib.auth import views as auth_views
 from django.contrib.sites.models import Site
-from django.utils.encoding import force_unicode
+from django.utils.encoding import force_unicode, smart_str
+from django.utils.html import conditional_escape
 from django.utils.timezone import utc
 from django.conf import settings
 
 from apps.backend import AppMessage
-from apps.backend.html2text import html2text
+from apps.backend.html2text import html2text, BODY_WIDTH
 
 from datetime import datetime
 from time import strptime, strftime
+from email.mime.base import MIMEBase
+from email import Encoders
+from textwrap import wrap
 from PIL import Image
 
 import xhtml2pdf
 import xhtml2pdf.pisa as pisa
 import cStringIO as StringIO
-import random, string, re, os, sys
+from contextlib import contextmanager
+import random, string, re, os, sys, errno, hashlib, tempfile, uuid, time, fcntl
 
 """
 Creating a unique slug depending on the model.
@@ -114,25 +118,51 @@ def _makeRegex():
     
     return ALL_DOWNCODE_MAPS, regex
 
-_MAPINGS = None
-_regex = None
+_table = None
+def _downcode_table():
+    """
+    The mapping of `downcode` for `unicode.translate`: the tuple indexed
+    by the code point (much faster than a dict, which fails the lookup
+    for every character that stays as is).
+    """
+    global _table
+
+    if _table is None:
+        mappings, regex = _makeRegex()
+        table = range(max(ord(k) for k in mappings) + 1)
+        for k, v in mappings.iteritems():
+            table[ord(k)] = unicode(v)
+        _table = tuple(table)
+    return _table
+
+# Short strings (names, search phrases) are downcoded again and again,
+# so they are cached. Strings that weren't used since the cache was
+# filled up last time are dropped.
+_DOWNCODE_CACHE_SIZE = 1000
+_DOWNCODE_CACHE_MAX_LENGTH = 200
+_downcoded = {}
+_downcoded_old = {}
 def downcode(s):
     """
     This function is 'downcode' the string pass in the parameter s. This is useful 
     in cases we want the closest representation, of a multilingual string, in simple
     latin chars. The most probable use is before calling slugify.
     """
-    global _MAPINGS, _regex
+    global _downcoded, _downcoded_old
 
-    if not _regex:
-        _MAPINGS, _regex = _makeRegex()    
-
-    downcoded = ""
-    for piece in _regex.findall(s):
-        if _MAPINGS.has_key(piece):
-            downcoded += _MAPINGS[piece]
-        else:
-            downcoded += piece
+    if len(s) > _DOWNCODE_CACHE_MAX_LENGTH:
+        return force_unicode(s).translate(_downcode_table())
+    try:
+        return _downcoded[s]
+    except KeyError:
+        pass
+    try:
+        downcoded = _downcoded_old[s]
+    except KeyError:
+        downcoded = force_unicode(s).translate(_downcode_table())
+    if len(_downcoded) >= _DOWNCODE_CACHE_SIZE:
+        _downcoded_old, _downcoded = _downcoded, {}
+    _downcoded[s] = downcoded
     return downcoded
 
 
@@ -151,38 +181,78 @@ slugify_unique - end
 """
 
 
-def clean_text_for_search(text):
-    """
-    Prepare text for indexing and search.
-    """
-    # Get the normalized unicode text.
-    text= force_unicode(text).strip()
+"""
+clean_text_for_search
+"""
+# Quotation at the beginning of the text, or e-mail address.
+_QUOTE_OR_EMAIL= re.compile(
+    r'^\>+|\b[A-Za-z0-9_\.-]+@[A-Za-z0-9_\.-]+[A-Za-z0-9_][A-Za-z0-9_]\b')
 
-    # Remove e-mail quotation from the beginnings of the string.
-    text= re.sub(r'^\>+', '', text)
+# Markup html2text is needed for (`\/script>` switches its output off).
+_MARKUP= re.compile(r'[<&]|\\/script>')
 
-    # Remove e-mail addresses.
-    text= re.sub(r'\b[A-Za-z0-9_\.-]+@[A-Za-z0-9_\.-]+[A-Za-z0-9_][A-Za-z0-9_]\b', '', text)
+_WHITESPACE= re.compile(r'\s+')
 
-    # Try to convert html to text.
-    try:
-        text= html2text(text)
-    except:
-        pass
+# Where textwrap (used by html2text) breaks the lines not only at spaces:
+# hyphenated and long words, unicode spaces.
+_WRAP_BREAKS= re.compile(r'[^0-9\W]-(?=\w+[^0-9\W])|-{2,}(?=\w)|\S{%d,}|[^\S ]'
+                         % (BODY_WIDTH + 1), re.U)
 
-    # Clean the text from special characters, such as
-    # section divisions ***, etc. but preserve punctuation.
-    text= re.sub(r'\B\W{2,}\B', ' ', text)
+# Special characters, such as section divisions ***, etc.
+_SPECIAL_CHARS= re.compile(r'\B\W{2,}\B')
 
-    # Remove all returns and new lines.
-    text= re.sub(r'\n+', ' ', text)
-    text= re.sub(r'\r+', ' ', text)
+# Returns, new lines and multiple spaces.
+_SPACES= re.compile(r'\s{2,}|[\n\r]')
 
-    # Convert multiple spaces to singles.
-    text= re.sub(r'\s{2,}', ' ', text)
 
+def _plain_html2text(text):
+    """
+    `html2text(text)` for the text without markup, but without parsing it.
+    Lines are wrapped only if they aren't broken at spaces: new line and
+    space are the same for `clean_text_for_search`.
+    """
+    text= _WHITESPACE.sub(u' ', text)
+    if text.startswith(' '):
+        text= text[1:]
+    if not text or text[0] in '-*' or not _WRAP_BREAKS.search(text):
+        return text + u'\n\n'
+    lines= wrap(text, BODY_WIDTH)
+    if lines:
+        return u'\n'.join(lines) + u'\n\n'
+    return u'\n'
+
+
+def clean_text_for_search(text, downcoded=False):
+    """
+    Prepare text for indexing and search. If `downcoded` is True, the
+    text is also downcoded (the same as `downcode` on the result).
+    """
+    # Normalized unicode text without e-mail quotation
+    # at the beginning and without e-mail addresses.
+    text= _QUOTE_OR_EMAIL.sub(u'', force_unicode(text).strip())
+
+    # Convert html to text (only parse it if there is any markup).
+    if _MARKUP.search(text):
+        try:
+            text= html2text(text)
+        except:
+            pass
+    else:
+        text= _plain_html2text(text)
+
+    # Clean the text from special characters, but preserve punctuation,
+    # then remove returns and new lines and convert multiple spaces
+    # to singles.
+    text= _SPACES.sub(u' ', _SPECIAL_CHARS.sub(u' ', text))
+
+    if downcoded:
+        text= text.translate(_downcode_table())
     return text
 
+"""
+clean_text_for_search - end
+"""
+
 
 def get_domain_name(id=1):
     """
@@ -190,6 +260,9 @@ def get_domain_name(id=1):
     Default is the 1st project.
     """
     try:
+        if id == settings.SITE_ID:
+            # Cached by the sites framework (cleared when the Site is saved).
+            return Site.objects.get_current().domain
         return Site.objects.get(id=id).domain
     except Site.DoesNotExist: # Return the default one.
         return Site.objects.get(id=1).domain
@@ -303,19 +376,148 @@ def handle_image(f, store_path, **kwargs):
     return filename + ext
 
 
+"""
+Content-addressed attachment store.
+Every file is stored once under its SHA-256 digest, PIAAttachment
+records refer to it by `path` (relative to the store root, which is
+ATTACHMENT_DIR) and keep the original file name. The file is removed
+from the disk when the last record referring to it is deleted
+(see `release_stored_file`).
+"""
+# The record referring to the file is saved after the file is put to the
+# store, so a file which is not referred to is removed only if it was put
+# (or re-used) more than this number of seconds ago - the rest is left
+# to `clean_store`.
+STORE_RELEASE_DELAY= 24 * 60 * 60
+
+def get_store_path(digest, ext=''):
+    """
+    Path of the file with the given SHA-256 digest relative to the store
+    root: store/<first 2 hex digits>/<digest><ext>
+    """
+    return 'store/%s/%s%s' % (digest[:2], digest, ext.lower())
+
+
+def _ensure_store_dir(dir_name):
+    try:
+        os.makedirs(dir_name)
+    except OSError as e:
+        if e.errno != errno.EEXIST: # Created by a concurrent process.
+            raise
+    return dir_name
+
+
+def open_store_tmp(store_root):
+    """
+    Open a temporary file inside of the store (on the same file system,
+    so that `put_to_store` moves it without copying).
+    Returns (file object, path).
+    """
+    fd, tmp_path= tempfile.mkstemp(
+        dir=_ensure_store_dir(os.path.join(store_root, 'store', 'tmp')))
+    return os.fdopen(fd, 'wb'), tmp_path
+
+
+@contextmanager
+def store_lock(store_root):
+    """
+    Exclusive lock of the store, shared by all the processes: the check
+    whether the file is stored and its removal are done under it (see
+    `put_to_store`, `release_stored_file`).
+    """
+    lock_file= open(os.path.join(
+        _ensure_store_dir(os.path.join(store_root, 'store')), '.lock'), 'a')
+    try:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        yield
+    finally:
+        lock_file.close() # Releases the lock.
+
+
+def put_to_store(tmp_path, digest, store_root, ext=''):
+    """
+    Move the file `tmp_path` with the content of the given SHA-256 `digest`
+    to the store. If the identical file is stored already, `tmp_path`
+    is simply removed, and the stored file is touched, so that it isn't
+    released before the new record referring to it is saved.
+    Returns the path relative to `store_root`.
+    """
+    path= get_store_path(digest, ext)
+    full_path= os.path.join(store_root, path)
+    with store_lock(store_root):
+        if os.path.exists(full_path):
+            os.utime(full_path, None)
+            os.remove(tmp_path)
+        else:
+            _ensure_store_dir(os.path.dirname(full_path))
+            os.chmod(tmp_path, 0644) # mkstemp creates it readable by owner only.
+            os.rename(tmp_path, full_path)
+    return path
+
+
+def store_content(content, store_root, ext=''):
+    """
+    Put the `content` (string) to the store. Returns the path relative
+    to `store_root`.
+    """
+    fp, tmp_path= open_store_tmp(store_root)
+    try:
+        fp.write(content)
+    finally:
+        fp.close()
+    return put_to_store(tmp_path, hashlib.sha256(content).hexdigest(),
+                        store_root, ext)
+
+
+def release_stored_file(path, store_root, is_referenced):
+    """
+    Remove the file `path` (relative to `store_root`) from the disk,
+    unless `is_referenced()` returns True, or the file was put to the store
+    less than STORE_RELEASE_DELAY seconds ago.
+    Returns True if the file is removed.
+    """
+    full_path= os.path.join(store_root, path)
+    with store_lock(store_root):
+        try:
+            if time.time() - os.path.getmtime(full_path) < STORE_RELEASE_DELAY:
+                return False
+            if is_referenced():
+                return False
+            os.remove(full_path)
+        except OSError:
+            return False
+    return True
+
+
+def clean_store(store_root, is_referenced):
+    """
+    Remove the files which are not referred to from the store
+    (see `release_stored_file`). `is_referenced(path)` checks
+    the path relative to `store_root`. Returns the number of files removed.
+    """
+    removed= 0
+    store_dir= os.path.join(store_root, 'store')
+    for dir_name in os.listdir(store_dir):
+        if len(dir_name) != 2: # Not a digest prefix: `tmp`, `.lock`.
+            continue
+        for file_name in os.listdir(os.path.join(store_dir, dir_name)):
+            path= 'store/%s/%s' % (dir_name, file_name)
+            if release_stored_file(path, store_root,
+                                   lambda: is_referenced(path)):
+                removed += 1
+    return removed
+
+
 def save_attached_file(f, store_root, **kwargs):
     """
-    Check if attachments are ok, save files,
-    return what is needed to save attachment in the db.
+    Check if attachments are ok, save files to the attachment store
+    (see `put_to_store`), return what is needed to save attachment in the db:
+    {'size', 'path' (relative to the store), 'sha256', 'errors'}.
     """
     max_size= kwargs.get('max_size', 104857600) # Default limit is 100MB
-    dir_name= kwargs.get('dir_name', id_generator()) # Random name, if not given
-    dir_id= kwargs.get('dir_id', None)
-    if dir_id is None: # Now, if not given
-        dir_id= datetime.strftime(datetime.utcnow().replace(
-            tzinfo=utc), '%d-%m-%Y_%H-%M')
 
-    f_info= {'size': len(f), 'path': None, 'errors': []} # Object to return
+    f_info= {'size': len(f), 'path': None, 'sha256': None,
+             'errors': []} # Object to return
     if f_info['size'] > max_size:
         f_info['errors'].append(AppMessage('AttachTooBig').message %
                                 {'filename': f.name,
@@ -324,24 +526,23 @@ def save_attached_file(f, store_root, **kwargs):
     # TO-DO: 'Sniff' the file before saving
 
     if len(f_info['errors']) == 0:
-
-        # Ensure all directory names.
-        dir_full= ('%s/attachments/%s/%s' % (
-            store_root, dir_name, dir_id)).replace('//', '/')
-        path_report= ('%s/%s/%s' % (
-            dir_name, dir_id, f.name)).replace('//', '/')
-        path_full= ('%s/%s' % (dir_full, f.name)).replace('//', '/')
-
-        # Ensure directory on disk.
-        if not os.path.exists(dir_full):
-            os.makedirs(dir_full)
-
+        attachment_root= os.path.join(store_root, 'attachments')
         try:
-            path= default_storage.save(path_full, ContentFile(f.read()))
-            f_info['path']= path_report # Returns relative (to MEDIA_ROOT) path.
+            fp, tmp_path= open_store_tmp(attachment_root)
+            sha= hashlib.sha256()
+            try:
+                for chunk in f.chunks():
+                    fp.write(chunk)
+                    sha.update(chunk)
+            finally:
+                fp.close()
+            f_info['sha256']= sha.hexdigest()
+            # Returns relative (to MEDIA_ROOT/attachments) path.
+            f_info['path']= put_to_store(tmp_path, f_info['sha256'],
+                attachment_root, os.path.splitext(f.name)[1])
         except Exception as e:
             err= AppMessage('CantSaveAttachmnt').message % {
-                'filename': filename, 'error': e}
+                'filename': f.name, 'error': e}
             print >> sys.stderr, '[%s] %s' % (datetime.now().isoformat(), err)
             f_info['errors'].append(err)
     return f_info
@@ -364,6 +565,44 @@ def email_from_name(name, **kwargs):
     return template
 
 
+def render_to_string_once(template_name, dictionary, field):
+    """
+    Render the template once for many recipients, who differ only in the
+    value of `field`. Returns the function of that value, which returns
+    the rendered text (the value is escaped the same way as the template
+    does it, filters on `field` are not supported).
+    """
+    marker= uuid.uuid4().hex
+    dictionary= dict(dictionary)
+    dictionary[field]= marker
+    parts= render_to_string(template_name, dictionary).split(marker)
+    return lambda value: conditional_escape(value).join(parts)
+
+
+def mime_attachment(filename, content, mimetype=None, **kwargs):
+    """
+    Encode the file as a MIME part, which can be attached to any number
+    of EmailMessages (see `EmailMessage.attach`) without encoding it
+    again for every one. If the file is in the attachment store, its
+    `path` there saves QueuedEmailBackend from storing it again.
+    """
+    basetype, subtype= (mimetype or DEFAULT_ATTACHMENT_MIME_TYPE).split('/', 1)
+    if basetype == 'text':
+        part= SafeMIMEText(smart_str(content, settings.DEFAULT_CHARSET),
+                           subtype, settings.DEFAULT_CHARSET)
+    else:
+        part= MIMEBase(basetype, subtype)
+        part.set_payload(content)
+        Encoders.encode_base64(part)
+    try:
+        filename.encode('ascii')
+    except UnicodeEncodeError:
+        filename= ('utf-8', '', filename.encode('utf-8'))
+    part.add_header('Content-Disposition', 'attachment', filename=filename)
+    part.stored_path= kwargs.get('path', None)
+    return part
+
+
 def login(request, **kwargs):
     """
     Custom view - handling the login form with "Remember me" checkbox.
@@ -425,21 +664,7 @@ def send_notification(notification):
 
     Returns True if message successfully sent.
     """
-    template= 'emails/notification_%s.txt' % notification.action
-    subj_name= None
-    for attr in ['name', 'summary', 'subject']:
-        try:
-            subj_name= getattr(notification.item.content_object, attr)
-        except:
-            pass
-        else:
-            break
-    message_subject= '%s: %s' % (notification.get_action_display(), subj_name)
-    message_subject= force_unicode(message_subject)
-    message_content= render_to_string(template, {'notification': notification,
-                                                 'domain': get_domain_name()})
-    message_notification= EmailMessage(message_subject, message_content,
-        settings.SERVER_EMAIL, [notification.receiver_email])
+    message_notification= notification_message(notification)
     try: # sending the message to the receiver, check if it doesn't fail.
         message_notification.send(fail_silently=False)
     except Exception as e:
@@ -448,6 +673,31 @@ def send_notification(notification):
         return False
     return True
 
+def notification_item_name(notification):
+    """
+    Name of the item the notification is about.
+    """
+    for attr in ['name', 'summary', 'subject']:
+        try:
+            return getattr(notification.item.content_object, attr)
+        except:
+            pass
+    return None
+
+def notification_message(notification, domain=None):
+    """
+    EmailMessage with the notification about the event
+    as described in EventNotification.
+    """
+    template= 'emails/notification_%s.txt' % notification.action
+    message_subject= '%s: %s' % (notification.get_action_display(),
+                                 notification_item_name(notification))
+    message_subject= force_unicode(message_subject)
+    message_content= render_to_string(template, {'notification': notification,
+        'domain': domain or get_domain_name()})
+    return EmailMessage(message_subject, message_content,
+        settings.SERVER_EMAIL, [notification.receiver_email])
+
 def render_to_pdf(template_src, context_dict, **kwargs):
     """
     Renders html template to PDF.
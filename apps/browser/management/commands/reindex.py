@@ -0,0 +1,126 @@
+"""
+Rebuild the search index in parallel: `index_queryset` of every index
+is split into primary key ranges, which are prepared and sent to the
+backend by a pool of processes, each in its own batches.
+"""
+from django.core.management.base import BaseCommand, CommandError
+from django.db.models import get_model, Min, Max
+from django import db
+from optparse import make_option
+from multiprocessing import Pool, cpu_count
+from datetime import datetime
+import time
+
+from haystack import connections
+from haystack.exceptions import NotHandled
+
+from sezam.settings import SEARCH_INDEX_BATCH_SIZE
+
+
+def _get_index(label, using):
+    """
+    Search index of the model `label` (app_label.model_name).
+    """
+    model= get_model(*label.split('.'))
+    if model is None:
+        raise CommandError('Unknown model: %s' % label)
+    try:
+        return connections[using].get_unified_index().get_index(model)
+    except NotHandled:
+        raise CommandError('No search index for: %s' % label)
+
+
+def _init_worker():
+    """
+    Every process needs its own db connection.
+    """
+    db.close_connection()
+
+
+def index_range(args):
+    """
+    Index the objects of `label` with `start` <= pk < `end` in batches.
+    Runs in the worker process, returns (label, number of objects).
+    """
+    label, start, end, batch_size, using= args
+    index= _get_index(label, using)
+    backend= connections[using].get_backend()
+    queryset= index.index_queryset().filter(pk__gte=start,
+                                            pk__lt=end).order_by('pk')
+    count, last= 0, None
+    while True:
+        batch= queryset if last is None else queryset.filter(pk__gt=last)
+        batch= list(batch[:batch_size])
+        if not batch:
+            break
+        backend.update(index, batch)
+        count += len(batch)
+        last= batch[-1].pk
+    return label, count
+
+
+class Command(BaseCommand):
+    args= '[app_label.model_name ...]'
+    help= 'Rebuild the search index of the given models (all indexed models if not given) with a pool of processes.'
+    option_list= BaseCommand.option_list + (
+        make_option('-w', '--workers', type='int', dest='workers',
+            default=cpu_count(),
+            help='Number of processes (default: number of CPUs).'),
+        make_option('-b', '--batch-size', type='int', dest='batch_size',
+            default=SEARCH_INDEX_BATCH_SIZE,
+            help='Number of objects sent to the backend at once (default %d).' % SEARCH_INDEX_BATCH_SIZE),
+        make_option('-s', '--shards', type='int', dest='shards', default=4,
+            help='Primary key ranges per process (default 4), more ranges balance the load better.'),
+        make_option('-u', '--using', dest='using', default='default',
+            help='Search connection to use (default `default`).'),
+        )
+
+    def handle(self, *labels, **options):
+        using= options.get('using') or 'default'
+        workers= max(1, options.get('workers') or 1)
+        batch_size= options.get('batch_size') or SEARCH_INDEX_BATCH_SIZE
+        if not labels:
+            labels= ['%s.%s' % (model._meta.app_label, model._meta.module_name)
+                     for model in connections[using].get_unified_index(
+                        ).get_indexed_models()]
+
+        # Split every queryset into pk ranges.
+        ranges, total= [], {}
+        shards= workers * max(1, options.get('shards') or 1)
+        for label in labels:
+            queryset= _get_index(label, using).index_queryset()
+            total[label]= queryset.count()
+            bounds= queryset.aggregate(first=Min('pk'), last=Max('pk'))
+            if not total[label]:
+                continue
+            step= max(1, (bounds['last'] - bounds['first'] + shards) // shards)
+            for start in range(bounds['first'], bounds['last'] + 1, step):
+                ranges.append((label, start, start + step, batch_size, using))
+        self.stdout.write('Indexing %s in %d ranges with %d processes\n' % (
+            ', '.join('%s (%d)' % item for item in total.iteritems()),
+            len(ranges), workers))
+
+        # Don't share the connection of this process with the workers.
+        db.close_connection()
+        pool= Pool(workers, _init_worker)
+        started= time.time()
+        done, indexed= 0, dict((label, 0) for label in total)
+        try:
+            for label, count in pool.imap_unordered(index_range, ranges):
+                done += 1
+                indexed[label] += count
+                spent= time.time() - started
+                self.stdout.write('[%s] %d/%d ranges, %d objects, %.1f objects/s\n' % (
+                    datetime.now().isoformat(), done, len(ranges),
+                    sum(indexed.values()),
+                    sum(indexed.values()) / spent if spent else 0))
+        except:
+            pool.terminate()
+            raise
+        else:
+            pool.close()
+        finally:
+            pool.join()
+        spent= time.time() - started
+        self.stdout.write('Indexed %s in %.1fs\n' % (', '.join(
+            '%s: %d' % item for item in indexed.iteritems()), spent))
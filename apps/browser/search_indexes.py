@@ -5,9 +5,9 @@ from django.utils.timezone import utc
 from apps.vocabulary.models import AuthorityProfile
 from apps.pia_request.models import PIAMessage, PIAThread, PIARequest
 
-# WARNING! `clean_text_for_search` cleanse the text, but it should also be
+# WARNING! The text in the index should be not only cleansed, but also
 # downcoded (all non-ASCII symbols from national alphabets changed to their
-# ASCII `doubles`). Do the same before search!
+# ASCII `doubles`), see `clean_text_for_search`. Do the same before search!
 from apps.backend.utils import clean_text_for_search, downcode
 
 from datetime import datetime
@@ -28,8 +28,8 @@ class AuthorityProfileIndex(indexes.SearchIndex, indexes.Indexable):
         self.prepared_data = super(AuthorityProfileIndex, self).prepare(object)
         # Clean the text.
         if self.prepared_data['text']:
-            self.prepared_data['text']= downcode(clean_text_for_search(
-                self.prepared_data['text']))
+            self.prepared_data['text']= clean_text_for_search(
+                self.prepared_data['text'], downcoded=True)
         if self.prepared_data['report_text'] is None:
             self.prepared_data['report_text']= ''
         return self.prepared_data
@@ -48,6 +48,10 @@ class PIARequestIndex(indexes.SearchIndex, indexes.Indexable):
     authority= indexes.CharField(model_attr='authority__name')
     summary= indexes.CharField(model_attr='summary')
     report_text= indexes.CharField(default='') # For reporting purposes.
+    # For the lists of similar Requests (see apps.pia_request.similar).
+    user_id= indexes.IntegerField(model_attr='user__pk')
+    authority_slug= indexes.CharField(model_attr='authority__slug')
+    latest_post= indexes.DateTimeField(null=True)
 
     def _till_now(self):
         return datetime.utcnow().replace(tzinfo=utc)
@@ -59,10 +63,15 @@ class PIARequestIndex(indexes.SearchIndex, indexes.Indexable):
         self.prepared_data = super(PIARequestIndex, self).prepare(object)
 
         # Extract all the messages from the PIAThread
-        # and append them to the end of `text`.
-        for msg in object.thread.filter(
-                created__lte=self._till_now()).order_by('created'):
-            self.prepared_data['text'] += msg.body
+        # and append them to the end of `text`. The thread is prefetched
+        # for the whole batch (see `index_queryset`), so it is filtered
+        # and sorted here instead of the db.
+        till_now= self._till_now()
+        thread= sorted((msg for msg in object.thread.all()
+                        if msg.created <= till_now), key=lambda m: m.created)
+        self.prepared_data['text'] += ''.join(msg.body or '' for msg in thread)
+        if thread:
+            self.prepared_data['latest_post']= thread[-1].created
 
         # For reporting purposes storing a duplicate of the thread,
         # cleaned, but not downcoded.
@@ -75,4 +84,11 @@ class PIARequestIndex(indexes.SearchIndex, indexes.Indexable):
         return self.prepared_data
 
     def index_queryset(self):
-        return self.get_model().objects.filter(created__lte=self._till_now())
+        """
+        Used when the entire index for model is updated (in batches).
+        User and Authority are fetched in the same query, the threads
+        of the batch - in one more.
+        """
+        return self.get_model().objects.filter(
+            created__lte=self._till_now()).select_related(
+            'user', 'authority').prefetch_related('thread')
@@ -0,0 +1,75 @@
+"""
+Listen to the mailbox with IMAP IDLE and import responses from
+the Authorities as soon as they arrive.
+
+The periodic `check_mail` remains as a fallback.
+"""
+from django.core.management.base import BaseCommand, CommandError
+from django.db import close_connection
+from optparse import make_option
+from datetime import datetime
+import sys, time, socket, imaplib
+
+from sezam.settings import MAILBOXES, MAIL_IDLE_TIMEOUT, \
+    MAIL_RECONNECT_DELAY, MAIL_RECONNECT_DELAY_MAX
+from apps.pia_request.tasks import get_mail_importer, import_mails
+from apps.backend import AppMessage
+
+
+class Command(BaseCommand):
+    args= '[mailbox_name]'
+    help= 'Listen to the mailbox (`default` if not given) with IMAP IDLE and import responses as soon as they arrive.'
+    option_list= BaseCommand.option_list + (
+        make_option('--idle-timeout', type='int', dest='idle_timeout',
+            default=MAIL_IDLE_TIMEOUT,
+            help='Re-issue IDLE every N seconds (default %d).' % MAIL_IDLE_TIMEOUT),
+        )
+
+    def handle(self, mailbox_name='default', **options):
+        if mailbox_name not in MAILBOXES:
+            raise CommandError(AppMessage('MailboxNotFound').message)
+        idle_timeout= options.get('idle_timeout') or MAIL_IDLE_TIMEOUT
+        delay= MAIL_RECONNECT_DELAY
+        while True:
+            imp= get_mail_importer(mailbox_name)
+            connection= None
+            try:
+                connection= imp.imap_connect()
+                delay= MAIL_RECONNECT_DELAY # Connected, reset the delay.
+                # Import whatever arrived while nobody was listening.
+                self.import_mails(mailbox_name, imp, connection)
+                while True:
+                    if imp.idle(connection, idle_timeout):
+                        self.import_mails(mailbox_name, imp, connection)
+                    else:
+                        # Nothing new, make sure the connection is alive.
+                        connection.noop()
+            except KeyboardInterrupt:
+                break
+            except (imaplib.IMAP4.error, socket.error) as e:
+                print >> sys.stderr, '[%s] %s' % (datetime.now().isoformat(),
+                    AppMessage('MailListenerReconnect').message % {
+                        'mailbox': mailbox_name, 'error': e, 'delay': delay})
+            except Exception as e:
+                # Anything else (e.g. db error while importing) shouldn't
+                # stop the listener: start over with a new db connection.
+                print >> sys.stderr, '[%s] %s' % (datetime.now().isoformat(),
+                    AppMessage('MailListenerFailed').message % {
+                        'mailbox': mailbox_name, 'error': e, 'delay': delay})
+                close_connection()
+            finally:
+                if connection:
+                    try:
+                        connection.logout()
+                    except:
+                        pass
+            time.sleep(delay)
+            delay= min(delay * 2, MAIL_RECONNECT_DELAY_MAX)
+
+    def import_mails(self, mailbox_name, importer, connection):
+        counters= {'mailbox': mailbox_name, 'received': 0, 'processed': 0,
+                   'skipped': 0}
+        import_mails(importer, connection, counters)
+        if counters['received']:
+            self.stdout.write('[%s] %s\n' % (datetime.now().isoformat(),
+                AppMessage('CheckMailboxComplete').message % counters))
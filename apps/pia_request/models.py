@@ -7,14 +7,18 @@ from django.db.models import *
 from django.contrib.auth.models import User
 from django.contrib.contenttypes.models import ContentType
 from django.utils.translation import ugettext_lazy as _
-from django.db.models.signals import post_save
+from django.db.models.signals import post_save, post_delete
 from django.dispatch import receiver
+from django.utils.timezone import utc
 from datetime import datetime
 
 from apps.vocabulary.models import AuthorityProfile
 from apps.backend.models import GenericText, GenericPost, GenericMessage,\
-    GenericFile, GenericEvent, TaggedItem
-from apps.backend.utils import increment_id, send_notification
+    GenericFile, GenericEvent
+from apps.backend.notifications import queue_events
+from apps.backend.indexing import queue_index_update, index_updated
+from apps.pia_request.similar import invalidate_similar_requests
+from apps.backend.utils import increment_id
 
 PIA_REQUEST_STATUS= (
     ('in_progress', _(u'In progress')),
@@ -52,8 +56,14 @@ class PIAMessage(GenericMessage):
 class PIAAttachment(GenericFile):
     """
     A file attached to he message in the Thread.
+
+    Files are stored once per content (see `put_to_store`): all the
+    attachments with the same `sha256` refer to the same file, which is
+    removed only with the last of them.
     """
     message= ForeignKey(PIAMessage, related_name='attachments')
+    sha256= CharField(max_length=64, null=True, blank=True, db_index=True,
+                      verbose_name=_(u'SHA-256 of the content'))
 
     def __unicode__(self):
         return self.filename
@@ -88,6 +98,10 @@ class PIAThread(PIAMessage):
     """
     Any message (incoming or outgoing) in the thread following
     a particular Request.
+
+    If `batch_save` is set on the instance, `_post_save_thread` skips it:
+    the side effects are processed for the whole batch by
+    `update_requests_on_new_threads` and `notify_followers_on_new_threads`.
     """
     request= ForeignKey(PIARequest, related_name='thread',
                         verbose_name=_(u'request'))
@@ -148,63 +162,88 @@ class PIARequestDraft(PIAMessage):
         return self.subject
 
 
-@receiver(post_save)
-def _post_save(sender, **kwargs):
+@receiver(post_save, sender=PIARequest)
+@receiver(post_delete, sender=PIARequest)
+def _request_changed(sender, instance, **kwargs):
+    """
+    Queueing the update of the search index (see apps.backend.indexing).
+    """
+    queue_index_update(PIARequest, [instance.pk])
+
+
+@receiver(index_updated, sender=PIARequest)
+def _request_reindexed(sender, ids, **kwargs):
+    """
+    Dropping the cached similar Requests (see apps.pia_request.similar)
+    when the Requests (and their Threads) are updated in the index.
+    """
+    invalidate_similar_requests(ids)
+
+
+@receiver(post_save, sender=PIAThread)
+def _post_save_thread(sender, instance, **kwargs):
     """
-    PIAThread:
     * Filling the latest message in the Thread (see the note on
     de-normalization in the PIARequest description).
-    PIAThread & PIAAnnotation:
-    * Processing subscriptions to PIARequest and AuthorityProfile
+    * Queueing the event for the Users following the Request and the
+    Authority (see apps.backend.notifications).
+    * Queueing the update of the search index - the thread is
+    indexed as a part of the Request.
     """
+    if getattr(instance, 'batch_save', False):
+        return
+    if kwargs.get('created', False):
+        instance.request.latest_thread_post= instance
+        instance.request.save()
+    else:
+        queue_index_update(PIARequest, [instance.request_id])
+    notify_followers_on_new_threads([instance])
 
-    def __notify_followers(act, **kwargs):
-        """
-        Call a function that sends notifications to the Users, following
-        given Request or Authority, to which this request is made.
-        """
-        p= kwargs.get('piarequest', None)
-        a= kwargs.get('authority', None)
-        if (p is None) and (a is None):
-            return
-        g= ContentType.objects.get_for_model
-
-        items= TaggedItem.objects.filter(
-            Q(object_id=p.id, content_type_id=g(p.__class__).id)|\
-            Q(object_id=a.id, content_type_id=g(a.__class__).id))
-        if not items:
-            return
-        for item in items:
-            notifications= item.notification.filter(**act)
-            if notifications:
-                for notification in notifications:
-                    if send_notification(notification):
-                        pass
-                    else:
-                        print "Cannot send notification:\n %s" %\
-                            notification.__unicode__()
-
-    instance= kwargs.get('instance')
-    if sender == PIAThread:
-        # Update `latest_thread_post` in PIARequest only
-        # if it's not the first message in Thread.
-        if kwargs.get('created', False):
-            instance.request.latest_thread_post= instance
-            instance.request.save()
-
-        # Manage subscriptions to PIARequest and Authority after update.
-        act= {'action__in': ['new_message']}
-        if instance.is_response:
-            act['action__in'].append('response_from')
-        else:
-            act['action__in'].append('request_to')
-        __notify_followers(act, piarequest=instance.request,
-                           authority=instance.request.authority)
-    elif sender == PIAAnnotation:
-        # Manage subscriptions to PIARequest and Authority after update.
-        try:
-            __notify_followers({'action__in': ['annotation']},
-                               piarequest=instance.thread_message.request,
-                authority=instance.thread_message.request.authority)
-        except Exception as e:
-            print >> sys.stderr, '[%s] %s' % (datetime.now().isoformat(), e)
+
+@receiver(post_save, sender=PIAAnnotation)
+def _post_save_annotation(sender, instance, **kwargs):
+    """
+    Queueing the event for the Users following the Request and the
+    Authority (see apps.backend.notifications).
+    """
+    try:
+        request= instance.thread_message.request
+        queue_events([(PIARequest, request.id, 'annotation'),
+                      (AuthorityProfile, request.authority_id, 'annotation')])
+    except Exception as e:
+        print >> sys.stderr, '[%s] %s' % (datetime.now().isoformat(), e)
+
+
+def update_requests_on_new_threads(threads, **kwargs):
+    """
+    Batch version of `_post_save_thread`: fill `latest_thread_post`
+    (and `status`, if given in kwargs) of the Requests of `threads`
+    with one UPDATE per Request, and queue them for indexing.
+    """
+    latest= {}
+    for thread in threads:
+        latest[thread.request_id]= thread.pk
+    fields= {'lastchanged': datetime.utcnow().replace(tzinfo=utc)}
+    if 'status' in kwargs:
+        fields['status']= kwargs['status']
+    for request_id, thread_id in latest.iteritems():
+        PIARequest.objects.filter(pk=request_id).update(
+            latest_thread_post=thread_id, **fields)
+    queue_index_update(PIARequest, latest.keys())
+
+
+def notify_followers_on_new_threads(threads):
+    """
+    Batch version of `_post_save_thread`: queue the events for the Users
+    following the Requests of `threads` or the Authorities they are made
+    to, with one INSERT. The followers are notified by the periodic task.
+    """
+    events= []
+    for thread in threads:
+        action= 'response_from' if thread.is_response else 'request_to'
+        for model, object_id in ((PIARequest, thread.request_id),
+                (AuthorityProfile, thread.request.authority_id)):
+            events.append((model, object_id, 'new_message'))
+            events.append((model, object_id, action))
+    if events:
+        queue_events(events)
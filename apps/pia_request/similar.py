@@ -0,0 +1,80 @@
+"""
+Similar Requests.
+
+The Requests similar to the given one are found by elasticsearch
+`more_like_this` and made of the fields stored in the index (see
+PIARequestIndex), so that no Request is loaded from the db. The result
+is cached for SIMILAR_REQUESTS_CACHE_TIMEOUT, or until the document
+of the Request is updated in the index (see `_request_reindexed`
+in models).
+"""
+from django.core.cache import cache
+from django.conf import settings
+from haystack.query import SearchQuerySet
+
+# Fields of PIARequestIndex the similar Requests are made of.
+STORED_FIELDS= ('summary', 'authority', 'authority_slug', 'user', 'user_id',
+                'latest_post')
+
+
+def more_like_this(pia_request):
+    """
+    SearchQuerySet of the Requests similar to the given one.
+    """
+    # WARNING! Using `django_ct__exact` (haystack's internal field)
+    # is a dirty trick, but the only working. Find better solution!
+    return SearchQuerySet().more_like_this(pia_request).filter(
+        django_ct__exact='pia_request.piarequest')
+
+
+def get_similar_requests(pia_request):
+    """
+    SIMILAR_REQUESTS_NUMBER Requests similar to the given one
+    (see `stored_request`), cached.
+    """
+    key= _cache_key(pia_request.pk)
+    items= cache.get(key)
+    if items is None:
+        items= [stored_request(result) for result in
+                more_like_this(pia_request)[:settings.SIMILAR_REQUESTS_NUMBER]]
+        cache.set(key, items, settings.SIMILAR_REQUESTS_CACHE_TIMEOUT)
+    return items
+
+
+def search_similar(words, exclude=None, limit=None):
+    """
+    Requests with any of the `words` in the summary, except the Request
+    with id `exclude` (see `stored_request`).
+    """
+    results= SearchQuerySet().filter(summary__in=words).filter(
+        django_ct__exact='pia_request.piarequest')
+    if limit:
+        # One more, in case `exclude` is among them.
+        results= results[:int(limit) + 1]
+    items= [stored_request(result) for result in results]
+    items= [item for item in items if item['pk'] != exclude]
+    if limit:
+        return items[:int(limit)]
+    return items
+
+
+def stored_request(result):
+    """
+    The Request as a dict of its id (`pk`) and STORED_FIELDS
+    of the SearchResult.
+    """
+    item= dict((field, getattr(result, field, None))
+               for field in STORED_FIELDS)
+    item['pk']= int(result.pk)
+    return item
+
+
+def invalidate_similar_requests(ids):
+    """
+    Drop the cached similar Requests of the Requests with `ids`.
+    """
+    cache.delete_many([_cache_key(request_id) for request_id in ids])
+
+
+def _cache_key(request_id):
+    return 'similar_requests:%s' % request_id
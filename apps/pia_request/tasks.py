@@ -1,68 +1,398 @@
 from celery.task.schedules import crontab
 from celery.decorators import task, periodic_task
+from celery.exceptions import SoftTimeLimitExceeded
 from django.utils.timezone import utc
 from django.utils.translation import ugettext as _
 from django.template.loader import render_to_string
-from django.core.mail import EmailMessage
+from django.core.mail import EmailMessage, get_connection
+from django.db import transaction, DatabaseError
 from datetime import datetime, timedelta
-import re, sys
+import sys, socket, imaplib, mimetypes
 
 from sezam.settings import MAILBOXES, ATTACHMENT_DIR, OVERDUE_DAYS,\
-    DEFAULT_FROM_EMAIL
-from apps.pia_request.models import PIARequest, PIAThread, PIAAttachment,\
-    PIA_REQUEST_STATUS, get_request_status
-from apps.backend import MailImporter, AppMessage
+    DEFAULT_FROM_EMAIL, MAIL_FETCH_BATCH_SIZE, MAIL_FETCH_BATCH_BYTES,\
+    MAIL_IMPORT_BATCH_SIZE, MAIL_IMPORT_RETRIES, MAILBOX_CHECK_TIMEOUT,\
+    MAIL_CHUNK_SIZE,\
+    MEDIA_ROOT, USE_DEFAULT_FROM_EMAIL, MASS_REQUEST_CHUNK_SIZE
+from apps.pia_request.models import PIARequestDraft, PIARequest, PIAThread,\
+    PIAAttachment, PIA_REQUEST_STATUS, get_request_status, update_requests_on_new_threads,\
+    notify_followers_on_new_threads
+from apps.backend import MailImporter, AppMessage, get_address_router
+from apps.backend.models import MailboxState, OutgoingMail
 from apps.backend.html2text import html2text
-from apps.backend.utils import get_domain_name, email_from_name
+from apps.backend.utils import get_domain_name, email_from_name, \
+    render_to_string_once, mime_attachment, clean_store
 
 @periodic_task(run_every=crontab(day_of_week="*", hour="*", minute="*/10"))
 def check_mail(mailbox_settings=None):
     """
     Checks mail for responses.
+    Every mailbox is checked by its own `check_mailbox` subtask, so that
+    a slow IMAP server doesn't delay the others. If `mailbox_settings`
+    is not given, all the mailboxes from MAILBOXES are checked.
+    """
+    mailboxes= collect_mailboxes(mailbox_settings)
+    for mailbox_name in mailboxes:
+        # Don't let the subtasks pile up, if the workers are busy:
+        # by the time it expires the next check is already scheduled.
+        check_mailbox.apply_async(args=(mailbox_name,),
+                                  expires=MAILBOX_CHECK_TIMEOUT)
+    return AppMessage('CheckMailDispatched').message % ', '.join(mailboxes)
+
+
+@task(soft_time_limit=MAILBOX_CHECK_TIMEOUT,
+      time_limit=MAILBOX_CHECK_TIMEOUT + 60)
+def check_mailbox(mailbox_name):
+    """
+    Checks a single mailbox for responses.
     If there is any response, creates a Message and adds it to the Thread.
     Also processes attachments in the emails and adds them to newly
     created messages.
+    Returns the counters of the mailbox check.
+    """
+    counters= {'mailbox': mailbox_name, 'received': 0, 'processed': 0,
+               'skipped': 0, 'error': ''}
+    imp= get_mail_importer(mailbox_name, timeout=MAILBOX_CHECK_TIMEOUT)
+    connection= None
+    try:
+        # The connection is kept open for the next check in this worker.
+        connection= imp.imap_connect(pooled=True)
+        import_mails(imp, connection, counters)
+    except SoftTimeLimitExceeded:
+        # What is not processed yet will be imported on the next check.
+        counters['error']= 'timeout'
+    except (imaplib.IMAP4.error, socket.error) as e:
+        counters['error']= e
+    except Exception as e:
+        # Anything else is not expected - the connection is discarded,
+        # but the task fails.
+        counters['error']= e
+        raise
+    finally:
+        if connection:
+            if counters['error']:
+                # The connection is in unknown state.
+                imp.imap_discard(connection)
+            else:
+                imp.imap_release(connection)
+    if counters['error']:
+        print >> sys.stderr, '[%s] %s' % (datetime.now().isoformat(),
+            AppMessage('CheckMailboxFailed').message % counters)
+    return AppMessage('CheckMailboxComplete').message % counters
+
+
+def get_mail_importer(mailbox_name, **kwargs):
+    """
+    MailImporter for the mailbox with the given name (key in MAILBOXES),
+    set up to import responses to the Requests.
     """
+    return MailImporter(MAILBOXES[mailbox_name],
+                        attachment_dir=ATTACHMENT_DIR,
+                        router=get_address_router(get_domain_name()),
+                        batch_size=MAIL_FETCH_BATCH_SIZE,
+                        batch_bytes=MAIL_FETCH_BATCH_BYTES,
+                        **kwargs)
 
-    # Pattern to look for in `to` fields: delimiters include dash and dot.
-    addr_template= r'(\-|\.){1}\d+\@%s' % get_domain_name()
-    addr_pattern= re.compile(addr_template+'$') # End of line is required only locally.
 
-    # Collect mailboxes to check. NB: Mailbox should always be a list.
-    messages_total= 0
-    mailboxes= collect_mailboxes(mailbox_settings)
-    for mailbox in mailboxes:
-        imp= MailImporter(mailbox,
-                          attachment_dir=ATTACHMENT_DIR,
-                          addr_template=addr_template)
-        unread_messages= imp.process_mails(imp.imap_connect(), header_only=False)
-        for msg in unread_messages:
-            messages_total += 1
-            # Extract only the first(!) meaningful e-mail address.
-            try:
-                field_to= [t.strip() for t in msg['header']['to'].split(',') if addr_pattern.search(t)][0]
-            except:
-                # There are no such address in it - is it a spam?
-                # TO-DO: log it or to add the `from` address to the blacklist?
-                # Should the message be deleted?
-                print AppMessage('ResponseNotFound', value=msg['header']).message
+def import_mails(importer, connection, counters):
+    """
+    Import new messages from the mailbox (counters['mailbox']): save every
+    response in the Thread of its Request. Updates and returns `counters`.
+
+    Only messages above the watermark stored in MailboxState are fetched.
+    Every message is claimed by moving the watermark before processing,
+    so that concurrent imports (`check_mailbox` and `listen_mail`)
+    never process the same message twice. Messages which failed to fetch
+    or parse are kept in MailboxState for the next import.
+
+    Messages are saved in batches of MAIL_IMPORT_BATCH_SIZE
+    (see `process_messages`).
+    """
+    router= importer.router
+    state, created= MailboxState.objects.get_or_create(
+        mailbox=counters['mailbox'])
+    importer.uidvalidity, importer.last_uid= state.uidvalidity, state.last_uid
+    importer.retry_uids= parse_retry_uids(state.retry_uids)
+
+    # Attachments are already on disk, so only the text of the messages
+    # in the current batch is kept in memory.
+    batch= []
+    try:
+        for msg in importer.iter_mails(connection, header_only=False):
+            counters['received'] += 1
+            if not claim_message(state, importer, msg):
+                counters['skipped'] += 1 # Imported by somebody else.
                 continue
-            # Extracting request id.
-            try:
-                request_id= int(field_to.split('@')[0].rsplit('.', 1)[-1])
-            except:
-                try:
-                    request_id= int(field_to.split('@')[0].rsplit('-', 1)[-1])
-                except:
-                    print AppMessage('ResponseNotFound', value=msg['header']).message
-                    continue
-            new_message= new_message_in_thread(request_id, msg)
-            if new_message:
-                report_to_user_sent= send_report(new_message.request,
-                    status='response_received',
-                    template='emails/response_received.txt')
-    return AppMessage('CheckMailComplete', value=messages_total).message \
-        % messages_total
+            batch.append(msg)
+            if len(batch) >= MAIL_IMPORT_BATCH_SIZE:
+                process_messages(batch, router, counters)
+                batch= []
+    finally:
+        # Even if the import is interrupted, what is claimed already
+        # should be saved, and what has failed - retried.
+        if batch:
+            process_messages(batch, router, counters)
+        save_failed_uids(state, importer)
+
+    # The import is complete: save the new watermark (unless a concurrent
+    # import has already moved it further).
+    reset_watermark(state, importer)
+    forget_retried(state, importer)
+    MailboxState.objects.filter(pk=state.pk,
+        uidvalidity=importer.uidvalidity,
+        last_uid__lt=importer.last_uid).update(last_uid=importer.last_uid,
+        lastchanged=datetime.utcnow().replace(tzinfo=utc))
+    return counters
+
+
+def claim_message(state, importer, msg):
+    """
+    Move the watermark of the mailbox to the UID of the message, or
+    remove it from the messages to retry.
+    Returns False if it is already done (the message is claimed by
+    another import).
+    """
+    reset_watermark(state, importer)
+    # Don't lose the failures if the import is killed.
+    save_failed_uids(state, importer)
+    if msg['uid'] in importer.retry_uids:
+        return update_retry_uids(state, importer,
+            lambda retry_uids: retry_uids.pop(msg['uid'], None) is not None)
+    return MailboxState.objects.filter(pk=state.pk,
+        uidvalidity=importer.uidvalidity, last_uid__lt=msg['uid']).update(
+        last_uid=msg['uid'],
+        lastchanged=datetime.utcnow().replace(tzinfo=utc)) > 0
+
+
+def reset_watermark(state, importer):
+    """
+    Start the watermark of the mailbox anew, if the import has started
+    it anew (no watermark yet, or the mailbox was re-created, see
+    `MailImporter.search_new`), so that the messages can be claimed.
+    """
+    if (importer.uidvalidity == state.uidvalidity) and \
+           (importer.last_uid >= state.last_uid):
+        return
+    MailboxState.objects.filter(pk=state.pk, uidvalidity=state.uidvalidity,
+        last_uid=state.last_uid).update(
+        uidvalidity=importer.uidvalidity, last_uid=0, retry_uids='',
+        lastchanged=datetime.utcnow().replace(tzinfo=utc))
+    # Either by this import, or by a concurrent one.
+    state.uidvalidity, state.last_uid, state.retry_uids= \
+        importer.uidvalidity, 0, ''
+
+
+def save_failed_uids(state, importer):
+    """
+    Add the messages which failed to import to the messages to retry,
+    except for those which failed MAIL_IMPORT_RETRIES times already.
+    """
+    if not importer.failed_uids:
+        return
+    reset_watermark(state, importer)
+    failed_uids, importer.failed_uids= importer.failed_uids, {}
+    given_up= [uid for uid, attempts in failed_uids.items()
+               if attempts >= MAIL_IMPORT_RETRIES]
+    for uid in given_up:
+        print >> sys.stderr, '[%s] %s' % (datetime.now().isoformat(),
+            AppMessage('MailImportGaveUp').message % {
+                'mailbox': state.mailbox, 'uid': uid,
+                'attempts': failed_uids[uid]})
+
+    def change(retry_uids):
+        retry_uids.update(failed_uids)
+        for uid in given_up:
+            del retry_uids[uid]
+        return True
+    update_retry_uids(state, importer, change)
+
+
+def forget_retried(state, importer):
+    """
+    Remove the messages retried by the complete import from the messages
+    to retry, unless they have failed again: what is left of them is either
+    expunged, or not a response.
+    """
+    def change(retry_uids):
+        retried= [uid for uid, attempts in importer.retry_uids.items()
+                  if retry_uids.get(uid) == attempts]
+        for uid in retried:
+            del retry_uids[uid]
+        return len(retried) > 0
+    if importer.retry_uids:
+        update_retry_uids(state, importer, change)
+
+
+def update_retry_uids(state, importer, change):
+    """
+    Apply `change` to the messages to retry ({uid: attempts}) of the
+    mailbox, and save them unless `change` returns False. Concurrent
+    changes are never overwritten: the update is repeated until the
+    stored value is the same as the one that was changed.
+    Returns the result of `change`.
+    """
+    while True:
+        try:
+            stored= MailboxState.objects.filter(pk=state.pk,
+                uidvalidity=importer.uidvalidity).values_list(
+                'retry_uids', flat=True)[0]
+        except IndexError:
+            return False # The mailbox was re-created meanwhile.
+        retry_uids= parse_retry_uids(stored)
+        if not change(retry_uids):
+            return False
+        if MailboxState.objects.filter(pk=state.pk,
+                uidvalidity=importer.uidvalidity, retry_uids=stored).update(
+                retry_uids=format_retry_uids(retry_uids),
+                lastchanged=datetime.utcnow().replace(tzinfo=utc)):
+            return True
+
+
+def parse_retry_uids(value):
+    """
+    MailboxState.retry_uids as {uid: attempts}.
+    """
+    return dict((int(uid), int(attempts)) for uid, attempts in
+                (item.split(':') for item in (value or '').split()))
+
+
+def format_retry_uids(retry_uids):
+    return ' '.join(['%d:%d' % (uid, attempts) for uid, attempts
+                     in sorted(retry_uids.items())])
+
+
+def process_messages(messages, router, counters):
+    """
+    Save the batch of messages in the Threads of their Requests in one
+    transaction, then notify the followers and report to the Users
+    (once per Request). Updates and returns `counters`.
+
+    If the batch cannot be saved, falls back to `process_message`.
+    """
+    routed= []
+    for msg in messages:
+        request_id= get_request_id(msg, router)
+        if request_id is None:
+            counters['skipped'] += 1
+        else:
+            routed.append((request_id, msg))
+    try:
+        new_messages= save_responses(routed)
+    except DatabaseError as e:
+        print >> sys.stderr, '[%s] %s' % (datetime.now().isoformat(),
+            AppMessage('MsgCreateFailed').message % e)
+        for request_id, msg in routed:
+            if process_message(msg, router):
+                counters['processed'] += 1
+            else:
+                counters['skipped'] += 1
+        return counters
+    counters['processed'] += len(new_messages)
+    counters['skipped'] += len(routed) - len(new_messages)
+
+    # Side effects of saving PIAThread (see `_post_save_thread`) for the batch.
+    notify_followers_on_new_threads(new_messages)
+    connection= get_connection()
+    try:
+        reported= set()
+        for new_message in new_messages:
+            if new_message.request_id in reported:
+                continue
+            reported.add(new_message.request_id)
+            send_report(new_message.request, status='response_received',
+                        template='emails/response_received.txt',
+                        connection=connection)
+    finally:
+        connection.close()
+    return counters
+
+
+def save_responses(routed):
+    """
+    Create new messages in the Threads from the list of
+    (request_id, message) in one transaction.
+    All the Requests are fetched with one query, the attachments are
+    inserted with one query. PIAThread (multi-table inheritance from
+    PIAMessage) cannot be bulk-created, so it is saved one by one,
+    but without the side effects of `_post_save_thread`.
+    Returns the list of new messages.
+    """
+    requests= PIARequest.objects.select_related('user', 'authority').in_bulk(
+        set(request_id for request_id, msg in routed))
+    new_messages, attachments= [], []
+    with transaction.commit_on_success():
+        for request_id, msg in routed:
+            request= requests.get(request_id)
+            if request is None:
+                print AppMessage('RequestNotFound', value=(
+                    request_id, 'DoesNotExist',)).message
+                continue
+            new_message= PIAThread(request=request, is_response=True,
+                email_from=msg['header']['from'],
+                email_to=msg['header']['to'],
+                subject=msg['header']['subject'],
+                body=msg['content'])
+            new_message.batch_save= True
+            new_message.save()
+            new_messages.append(new_message)
+            for attachment in msg['attachments'] or []:
+                attachments.append(PIAAttachment(message=new_message,
+                    path=attachment['path'],
+                    filename=attachment['filename'],
+                    filetype=attachment['filename'].rsplit('.')[-1],
+                    filesize=attachment['filesize'],
+                    sha256=attachment['sha256']))
+        if attachments:
+            PIAAttachment.objects.bulk_create(attachments)
+        update_requests_on_new_threads(new_messages,
+                                       status=get_request_status('awaiting'))
+    return new_messages
+
+
+def get_request_id(msg, router):
+    """
+    Find the id of the Request the message is a response to (by the first
+    address in `to` field recognized by the AddressRouter), or None.
+    """
+    request_id= router.route(msg['header'].get('to'))
+    if request_id is None:
+        # There are no such address in it - is it a spam?
+        # TO-DO: log it or to add the `from` address to the blacklist?
+        # Should the message be deleted?
+        print AppMessage('ResponseNotFound', value=msg['header']).message
+    return request_id
+
+
+def process_message(msg, router):
+    """
+    Find the Request the message is a response to, save the message in its
+    Thread and report to the User.
+    Returns the new message or None.
+    """
+    request_id= get_request_id(msg, router)
+    if request_id is None:
+        return None
+    new_message= new_message_in_thread(request_id, msg)
+    if new_message:
+        report_to_user_sent= send_report(new_message.request,
+            status='response_received',
+            template='emails/response_received.txt')
+    return new_message
+
+
+@periodic_task(run_every=crontab(minute=30, hour=3))
+def clean_attachment_store():
+    """
+    Remove the files, which no attachment (or queued mail) refers to, from
+    the attachment store: those released by `_release_attachment_file` right
+    after being put to the store, put for the records which weren't saved,
+    or attached to the mails which are sent already.
+    """
+    removed= clean_store(ATTACHMENT_DIR,
+        lambda path: PIAAttachment.objects.filter(path=path).exists() or
+            OutgoingMail.objects.filter(status__in=('queued', 'sending'),
+                                        attachments__contains=path).exists())
+    return AppMessage('AttachmentStoreCleaned').message % removed
 
 
 @periodic_task(run_every=crontab(minute=0, hour=0))
@@ -75,56 +405,97 @@ def check_overdue():
     total_overdue_requests= 0
 
     # Process overdue requests (those remain unanswered for OVERDUE_DAYS).
-    when= datetime.utcnow().replace(tzinfo=utc) - timedelta(days=OVERDUE_DAYS)
-    in_progress= 'in_progress'
-    for pia_request in PIARequest.objects.filter(created__lt=when,
-                                                 status=in_progress):
-        if PIAThread.objects.filter(request=pia_request,
-                                    is_response=True).count() == 0:
-            total_overdue_requests += 1
-            
-            # Send a reminder to the Authority.
-            send_reminder(pia_request)
-            # Send an overdue report to user.
-            send_report(pia_request,
-                        status='overdue',
-                        template='emails/report_overdue_to_user.txt')
-
-            # Set 'overdue' status to the request:
-            # this doesn't depend on sending messages - even if there are errors
-            # the request should be marked as `overdue`.
-            pia_request.status= get_request_status('overdue')
-            try:
-                pia_request.save()
-            except Exception as e:
-                pass
-
-    # Process long_overdue requests (those that remain unanswered for twice OVERDUE_DAYS).
-    when= datetime.utcnow().replace(tzinfo=utc) - timedelta(days=OVERDUE_DAYS * 2)
-    in_progress= ['in_progress', 'overdue']
-    for pia_request in PIARequest.objects.filter(created__lt=when,
-                                                 status__in=in_progress):
-        if PIAThread.objects.filter(request=pia_request,
-                                    is_response=True).count() == 0:
-            total_overdue_requests += 1
-
-            # Send a reminder to the Authority.
-            send_reminder(pia_request,
-                          email_template='emails/reminder_long_overdue.txt')
-            # Send an overdue report to user.
-            send_report(pia_request,
-                        status='long_overdue',
-                        template='emails/report_long_overdue_to_user.txt')
-            # Set 'long_overdue' status to the request.
-            pia_request.status= 'long_overdue'
-            try:
-                pia_request.save()
-            except Exception as e:
-                pass
+    # Set 'overdue' status to the requests:
+    # this doesn't depend on sending messages - even if there are errors
+    # the request should be marked as `overdue`.
+    overdue= mark_overdue(OVERDUE_DAYS, ['in_progress'], 'overdue')
+    total_overdue_requests += len(overdue)
+    # Send reminders to the Authorities and overdue reports to users.
+    dispatch_overdue_mails(overdue, 'overdue')
+
+    # Process long_overdue requests (those that remain unanswered for twice
+    # OVERDUE_DAYS), including those which have just become overdue.
+    long_overdue= mark_overdue(OVERDUE_DAYS * 2, ['in_progress', 'overdue'],
+                               'long_overdue')
+    total_overdue_requests += len(long_overdue)
+    dispatch_overdue_mails(long_overdue, 'long_overdue')
 
     return AppMessage('CheckOverdueComplete').message % total_overdue_requests
 
 
+# Templates of the reminder to the Authority and the report to the User
+# by the status of the Request.
+OVERDUE_TEMPLATES= {
+    'overdue': {'reminder': 'emails/reminder_overdue.txt',
+                'report': 'emails/report_overdue_to_user.txt'},
+    'long_overdue': {'reminder': 'emails/reminder_long_overdue.txt',
+                     'report': 'emails/report_long_overdue_to_user.txt'},
+    }
+
+
+def dispatch_overdue_mails(request_ids, status):
+    """
+    Fan out reminders (to the Authorities) and reports (to the Users)
+    about the Requests with the given ids to `send_overdue_mails` subtasks,
+    MAIL_CHUNK_SIZE mails per subtask.
+
+    The subtasks are not paced: the mails are only queued, and the mail
+    queue keeps every e-mail domain within MAIL_DOMAIN_RATE_LIMIT.
+    """
+    mails= []
+    for i in range(0, len(request_ids), 500):
+        for pk in PIARequest.objects.filter(pk__in=request_ids[i:i + 500]
+                                            ).values_list('pk', flat=True):
+            mails.extend([('reminder', pk), ('report', pk)])
+    for i in range(0, len(mails), MAIL_CHUNK_SIZE):
+        send_overdue_mails.delay(mails[i:i + MAIL_CHUNK_SIZE], status)
+
+
+@task(ignore_result=True)
+def send_overdue_mails(mails, status):
+    """
+    Send a chunk of mails about overdue Requests over one connection.
+    `mails` is a list of ('reminder' or 'report', request_id): 'reminder'
+    goes to the Authority, 'report' to the User.
+    """
+    templates= OVERDUE_TEMPLATES[status]
+    requests= PIARequest.objects.select_related('user', 'authority').in_bulk(
+        set(request_id for kind, request_id in mails))
+    connection= get_connection()
+    try:
+        for kind, request_id in mails:
+            pia_request= requests.get(request_id)
+            if pia_request is None:
+                continue
+            if kind == 'reminder':
+                send_reminder(pia_request, email_template=templates[kind],
+                              connection=connection)
+            else:
+                send_report(pia_request, status=status,
+                            template=templates[kind], connection=connection)
+    finally:
+        connection.close()
+
+
+def mark_overdue(days, statuses, new_status):
+    """
+    Set `new_status` to the Requests in one of `statuses`, which remain
+    unanswered for `days`. Candidates are found with one query (anti-join
+    with the responses in the Thread) and updated by their ids - exactly
+    those which are returned (the anti-join is not repeated).
+    Returns the list of ids of the updated Requests.
+    """
+    now= datetime.utcnow().replace(tzinfo=utc)
+    candidates= PIARequest.objects.filter(
+        created__lt=now - timedelta(days=days), status__in=statuses).exclude(
+        thread__is_response=True)
+    request_ids= list(candidates.order_by().values_list('pk', flat=True))
+    for i in range(0, len(request_ids), 500):
+        PIARequest.objects.filter(pk__in=request_ids[i:i + 500]).update(
+            status=get_request_status(new_status), lastchanged=now)
+    return request_ids
+
+
 def new_message_in_thread(request_id, msg):
     """
     Pick up the request and create a new PIAMessage in its PIAThread.
@@ -159,12 +530,13 @@ def new_message_in_thread(request_id, msg):
         if msg['attachments']:
             for attachment in msg['attachments']:
                 filesize= attachment['filesize']
-                path= attachment['filename']
-                filename= path.rsplit('/')[-1]
-                filetype= path.rsplit('.')[-1]
+                path= attachment['path']
+                filename= attachment['filename']
+                filetype= filename.rsplit('.')[-1]
                 try:
                     PIAAttachment.objects.create(message=new_message, path=path,
-                        filename=filename, filetype=filetype, filesize=filesize)
+                        filename=filename, filetype=filetype, filesize=filesize,
+                        sha256=attachment['sha256'])
                 except Exception as e:
                     print AppMessage('AttachFailed', value=(
                         filename, request_id, e,)).message
@@ -173,16 +545,18 @@ def new_message_in_thread(request_id, msg):
 
 def collect_mailboxes(mailbox_settings):
     """
-    Create a list of mailboxes to check.
+    Create a list of names of the mailboxes to check.
     """
     def _append_mailbox(mb_key):
-        try:
-            mailboxes.append(MAILBOXES[mb_key])
-        except KeyError:
+        if mb_key in MAILBOXES:
+            mailboxes.append(mb_key)
+        else:
             print AppMessage('MailboxNotFound', value=mb_key).message
     mailboxes= []
     if mailbox_settings is None:
-        _append_mailbox('default')
+        # All mailboxes.
+        for mailbox_name in sorted(MAILBOXES.keys()):
+            _append_mailbox(mailbox_name)
     else:
         if isinstance(mailbox_settings, basestring):
             # Single mailbox.
@@ -217,7 +591,8 @@ def send_reminder(pia_request, overdue_date=None, **kwargs):
         'request_id': str(pia_request.pk), 'request_date': overdue_date,
         'authority': authority, 'info_email': 'info@%s' % get_domain_name()})
     message_request= EmailMessage(message_subject, message_content,
-        DEFAULT_FROM_EMAIL, [email_to], headers = {'Reply-To': email_from})
+        DEFAULT_FROM_EMAIL, [email_to], headers = {'Reply-To': email_from},
+        connection=kwargs.get('connection', None))
     try: # sending the message to the Authority, check if it doesn't fail.
         message_request.send(fail_silently=False)
     except Exception as e:
@@ -250,7 +625,8 @@ def send_report(pia_request, status, **kwargs):
         'request_id': str(pia_request.pk), 'request_date': report_date,
         'authority': authority, 'user': user, 'domain': get_domain_name()})
     message_request= EmailMessage(message_subject, message_content,
-        DEFAULT_FROM_EMAIL, [email_to], headers = {'Reply-To': email_from})
+        DEFAULT_FROM_EMAIL, [email_to], headers = {'Reply-To': email_from},
+        connection=kwargs.get('connection', None))
     try: # sending the message to the User, check if it doesn't fail.
         message_request.send(fail_silently=False)
     except Exception as e:
@@ -276,3 +652,156 @@ def get_message_subject(status, **kwargs):
             str(number) + _(u' from ') + date
         }
     return subjects[status]
+
+
+@task(ignore_result=False)
+def send_mass_request(draft_id, email_template='emails/request_to_authority.txt'):
+    """
+    Send the Request from the Draft to every Authority in it (mass request).
+
+    The Authorities are processed in chunks of MASS_REQUEST_CHUNK_SIZE:
+    the Requests of a chunk are created in one transaction, the messages are
+    sent over one connection, the side effects of the new Threads are
+    processed for the whole chunk (see `PIAThread.batch_save`).
+    The body is rendered only once (see `render_to_string_once`), the
+    attachments of the Draft are read and encoded only once and shared by
+    all the messages.
+    The progress is reported in the task state (see `mass_request_status`
+    view). The Authorities that were successful are removed from the
+    Draft together with their chunk (see `_send_mass_request_chunk`),
+    the Draft is deleted if nothing failed.
+    """
+    draft= PIARequestDraft.objects.select_related('user').get(pk=draft_id)
+    user= draft.user
+    # No newlines in Email subject!
+    subject= ''.join(draft.subject.splitlines())
+    authorities= list(draft.authority.all())
+    attachments= list(draft.attachments.all())
+    files= []
+    for attachment in attachments:
+        path= ('%s/attachments/%s' % (MEDIA_ROOT,
+                                      attachment.path)).replace('//', '/')
+        try:
+            with open(path, 'rb') as f:
+                files.append(mime_attachment(attachment.filename, f.read(),
+                    mimetypes.guess_type(attachment.filename)[0],
+                    path=attachment.path))
+        except Exception as e:
+            print >> sys.stderr, '[%s] %s' % (datetime.now().isoformat(), e)
+    render_body= render_to_string_once(email_template, {
+        'content': draft.body,
+        'info_email': 'info@%s' % get_domain_name()}, 'reply_to')
+
+    progress= {'current': 0, 'total': len(authorities),
+               'successful': [], 'failed': []}
+    for i in range(0, len(authorities), MASS_REQUEST_CHUNK_SIZE):
+        chunk= []
+        for authority in authorities[i:i + MASS_REQUEST_CHUNK_SIZE]:
+            email_to= authority.get_authority_email()
+            if email_to is None:
+                progress['failed'].append({'slug': authority.slug,
+                    'name': authority.name,
+                    'error': AppMessage('AuthEmailNotFound').message})
+            else:
+                chunk.append((authority, email_to))
+        if chunk:
+            _send_mass_request_chunk(draft, subject, chunk, attachments,
+                files, render_body, progress)
+        progress['current']= min(i + MASS_REQUEST_CHUNK_SIZE,
+                                 progress['total'])
+        send_mass_request.update_state(state='PROGRESS', meta=progress)
+
+    # Delete the draft if all successful.
+    if not progress['failed']:
+        try:
+            draft.delete()
+        except Exception as e:
+            print >> sys.stderr, '[%s] %s' % (datetime.now().isoformat(),
+                AppMessage('DraftRemoveFailed', value=(draft_id,)).message % e)
+    return progress
+
+
+def _send_mass_request_chunk(draft, subject, chunk, attachments, files,
+                             render_body, progress):
+    """
+    Create the Requests to the chunk of (authority, email_to) and send
+    them. The results are added to `progress`.
+
+    The Requests, their Threads, attachments and notifications, the queued
+    messages (see apps.backend.mail) and the removal of the Authorities
+    that were successful from the Draft are saved in one transaction:
+    if the chunk is interrupted, nothing of it is saved and the Draft
+    keeps its Authorities, so they get the Request once, when it is
+    sent again.
+    """
+    # Avoid circular import.
+    from apps.pia_request.views import create_request_notification, \
+        request_events
+
+    user= draft.user
+    successful, failed= [], []
+    with transaction.commit_on_success():
+        # One by one (bulk_create doesn't set the pk).
+        requests= dict((authority.id, PIARequest.objects.create(
+            summary=subject, authority=authority, user=user))
+            for authority, email_to in chunk)
+
+        threads, thread_attachments, unsent, done= [], [], [], []
+        connection= get_connection()
+        try:
+            for authority, email_to in chunk:
+                pia_request= requests[authority.id]
+                pia_request.authority= authority
+                reply_to= email_from_name(user.get_full_name(),
+                                          id=pia_request.id, delimiter='.')
+                email_from= DEFAULT_FROM_EMAIL if USE_DEFAULT_FROM_EMAIL \
+                    else reply_to
+                message_content= render_body(reply_to)
+                message= EmailMessage(subject, message_content, email_from,
+                    [email_to], headers={'Reply-To': reply_to},
+                    connection=connection)
+                for part in files:
+                    message.attach(part)
+                try:
+                    message.send(fail_silently=False)
+                except Exception as e:
+                    unsent.append(pia_request.pk)
+                    failed.append({'slug': authority.slug,
+                        'name': authority.name, 'error': unicode(e)})
+                    continue
+
+                # An author always follows its own request.
+                create_request_notification(user, pia_request,
+                    pia_request.id, pia_request.summary[:50],
+                    request_events(pia_request))
+
+                # The 1st message in the thread.
+                thread= PIAThread(request=pia_request, is_response=False,
+                    email_to=email_to, email_from=reply_to, subject=subject,
+                    body=message_content)
+                thread.batch_save= True
+                thread.save()
+                threads.append(thread)
+                for attachment in attachments:
+                    thread_attachments.append(PIAAttachment(message=thread,
+                        filename=attachment.filename, path=attachment.path,
+                        filetype=attachment.filetype,
+                        filesize=attachment.filesize,
+                        sha256=attachment.sha256))
+                done.append(authority)
+                successful.append({'slug': authority.slug,
+                    'name': authority.name, 'id': pia_request.id})
+        finally:
+            connection.close()
+
+        # Wipe from the db the Requests that cannot be sent.
+        if unsent:
+            PIARequest.objects.filter(pk__in=unsent).delete()
+        if thread_attachments:
+            PIAAttachment.objects.bulk_create(thread_attachments)
+        update_requests_on_new_threads(threads)
+        notify_followers_on_new_threads(threads)
+        if done:
+            draft.authority.remove(*done)
+    progress['successful'].extend(successful)
+    progress['failed'].extend(failed)
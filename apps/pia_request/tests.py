@@ -5,7 +5,19 @@ when you run "manage.py test".
 Replace this with more appropriate tests for your application.
 """
 
-from django.test import TestCase
+from django.test import TestCase, TransactionTestCase
+from django.contrib.auth.models import User
+from django.core.mail import get_connection
+from django.db import DatabaseError
+from django.utils.timezone import utc
+
+from datetime import datetime, timedelta
+import imaplib
+
+from apps.pia_request import tasks
+from apps.pia_request.models import PIARequest, PIAThread, PIARequestDraft
+from apps.backend.models import OutgoingMail
+from apps.vocabulary.models import AuthorityCategory, AuthorityProfile
 
 
 class SimpleTest(TestCase):
@@ -14,3 +26,260 @@ class SimpleTest(TestCase):
         Tests that 1 + 1 always equals 2.
         """
         self.assertEqual(1 + 1, 2)
+
+
+"""
+Mail import
+"""
+class FakeImporter(object):
+    def __init__(self):
+        self.released, self.discarded= [], []
+
+    def imap_connect(self, pooled=False):
+        return object()
+
+    def imap_release(self, connection):
+        self.released.append(connection)
+
+    def imap_discard(self, connection):
+        self.discarded.append(connection)
+
+
+class CheckMailboxTest(TestCase):
+    def setUp(self):
+        self.get_mail_importer= tasks.get_mail_importer
+        self.import_mails= tasks.import_mails
+        self.importers, self.counters= {}, {}
+        def get_mail_importer(mailbox_name, **kwargs):
+            return self.importers.setdefault(mailbox_name, FakeImporter())
+        tasks.get_mail_importer= get_mail_importer
+
+    def tearDown(self):
+        tasks.get_mail_importer= self.get_mail_importer
+        tasks.import_mails= self.import_mails
+
+    def _import_mails(self, failing):
+        def import_mails(importer, connection, counters):
+            self.counters[counters['mailbox']]= counters
+            counters['received']+= 1
+            if counters['mailbox'] in failing:
+                raise failing[counters['mailbox']]
+            counters['processed']+= 1
+        tasks.import_mails= import_mails
+
+    def test_import_error(self):
+        error= imaplib.IMAP4.error('FETCH failed')
+        self._import_mails({'broken': error})
+        tasks.check_mailbox('broken')
+        tasks.check_mailbox('sezam')
+        # The error is recorded for its mailbox only.
+        self.assertEqual(self.counters['broken']['error'], error)
+        self.assertEqual(self.counters['broken']['processed'], 0)
+        self.assertEqual(self.counters['sezam']['error'], '')
+        self.assertEqual(self.counters['sezam']['processed'], 1)
+        # The broken connection is not reused.
+        self.assertEqual(len(self.importers['broken'].discarded), 1)
+        self.assertEqual(self.importers['broken'].released, [])
+        self.assertEqual(len(self.importers['sezam'].released), 1)
+        self.assertEqual(self.importers['sezam'].discarded, [])
+
+    def test_unexpected_error(self):
+        self._import_mails({'broken': ValueError('Unexpected')})
+        self.assertRaises(ValueError, tasks.check_mailbox, 'broken')
+        self.assertEqual(len(self.importers['broken'].discarded), 1)
+        self.assertEqual(self.importers['broken'].released, [])
+"""
+Mail import - end
+"""
+
+
+"""
+Overdue requests
+"""
+class OverdueTestCase(TestCase):
+    def setUp(self):
+        self.user= User.objects.create_user('jan', 'jan@example.com', 'x')
+        category= AuthorityCategory.objects.create(name='Urzedy')
+        self.authority= AuthorityProfile.objects.create(name='Urzad Miasta',
+            category=category, email='urzad@example.com')
+
+    def _request(self, days, status='in_progress', thread=()):
+        """
+        Request made `days` ago, `thread` is the list of `is_response`
+        of its messages.
+        """
+        pia_request= PIARequest.objects.create(user=self.user,
+            authority=self.authority, subject='Wniosek',
+            email_to=self.authority.email, email_from='jan@sezam.pl')
+        for is_response in thread:
+            PIAThread.objects.create(request=pia_request,
+                is_response=is_response, subject='Re: Wniosek',
+                email_to=self.authority.email, email_from='jan@sezam.pl')
+        PIARequest.objects.filter(pk=pia_request.pk).update(status=status,
+            created=datetime.utcnow().replace(tzinfo=utc) - timedelta(days=days))
+        return pia_request.pk
+
+
+class MarkOverdueTest(OverdueTestCase):
+    def _status(self, pk):
+        return PIARequest.objects.get(pk=pk).status
+
+    def test_responded(self):
+        unanswered= self._request(20, thread=[False])
+        responded= self._request(20, thread=[False, True])
+        self.assertEqual(tasks.mark_overdue(14, ['in_progress'], 'overdue'),
+                         [unanswered])
+        self.assertEqual(self._status(unanswered), 'overdue')
+        self.assertEqual(self._status(responded), 'in_progress')
+
+    def test_updated(self):
+        overdue= [self._request(20), self._request(30, status='overdue')]
+        others= [self._request(2), self._request(20, status='successful'),
+                 self._request(30, status='long_overdue')]
+        request_ids= tasks.mark_overdue(14, ['in_progress', 'overdue'],
+                                        'long_overdue')
+        # The ids returned are exactly those updated.
+        self.assertEqual(sorted(request_ids), sorted(overdue))
+        self.assertEqual(sorted(PIARequest.objects.filter(
+            status='long_overdue').exclude(pk__in=others).values_list(
+            'pk', flat=True)), sorted(overdue))
+        self.assertEqual([self._status(pk) for pk in others],
+                         ['in_progress', 'successful', 'long_overdue'])
+        self.assertEqual(tasks.mark_overdue(14, ['in_progress', 'overdue'],
+                                            'long_overdue'), [])
+
+
+class DispatchOverdueMailsTest(OverdueTestCase):
+    class Connection(object):
+        closed= False
+
+        def close(self):
+            self.closed= True
+
+    def setUp(self):
+        super(DispatchOverdueMailsTest, self).setUp()
+        self.saved= dict((name, getattr(tasks, name)) for name in (
+            'send_overdue_mails', 'send_reminder', 'send_report',
+            'get_connection', 'MAIL_CHUNK_SIZE'))
+        self.sent, self.chunks, self.connections= [], [], []
+        def get_connection():
+            self.connections.append(self.Connection())
+            return self.connections[-1]
+        def send_reminder(pia_request, **kwargs):
+            self.sent.append(('reminder', pia_request.pk,
+                              kwargs['email_template'], kwargs['connection']))
+        def send_report(pia_request, status, **kwargs):
+            self.sent.append(('report', pia_request.pk,
+                              kwargs['template'], kwargs['connection']))
+        tasks.get_connection= get_connection
+        tasks.send_reminder= send_reminder
+        tasks.send_report= send_report
+
+    def tearDown(self):
+        for name, value in self.saved.iteritems():
+            setattr(tasks, name, value)
+
+    def test_dispatch(self):
+        request_ids= [self._request(20) for i in range(4)]
+        class Subtask(object):
+            def delay(subtask, mails, status):
+                self.chunks.append((mails, status))
+        tasks.send_overdue_mails= Subtask()
+        tasks.MAIL_CHUNK_SIZE= 3
+        tasks.dispatch_overdue_mails(request_ids + [max(request_ids) + 1],
+                                     'overdue')
+        # No pacing: the mail queue does it.
+        self.assertEqual([len(mails) for mails, status in self.chunks],
+                         [3, 3, 2])
+        self.assertEqual(set(status for mails, status in self.chunks),
+                         set(['overdue']))
+        self.assertEqual(sorted(mail for mails, status in self.chunks
+                                for mail in mails),
+            sorted([('reminder', pk) for pk in request_ids] +
+                   [('report', pk) for pk in request_ids]))
+
+    def test_send_chunk(self):
+        pk= self._request(30)
+        tasks.send_overdue_mails([('reminder', pk), ('report', pk),
+                                  ('reminder', pk + 1)], 'long_overdue')
+        # Over one connection, the missing Request is skipped.
+        self.assertEqual(len(self.connections), 1)
+        connection= self.connections[0]
+        self.assertTrue(connection.closed)
+        self.assertEqual(self.sent, [
+            ('reminder', pk, 'emails/reminder_long_overdue.txt', connection),
+            ('report', pk, 'emails/report_long_overdue_to_user.txt',
+             connection)])
+"""
+Overdue requests - end
+"""
+
+
+"""
+Mass requests
+"""
+class SendMassRequestTest(TransactionTestCase):
+    """
+    The chunk is saved (and its messages are queued) as a whole, so that
+    sending the Draft again after an interruption doesn't send the Request
+    twice to the same Authority.
+    """
+    def setUp(self):
+        user= User.objects.create_user('jan', 'jan@example.com', 'x')
+        category= AuthorityCategory.objects.create(name='Urzedy')
+        self.authorities= [AuthorityProfile.objects.create(
+            name='Urzad %d' % i, category=category,
+            email='urzad%d@example.com' % i) for i in range(5)]
+        self.draft= PIARequestDraft.objects.create(user=user,
+            subject='Wniosek', body='Prosze o informacje.')
+        self.draft.authority.add(*self.authorities)
+        self.saved= dict((name, getattr(tasks, name)) for name in (
+            'MASS_REQUEST_CHUNK_SIZE', 'get_connection',
+            'notify_followers_on_new_threads'))
+        self.update_state= tasks.send_mass_request.update_state
+        tasks.MASS_REQUEST_CHUNK_SIZE= 2
+        # The test runner replaces EMAIL_BACKEND, but the Requests are
+        # only queued in the db - in the same transaction.
+        tasks.get_connection= lambda: get_connection(
+            'apps.backend.mail.QueuedEmailBackend')
+        tasks.send_mass_request.update_state= lambda **kwargs: None
+
+    def tearDown(self):
+        for name, value in self.saved.iteritems():
+            setattr(tasks, name, value)
+        tasks.send_mass_request.update_state= self.update_state
+
+    def test_interrupted(self):
+        notified= []
+        def notify_followers_on_new_threads(threads):
+            notified.append(threads)
+            if len(notified) == 2:
+                raise DatabaseError('Interrupted')
+            self.saved['notify_followers_on_new_threads'](threads)
+        tasks.notify_followers_on_new_threads= notify_followers_on_new_threads
+        self.assertRaises(DatabaseError, tasks.send_mass_request,
+                          self.draft.pk)
+        # Only the first chunk is saved, its Authorities are removed
+        # from the Draft.
+        self.assertEqual(PIARequest.objects.count(), 2)
+        self.assertEqual(OutgoingMail.objects.count(), 2)
+        self.assertEqual(sorted(self.draft.authority.values_list('pk',
+            flat=True)), [a.pk for a in self.authorities[2:]])
+
+        tasks.notify_followers_on_new_threads= \
+            self.saved['notify_followers_on_new_threads']
+        progress= tasks.send_mass_request(self.draft.pk)
+        self.assertEqual(len(progress['successful']), 3)
+        self.assertEqual(progress['failed'], [])
+        # Every Authority got the Request once.
+        self.assertEqual(sorted(OutgoingMail.objects.values_list(
+            'recipients', flat=True)),
+            sorted(a.email for a in self.authorities))
+        self.assertEqual(sorted(PIARequest.objects.values_list(
+            'authority_id', flat=True)), [a.pk for a in self.authorities])
+        self.assertEqual(PIAThread.objects.count(), 5)
+        self.assertFalse(PIARequestDraft.objects.filter(
+            pk=self.draft.pk).exists())
+"""
+Mass requests - end
+"""
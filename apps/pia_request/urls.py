@@ -18,6 +18,10 @@ urlpatterns = patterns('apps.pia_request.views',
     url(r'^discard/(?P<id>\d+)/$', 'discard_request_draft',
         name='discard_request_draft'),
 
+    # Progress of sending the mass request (JSON).
+    url(r'^sending/(?P<task_id>[-\w]+)/$', 'mass_request_status',
+        name='mass_request_status'),
+
     # View request message thread.
     url(r'^(?P<id>\d+)/$', 'view_thread', {'template': 'thread.html'},
         name='view_thread'),
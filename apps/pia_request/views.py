@@ -1,33 +1,35 @@
 from django.shortcuts import get_object_or_404, render_to_response, redirect
-from django.contrib.contenttypes.models import ContentType
 from django.contrib.auth.decorators import login_required
 from django.template.loader import render_to_string
 from django.template import RequestContext
 from django.template.defaultfilters import slugify
 from django.utils.translation import ugettext as _
+from django.utils import simplejson as json
 from django.http import HttpResponse, Http404
 from django.core.paginator import Paginator, EmptyPage
 from django.core.urlresolvers import reverse
 from django.core.mail import EmailMessage
 from django.conf import settings
-from haystack.query import SearchQuerySet
 
-from time import struct_time, strptime
 from datetime import datetime
 import cStringIO as StringIO
 from shutil import rmtree
-import zipfile, cgi, re, os, sys
+import zipfile, mimetypes, cgi, re, os, sys
 
 from apps.pia_request.models import PIARequestDraft, PIARequest, PIAThread, PIAAnnotation, PIAAttachment, PIA_REQUEST_STATUS
+from apps.pia_request.tasks import send_mass_request
+from apps.pia_request.similar import more_like_this, get_similar_requests, \
+    search_similar
 from apps.pia_request.forms import MakeRequestForm, PIAFilterForm, ReplyDraftForm, CommentForm
 from apps.browser.forms import ModelSearchForm
 from apps.vocabulary.models import AuthorityProfile
 from apps.backend import AppMessage
-from apps.backend.models import TaggedItem, EventNotification
+from apps.backend.subscriptions import follow, unfollow, followed, \
+    is_following
 from apps.backend.utils import re_subject, process_filter_request, \
     downcode, save_attached_file, update_user_message, id_generator,\
     get_domain_name, email_from_name, clean_text_for_search, render_to_pdf, \
-    send_mail_managers
+    send_mail_managers, release_stored_file
 
 # Limiting request status list for user.
 PIA_REQUEST_STATUS_VISIBLE= tuple(v for v in PIA_REQUEST_STATUS if v[0] not in ('overdue', 'long_overdue', 'withdrawn', 'awaiting',))
@@ -62,6 +64,8 @@ def request_list(request, status=None, **kwargs):
 
     return render_to_response(template,
                               {'page': results,
+                               'followed': followed(request.user,
+                                                    results.object_list),
                                'form': PIAFilterForm(initial=initial),
                                'user_message': user_message,
                                'urlparams': urlparams,
@@ -101,33 +105,10 @@ def new_request(request, slug=None, **kwargs):
 def process_attachments(msg, attachments, **kwargs):
     """
     Process attachments of a given message.
-    Attachments should all be stored in a specific user's upload folder.
-    **kwargs determine folders name:
-    `dir_name`:
-    .../<dir_name>_...      - if given (usually user name)
-    .../undefined_..        - if None
-    `dir_id`:
-    .../<dir_name>_<dir_id> - if given (usually `request_id`)
-    .../<dir_name>_upload   - if None
+    Files are saved to the content-addressed attachment store (see
+    `save_attached_file`), so `dir_name` and `dir_id` in **kwargs are
+    not used any more.
     """
-    dir_name= kwargs.get('dir_name', 'undefined')
-    dir_id= kwargs.get('dir_id', None)
-
-    # Try to convert the last part of dir_name to time -
-    # maybe we already have dir_id.
-    dir_name_post_fix= dir_name.rsplit('/')
-    if len(dir_name_post_fix) > 1:
-        for substr in dir_name_post_fix[:2]:
-            try:
-                _dir_id= strptime(substr, '%d-%m-%Y_%H-%M')
-            except ValueError:
-                _dir_id= None
-            if isinstance(_dir_id, struct_time):
-                dir_id= substr
-                break
-    if dir_id: # If so, remove its part from dir_name.
-        dir_name= dir_name.replace(dir_id, '').replace('//', '/')
-
     # attached_so_far= {f.filename: f.filesize for f in msg.attachments.all()}
     # This doesn't work in python 2.6, so:
     attached_so_far= {}
@@ -141,29 +122,28 @@ def process_attachments(msg, attachments, **kwargs):
                 # The file is already attached to the message,
                 # and its size is the same - simply ignore it.
                 continue
-            else:
-                # If the size has changed, it should be re-written
-                # to the same location.
-                if dir_id is None:
-                    saved_path= msg.attachments.get(
-                        message=msg, filename=attachment.filename).path
-                    saved_path= saved_path.split('/')
-                    dir_name, dir_id= saved_path[:2]
+            # If the size has changed, the record is updated below.
 
         f= save_attached_file(attachment, settings.MEDIA_ROOT,
-            max_size=settings.ATTACHMENT_MAX_FILESIZE,
-            dir_name=dir_name, dir_id=dir_id)
+            max_size=settings.ATTACHMENT_MAX_FILESIZE)
         if f['errors']:
             attachment_failed.extend(f['errors'])
             continue
 
-        filename= f['path'].rsplit('/')[-1]
-        filetype= f['path'].rsplit('.')[-1]
+        filename= attachment.name
+        filetype= filename.rsplit('.')[-1]
         try:
             pia_attachment, created= PIAAttachment.objects.get_or_create(
-                message=msg, filename=filename, filetype=filetype, path=f['path'])
+                message=msg, filename=filename,
+                defaults={'filetype': filetype, 'path': f['path']})
+            old_path, old_sha256= pia_attachment.path, pia_attachment.sha256
+            pia_attachment.filetype= filetype
             pia_attachment.filesize= f['size']
+            pia_attachment.path= f['path']
+            pia_attachment.sha256= f['sha256']
             pia_attachment.save()
+            if old_path != f['path']: # Re-written with another content.
+                _release_attachment_file(old_path, old_sha256)
         except Exception as e:
             print >> sys.stderr, '[%s] %s' % (datetime.now().isoformat(), e)
 
@@ -176,22 +156,33 @@ def process_attachments(msg, attachments, **kwargs):
 
 def _do_remove_attachment(id_attachment):
     """
-    Wipe out attachment file from the disk, and clean it from the draft record.
+    Clean attachment from the draft record, and wipe out its file from
+    the disk, if this was the last reference to it.
     """
     attachment_obj= PIAAttachment.objects.get(id=int(id_attachment))
-    full_path= ('%s/attachments/%s' % (
-        settings.MEDIA_ROOT, attachment_obj.path)).replace('//', '/')
-    try:
-        os.remove(full_path)
-    except Exception as e:
-        pass
     try:
         attachment_obj.delete()
-    except:
+    except Exception as e:
         return e
+    _release_attachment_file(attachment_obj.path, attachment_obj.sha256)
     return None # No news are good news.
 
 
+def _release_attachment_file(path, sha256=None):
+    """
+    Remove the attachment file from the disk, unless there are other
+    attachments referring to it (identical files are stored once).
+    The check is repeated under the lock of the store, so that the file
+    is not removed while `put_to_store` gives it to a new attachment.
+    """
+    references= PIAAttachment.objects.filter(path=path)
+    if sha256:
+        references= references.filter(sha256=sha256) # Indexed.
+    if references.exists():
+        return
+    release_stored_file(path, settings.ATTACHMENT_DIR, references.exists)
+
+
 def remove_attachments(draft, id_list_remain=[], count_new=0):
     """
     Remove attachments unchecked by user.
@@ -329,7 +320,6 @@ def save_request_draft(request, id=None, **kwargs):
                     _(u'Draft saved successfully.'), 'success')
             # Try to find similar items.
             similar_items= retrieve_similar_items(draft, 20)
-            # similar_items= more_like_this(result['draft'], 20)
     response.update({'form': form,
                      'draft': draft,
                      'request_id': draft_id,
@@ -389,7 +379,10 @@ def attach_files(message, draft):
         path= ('%s/attachments/%s' % (settings.MEDIA_ROOT,
                                       attachment.path)).replace('//', '/')
         try:
-            message.attach_file(path)
+            # Stored files are named by their digest, use the original name.
+            with open(path, 'rb') as f:
+                message.attach(attachment.filename, f.read(),
+                               mimetypes.guess_type(attachment.filename)[0])
         except Exception as e:
             print >> sys.stderr, '[%s] %s' % (datetime.now().isoformat(), e)
             # TO-DO: register AppMessage('AttachFailed', value=(attachment.path, draft.id,).message
@@ -429,6 +422,10 @@ def send_request(request, id=None, **kwargs):
         from the DB).
 
         * cleans the draft out, if everything went well.
+
+        The request to more than one Authority (mass request) is sent in
+        the background by `send_mass_request`, its progress is reported
+        by `mass_request_status`.
         """
     if request.method != 'POST':
         raise Http404
@@ -468,11 +465,24 @@ def send_request(request, id=None, **kwargs):
     authorities= list(data['draft'].authority.all())
 
     # The process of sending a Request is looooong...
+    email_template= kwargs.get('email_template', 'emails/request_to_authority.txt')
+
+    # ...so the mass request is sent in the background.
+    if len(authorities) > 1:
+        result= send_mass_request.delay(data['draft'].id, email_template)
+        # Only the User who started the task can see its progress.
+        request.session['mass_requests']= request.session.get(
+            'mass_requests', [])[-9:] + [result.task_id]
+        request.session['user_message']= update_user_message({},
+            AppMessage('MassRequestStarted').message % {
+                'count': len(authorities),
+                'url': reverse('mass_request_status', args=(result.task_id,))},
+            'success')
+        return redirect(reverse('display_authorities'))
 
     # Prepare the message.
     # No newlines in Email subject!
     message_subject = ''.join(data['draft'].subject.splitlines())
-    email_template= kwargs.get('email_template', 'emails/request_to_authority.txt')
 
     # Process draft - try to send message to every Authority in the Draft.
     successful, failed= list(), list()
@@ -581,6 +591,25 @@ def send_request(request, id=None, **kwargs):
             context_instance=RequestContext(request))
 
 
+@login_required
+def mass_request_status(request, task_id=None, **kwargs):
+    """
+    Progress of sending the mass request (see `send_mass_request`) as JSON:
+    {'state', 'current', 'total', 'successful', 'failed'}, where the last
+    two are the lists of the Authorities processed so far.
+    """
+    if task_id not in request.session.get('mass_requests', []):
+        raise Http404
+    result= send_mass_request.AsyncResult(task_id)
+    data= {'state': result.state, 'current': 0, 'total': None,
+           'successful': [], 'failed': []}
+    if isinstance(result.info, dict):
+        data.update(result.info)
+    elif result.failed():
+        data['error']= unicode(result.info)
+    return HttpResponse(json.dumps(data), mimetype='application/json')
+
+
 def retrieve_similar_items(obj, limit=None):
     """
     Retrieve items similar to the given one.
@@ -601,42 +630,21 @@ def retrieve_similar_items(obj, limit=None):
             except: # Give up...
                 return []        
 
-    text_for_search= downcode(clean_text_for_search(text_for_search.lower()))
+    text_for_search= clean_text_for_search(text_for_search.lower(),
+                                           downcoded=True)
     text_for_search= [d for d in text_for_search.split()]
 
-    try:
-        similar_items= SearchQuerySet().filter(summary__in=text_for_search)
-    except:
-        return []
-
     # If the search is performed on PIAThread, need to exclude the originator.
     _exclude_pk= None
     if isinstance(obj, PIARequest):
         _exclude_pk= obj.pk
     elif isinstance(obj, PIAThread):
         _exclude_pk= obj.request.pk
-    if _exclude_pk:
-        similar_items= [o for o in similar_items if o.object.pk != _exclude_pk]
- 
-    if limit:
-        try:
-            return similar_items[:int(limit)]
-        except: pass
-    return similar_items
 
-def more_like_this(pia_request, limit=None):
-    """
-    Retrieve items similar to the given one.
-    """
-    # WARNING! Using `django_ct__exact` (haystack's internal field)
-    # is a dirty trick, but the only working. Find better solution!
-    similar_items= SearchQuerySet().more_like_this(pia_request).filter(
-        django_ct__exact='pia_request.piarequest')
-    if limit:
-        try:
-            return similar_items[:int(limit)]
-        except: pass
-    return similar_items
+    try:
+        return search_similar(text_for_search, _exclude_pk, limit)
+    except:
+        return []
 
 def awaiting_message(curr_user, request_user):
     """
@@ -689,9 +697,8 @@ def view_thread(request, id=None, **kwargs):
 
     attachments_allowed= request.session.pop('attachments_allowed',
                                              settings.ATTACHMENT_MAX_NUMBER)
-    # Extract similar requests.
-    similar_items= more_like_this(thread[0].request, 10)
-    # similar_items= retrieve_similar_items(thread[0].request, 10)
+    # Extract similar requests (cached).
+    similar_items= get_similar_requests(thread[0].request)
 
     # If there's a draft in the thread, make a form.
     for msg in thread:
@@ -705,17 +712,7 @@ def view_thread(request, id=None, **kwargs):
             break # Only one draft in Thread.
 
     # Check if the user is following the request.
-    following= False
-    if not request.user.is_anonymous():
-        content_type_id= ContentType.objects.get_for_model(
-            thread[0].request.__class__).id
-        try:
-            item= TaggedItem.objects.get(object_id=thread[0].request.id,
-                                         content_type_id=content_type_id)
-        except TaggedItem.DoesNotExist:
-            pass
-        else:
-            following= item.is_followed_by(request.user)
+    following= is_following(request.user, thread[0].request)
 
     return render_to_response(template,
                               {'mode': mode,
@@ -1192,15 +1189,10 @@ def _do_discard_request_draft(draft):
             draft= PIARequestDraft.objects.get(pk=int(draft))
         except Exception as e:
             return e
-    # Delete attachments from disk.
+    # Delete attachments (and their files, if not referred by others).
     if draft.attachments.count() > 0:
         for attachment in draft.attachments.all():
-            full_path= ('%s/attachments/%s' % (
-                settings.MEDIA_ROOT, attachment.path)).replace('//', '/')
-            try:
-                os.remove(full_path)
-            except Exception as e:
-                pass
+            _do_remove_attachment(attachment.id)
     # Delete draft itself.
     try:
         draft.delete()
@@ -1235,23 +1227,12 @@ def discard_request_draft(request, id=None, **kwargs):
                     'fail')
     return redirect(request.META.get('HTTP_REFERER'))
 
-def create_request_notification(user, obj, id, name, events):
+def create_request_notification(user, obj, id, name, events, delivery=None):
     """
     Create notification for a request.
+    `delivery` (one of DELIVERY) changes the delivery of the existing one.
     """
-    try:
-        item= TaggedItem.objects.get(object_id=id,
-                                     name=name,
-                                     content_type_id=ContentType.objects.get_for_model(obj.__class__).id)
-    except TaggedItem.DoesNotExist:
-        item= TaggedItem.objects.create(name=name,
-                                        content_object=obj)
-    for k, v in events.iteritems():
-        try:
-            evnt, created= EventNotification.objects.get_or_create(
-                item=item, action=k, receiver=user, summary=v)
-        except:
-            pass # TO-DO: Log it!
+    follow(user, obj, events, name=name, delivery=delivery)
     return
 
 @login_required
@@ -1267,12 +1248,13 @@ def follow_request(request, id=None, **kwargs):
     
     piarequest= get_object_or_404(PIARequest, id=int(id))
 
-    # Create notifier.
+    # Create notifier (hourly or daily digest, if asked for).
     create_request_notification(request.user,
                                 piarequest,
                                 piarequest.id,
                                 piarequest.summary[:50],
-                                request_events(piarequest))
+                                request_events(piarequest),
+                                delivery=request.GET.get('delivery'))
     return redirect(request.META.get('HTTP_REFERER'))
 
 
@@ -1285,26 +1267,7 @@ def unfollow_request(request, id=None, **kwargs):
         raise Http404
     piarequest= get_object_or_404(PIARequest, id=int(id))
 
-    try: # to get notifier.
-        item= TaggedItem.objects.get(object_id=piarequest.id,
-            content_type_id=ContentType.objects.get_for_model(
-                piarequest.__class__).id)
-    except TaggedItem.DoesNotExist:
-        return redirect(request.META.get('HTTP_REFERER'))
-
-    for k, v in request_events(piarequest).iteritems():
-        try:
-            evnt= EventNotification.objects.get(item=item, action=k,
-                                                receiver=request.user, summary=v)
-        except EventNotification.DoesNotExist:
-            continue
-        evnt.delete()
-
-    # Check if there is any notification connected to this item.
-    if not EventNotification.objects.filter(item=item):
-        try: # to wipe it out.
-            item.delete()
-        except: pass
+    unfollow(request.user, piarequest, request_events(piarequest).keys())
     return redirect(request.META.get('HTTP_REFERER'))
 
 
@@ -0,0 +1,487 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+"""
+Benchmarks for the hot paths of the project.
+
+Usage:
+    python benchmark.py -l                   # list available benchmarks
+    python benchmark.py mail_parse [-n 20]   # run the chosen one(s)
+    python benchmark.py mass_request -s 1    # 1000 Authorities (-n 20 x 50)
+    python benchmark.py text_normalize       # 200 texts (-n 20 x 10)
+    python benchmark.py downcode             # 100000 names, 20 bodies
+"""
+
+import os
+import re
+import sys
+import time
+import shutil
+import tempfile
+import optparse
+
+
+def switch_to_environment(src_file, settings_module):
+    """
+    Set the Project's Django environment.
+    """
+    message= "\n%s\n%s" % (
+        "Most probably the script is in the wrong directory.",
+        "The script should live in the `scripts` subdirectory of the main project directory!")
+    try: # Update $PATH
+        sys.path.append(
+            os.path.abspath(
+                os.path.join(os.path.dirname(src_file), os.path.pardir)))
+    except Exception as e:
+        print e
+        return message
+    try: # Switch to the given environment.
+        os.environ['DJANGO_SETTINGS_MODULE']= settings_module
+    except Exception as e:
+        print e
+        return message
+    return None
+
+
+def timeit(func, *args, **kwargs):
+    """
+    Call `func`, return the time spent in seconds.
+    """
+    start= time.time()
+    func(*args, **kwargs)
+    return time.time() - start
+
+
+def report(name, results, units):
+    """
+    Print the results in a table: label, time, speed.
+    `results` is a list of (label, seconds).
+    """
+    print '\n%s' % name
+    print '-' * 60
+    base= results[0][1]
+    for label, spent in results:
+        print '%-30s %8.3fs %10.1f %s/s  x%.2f' % (
+            label, spent, units[1] / spent if spent else 0, units[0],
+            base / spent if spent else 0)
+
+
+"""
+mail_parse: MailImporter parsing of the multipart messages.
+"""
+def _make_mail_corpus(count, attachment_size):
+    """
+    Create a list of fetch responses with multipart messages, each of
+    which has a text part, an html part and two binary attachments.
+    """
+    from email.mime.multipart import MIMEMultipart
+    from email.mime.text import MIMEText
+    from email.mime.application import MIMEApplication
+
+    corpus= []
+    for i in range(count):
+        msg= MIMEMultipart()
+        msg['From']= 'sekretariat@gmina-%d.pl' % i
+        msg['To']= 'jan.kowalski.%d@example.com' % i
+        msg['Subject']= 'Odpowiedz na wniosek %d' % i
+        msg.attach(MIMEText(u'Odpowiedź na wniosek o udostępnienie informacji publicznej.'.encode('utf8'),
+                            'plain', 'utf-8'))
+        msg.attach(MIMEText('<p>Odpowiedz na <b>wniosek</b></p>', 'html', 'utf-8'))
+        for n in range(2):
+            part= MIMEApplication(os.urandom(attachment_size), 'pdf')
+            part.add_header('Content-Disposition', 'attachment',
+                            filename='skan_%d.pdf' % n)
+            msg.attach(part)
+        corpus.append([('%d (RFC822 {0}' % (i + 1), msg.as_string()), ')'])
+    return corpus
+
+
+def _legacy_parse(importer, message_data, dir_name):
+    """
+    The way messages were parsed before `parse_mail`: header and content
+    are extracted in separate passes, each attachment is decoded twice.
+    """
+    import email
+    header= {}
+    for response_part in message_data:
+        if isinstance(response_part, tuple):
+            msg= email.message_from_string(response_part[1])
+            for part in msg.walk():
+                for k, v in part.items():
+                    if k.lower() not in importer.content_related:
+                        header.update({k.lower().strip(): importer._clean_text_encoded(v)})
+    attachments= []
+    for response_part in message_data:
+        if isinstance(response_part, tuple):
+            msg= email.message_from_string(response_part[1])
+            for part in msg.walk():
+                if part.is_multipart():
+                    continue
+                if part.get_params(None, 'Content-Disposition'):
+                    size= len(part.get_payload(decode=True))
+                    name= os.path.join(importer.ensure_directory(
+                        importer.attachment_dir + dir_name),
+                        part.get_filename())
+                    fp= open(name, 'wb')
+                    fp.write(part.get_payload(decode=True))
+                    fp.close()
+                    attachments.append({'filename': name, 'filesize': size})
+    return header, attachments
+
+
+def bench_mail_parse(opts):
+    from apps.backend import MailImporter
+
+    size= opts.size * 1024 * 1024
+    corpus= _make_mail_corpus(opts.number, size)
+    total_mb= opts.number * 2 * opts.size
+    tmp_dir= tempfile.mkdtemp() + '/'
+    importer= MailImporter({}, attachment_dir=tmp_dir)
+
+    def _legacy():
+        for message_data in corpus:
+            _legacy_parse(importer, message_data, 'legacy/')
+
+    def _single_pass():
+        for message_data in corpus:
+            header, content, parts= importer.parse_mail(message_data)
+            importer.save_attachments(parts, dir_name='single/')
+
+    try:
+        report('mail_parse: %d messages, 2 x %d MB attachments each' % (
+                   opts.number, opts.size),
+               [('two passes (legacy)', timeit(_legacy)),
+                ('parse_mail', timeit(_single_pass))],
+               ('MB', total_mb))
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+"""
+mail_parse - end
+"""
+
+
+
+"""
+address_routing: finding Request id in the `to` field of inbound mail.
+"""
+def _make_header_corpus(count, domain):
+    """
+    `to` fields: responses (dot and dash delimited, sometimes among other
+    recipients) and spam.
+    """
+    corpus= []
+    for i in range(count):
+        kind= i % 4
+        if kind == 0:
+            to= 'jan.kowalski.%d@%s' % (i, domain)
+        elif kind == 1:
+            to= 'sekretariat@gmina-%d.pl, anna-nowak-%d@%s' % (i, i, domain)
+        elif kind == 2:
+            to= 'biuro@gmina-%d.pl, kancelaria@gmina-%d.pl' % (i, i)
+        else:
+            to= 'piotr.%d@%s.example.com' % (i, domain)
+        corpus.append(to)
+    return corpus
+
+
+def _legacy_route(to, domain):
+    """
+    The way Request id was found before AddressRouter: template built
+    on every run, uncompiled search in the filter, then split, search
+    again and parse with the nested fallbacks.
+    """
+    addr_template= r'(\-|\.){1}\d+\@%s' % domain
+    if not re.search(addr_template, to):
+        return None
+    addr_pattern= re.compile(addr_template + '$')
+    try:
+        field_to= [t.strip() for t in to.split(',') if addr_pattern.search(t)][0]
+    except:
+        return None
+    try:
+        return int(field_to.split('@')[0].rsplit('.', 1)[-1])
+    except:
+        try:
+            return int(field_to.split('@')[0].rsplit('-', 1)[-1])
+        except:
+            return None
+
+
+def bench_address_routing(opts):
+    from apps.backend import get_address_router
+
+    domain= 'sezam.pl'
+    count= opts.number * 5000
+    corpus= _make_header_corpus(count, domain)
+    router= get_address_router(domain)
+
+    # Both should give the same ids.
+    for to in corpus:
+        assert _legacy_route(to, domain) == router.route(to), to
+
+    def _legacy():
+        for to in corpus:
+            _legacy_route(to, domain)
+
+    def _router():
+        for to in corpus:
+            router.route(to)
+
+    report('address_routing: %d headers' % count,
+           [('template + rsplit (legacy)', timeit(_legacy)),
+            ('AddressRouter', timeit(_router))],
+           ('headers', count))
+"""
+address_routing - end
+"""
+
+
+"""
+mass_request: sending the Request to many Authorities.
+"""
+def bench_mass_request(opts):
+    from django.core import mail
+    from django.core.mail import EmailMessage, get_connection
+    from django.template.loader import render_to_string
+    from apps.backend.utils import render_to_string_once, mime_attachment
+
+    count= opts.number * 50
+    size= opts.size * 1024 * 1024
+    template= 'emails/request_to_authority.txt'
+    context= {'content': u'Wniosek o udostępnienie informacji publicznej.\n' * 20,
+              'info_email': 'info@sezam.pl'}
+    recipients= [('jan.kowalski.%d@sezam.pl' % i, 'sekretariat@gmina-%d.pl' % i)
+                 for i in range(count)]
+    tmp_dir= tempfile.mkdtemp()
+    paths= []
+    for n in range(2):
+        paths.append(os.path.join(tmp_dir, 'skan_%d.pdf' % n))
+        with open(paths[-1], 'wb') as f:
+            f.write(os.urandom(size))
+    connection= get_connection('django.core.mail.backends.locmem.EmailBackend')
+
+    # Both should give the same body.
+    render_body= render_to_string_once(template, context, 'reply_to')
+    for reply_to, email_to in recipients[:10]:
+        assert render_body(reply_to) == render_to_string(template,
+            dict(context, reply_to=reply_to)), reply_to
+
+    def _send(message):
+        message.send()
+        del mail.outbox[:] # Keep the memory flat.
+
+    def _legacy():
+        for reply_to, email_to in recipients:
+            body= render_to_string(template, dict(context, reply_to=reply_to))
+            message= EmailMessage('Wniosek', body, reply_to, [email_to],
+                headers={'Reply-To': reply_to}, connection=connection)
+            for path in paths:
+                with open(path, 'rb') as f:
+                    message.attach(os.path.basename(path), f.read(),
+                                   'application/pdf')
+            _send(message)
+
+    def _render_once():
+        render_body= render_to_string_once(template, context, 'reply_to')
+        files= []
+        for path in paths:
+            with open(path, 'rb') as f:
+                files.append(mime_attachment(os.path.basename(path),
+                                             f.read(), 'application/pdf'))
+        for reply_to, email_to in recipients:
+            message= EmailMessage('Wniosek', render_body(reply_to), reply_to,
+                [email_to], headers={'Reply-To': reply_to},
+                connection=connection)
+            for part in files:
+                message.attach(part)
+            _send(message)
+
+    try:
+        report('mass_request: %d Authorities, 2 x %d MB attachments' % (
+                   count, opts.size),
+               [('per-message render (legacy)', timeit(_legacy)),
+                ('render once + shared MIME', timeit(_render_once))],
+               ('messages', count))
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+"""
+mass_request - end
+"""
+
+
+"""
+text_normalize: cleaning and downcoding of the text for the search index.
+"""
+def _make_text_corpus(count):
+    """
+    Thread bodies (plain text with quotations, e-mail addresses, section
+    divisions, and html) and Request summaries.
+    """
+    paragraph= (u'Szanowni Państwo, w odpowiedzi na wniosek z dnia 12-03-2013 r. '
+                u'przesłany z adresu jan.kowalski.%d@sezam.pl uprzejmie '
+                u'informuję, że Urząd Gminy w Łodzi nie posiada żądanej '
+                u'informacji (art. 4 ust. 3 ustawy).\n*** \n')
+    corpus= []
+    for i in range(count):
+        kind= i % 4
+        if kind == 0:
+            text= u'> ' + paragraph % i * 40
+        elif kind == 1:
+            text= u'<p>%s</p>' % (paragraph % i * 40).replace(u'\n', u'<br/>')
+        elif kind == 2:
+            text= u'Wniosek o udostępnienie informacji publicznej - e-mail nr %d' % i
+        else:
+            text= (paragraph % i).replace(u'informuję', u'informuję-przekazuję') * 40
+        corpus.append(text)
+    return corpus
+
+
+def _legacy_clean(text):
+    """
+    The way the text was cleaned before the normalizer: a pass per step,
+    html2text on every text.
+    """
+    from django.utils.encoding import force_unicode
+    from apps.backend.html2text import html2text
+    text= force_unicode(text).strip()
+    text= re.sub(r'^\>+', '', text)
+    text= re.sub(r'\b[A-Za-z0-9_\.-]+@[A-Za-z0-9_\.-]+[A-Za-z0-9_][A-Za-z0-9_]\b', '', text)
+    try:
+        text= html2text(text)
+    except:
+        pass
+    text= re.sub(r'\B\W{2,}\B', ' ', text)
+    text= re.sub(r'\n+', ' ', text)
+    text= re.sub(r'\r+', ' ', text)
+    text= re.sub(r'\s{2,}', ' ', text)
+    return text
+
+
+def _legacy_downcode(s, mappings, regex):
+    """
+    Downcode by concatenation of the pieces found by regex.
+    """
+    downcoded= ""
+    for piece in regex.findall(s):
+        if mappings.has_key(piece):
+            downcoded += mappings[piece]
+        else:
+            downcoded += piece
+    return downcoded
+
+
+def bench_text_normalize(opts):
+    from apps.backend.utils import clean_text_for_search, _makeRegex
+
+    count= opts.number * 10
+    corpus= _make_text_corpus(count)
+    mappings, regex= _makeRegex()
+    total_mb= sum(len(text.encode('utf-8')) for text in corpus) / 1024.0 / 1024
+
+    # Both should give the same text.
+    for text in corpus:
+        cleaned= _legacy_clean(text)
+        assert clean_text_for_search(text) == cleaned, text
+        assert clean_text_for_search(text, downcoded=True) == \
+            _legacy_downcode(cleaned, mappings, regex), text
+
+    def _legacy():
+        for text in corpus:
+            _legacy_downcode(_legacy_clean(text), mappings, regex)
+
+    def _normalizer():
+        for text in corpus:
+            clean_text_for_search(text, downcoded=True)
+
+    report('text_normalize: %d texts, %.1f MB' % (count, total_mb),
+           [('pass per step (legacy)', timeit(_legacy)),
+            ('clean_text_for_search', timeit(_normalizer))],
+           ('MB', total_mb))
+"""
+text_normalize - end
+"""
+
+
+"""
+downcode: names (slugs, e-mail addresses, search phrases) and thread bodies.
+"""
+def bench_downcode(opts):
+    from apps.backend.utils import downcode, _makeRegex
+
+    mappings, regex= _makeRegex()
+    first_names= [u'Łukasz', u'Małgorzata', u'Grzegorz', u'Józef', u'Bożena',
+                  u'Jędrzej', u'Żaneta', u'Krzysztof']
+    last_names= [u'Brzęczyszczykiewicz', u'Wójcik', u'Kołodziej', u'Dąbrowska',
+                 u'Szczęsny', u'Żółkiewski', u'Nowak', u'Łuczak']
+    names= [u'%s %s' % (first, last) for first in first_names
+            for last in last_names] + [u'Urząd Gminy Świętochłowice',
+            u'Starostwo Powiatowe w Łodzi', u'Ministerstwo Środowiska']
+    count= opts.number * 5000
+    corpus= [names[i % len(names)] for i in range(count)]
+    body= u'Szanowni Państwo, w odpowiedzi na wniosek uprzejmie informuję, ' \
+          u'że Urząd Gminy w Łodzi nie posiada żądanej informacji. '
+    body= body * (100 * 1024 / len(body.encode('utf-8')) + 1)
+    bodies= [body + unicode(i) for i in range(opts.number)]
+    total_mb= len(bodies) * len(body.encode('utf-8')) / 1024.0 / 1024
+
+    # Both should give the same text.
+    for text in names + bodies[:1]:
+        assert downcode(text) == _legacy_downcode(text, mappings, regex), text
+
+    def _legacy(texts):
+        for text in texts:
+            _legacy_downcode(text, mappings, regex)
+
+    def _downcode(texts):
+        for text in texts:
+            downcode(text)
+
+    report('downcode: %d names' % count,
+           [('concatenation (legacy)', timeit(_legacy, corpus)),
+            ('translate + cache', timeit(_downcode, corpus))],
+           ('names', count))
+    report('downcode: %d thread bodies, 100 KB each' % len(bodies),
+           [('concatenation (legacy)', timeit(_legacy, bodies)),
+            ('translate', timeit(_downcode, bodies))],
+           ('MB', total_mb))
+"""
+downcode - end
+"""
+
+
+BENCHMARKS= {
+    'mail_parse': bench_mail_parse,
+    'address_routing': bench_address_routing,
+    'mass_request': bench_mass_request,
+    'text_normalize': bench_text_normalize,
+    'downcode': bench_downcode,
+    }
+
+
+if __name__ == "__main__":
+    # Set the environment.
+    env_response= switch_to_environment(__file__, 'sezam.settings')
+    if env_response:
+        print env_response
+        exit()
+
+    cmdparser= optparse.OptionParser(
+        usage="usage: python %prog [Options] benchmark [benchmark ...]")
+    cmdparser.add_option("-l", "--list", action="store_true", dest="list",
+        help="list available benchmarks")
+    cmdparser.add_option("-n", "--number", type="int", dest="number",
+        default=20, help="size of the corpus (default 20)")
+    cmdparser.add_option("-s", "--size", type="int", dest="size",
+        default=3, help="size of a single item in MB, where applicable (default 3)")
+    opts, args= cmdparser.parse_args()
+
+    if opts.list or not args:
+        print 'Available benchmarks: %s' % ', '.join(sorted(BENCHMARKS.keys()))
+        exit()
+    for name in args:
+        try:
+            bench= BENCHMARKS[name]
+        except KeyError:
+            print 'Unknown benchmark: %s' % name
+            continue
+        bench(opts)
@@ -212,6 +212,18 @@ EMAIL_HOST_PASSWORD = ''
 EMAIL_USE_TLS = False
 DEFAULT_FROM_EMAIL = ''
 
+# Outbound mail is only queued in the db, the `process_mail_queue` task
+# sends it through MAIL_QUEUE_BACKEND (in batches of MAIL_QUEUE_BATCH_SIZE
+# over one connection), no more than MAIL_DOMAIN_RATE_LIMIT messages
+# per minute to the same e-mail domain. Failed messages are retried after
+# MAIL_QUEUE_RETRY_DELAY seconds, doubled after every attempt.
+EMAIL_BACKEND = 'apps.backend.mail.QueuedEmailBackend'
+MAIL_QUEUE_BACKEND = 'django.core.mail.backends.smtp.EmailBackend'
+MAIL_QUEUE_BATCH_SIZE = 100
+MAIL_QUEUE_MAX_ATTEMPTS = 6
+MAIL_QUEUE_RETRY_DELAY = 60
+MAIL_DOMAIN_RATE_LIMIT = 30
+
 # Should the system use default 'from' e-mail address for all messages?
 # WARNING! This might be overridden in the local conf.py.
 USE_DEFAULT_FROM_EMAIL = False
@@ -243,6 +255,52 @@ MAILBOXES = {
     }
 }
 
+# Number of messages, whose headers are fetched from the mailbox in one IMAP
+# round trip, full messages are fetched MAIL_FETCH_BATCH_BYTES at a time
+# (a larger one - on its own). Set MAIL_FETCH_BATCH_SIZE to None to fetch
+# messages one by one.
+MAIL_FETCH_BATCH_SIZE = 200
+MAIL_FETCH_BATCH_BYTES = 5 * 1024 * 1024
+
+# Number of imported messages saved to the db in one transaction.
+MAIL_IMPORT_BATCH_SIZE = 50
+
+# Messages which failed to fetch or parse are retried on the next imports,
+# up to MAIL_IMPORT_RETRIES times, then left unread in the mailbox.
+MAIL_IMPORT_RETRIES = 3
+
+# Time limit (in seconds) for checking a single mailbox, including
+# IMAP socket operations. Should not exceed the period of `check_mail`.
+MAILBOX_CHECK_TIMEOUT = 300
+
+# IMAP IDLE listener (manage.py listen_mail): re-issue IDLE every N seconds
+# (RFC 2177 recommends less than 29 minutes), delay before reconnecting
+# after a failure doubles from MAIL_RECONNECT_DELAY up to the maximum.
+MAIL_IDLE_TIMEOUT = 1500
+MAIL_RECONNECT_DELAY = 5
+MAIL_RECONNECT_DELAY_MAX = 300
+
+# Reminders and reports about overdue requests are sent by subtasks,
+# MAIL_CHUNK_SIZE messages per subtask over one connection. They are only
+# queued (see above), so the mail queue paces them per e-mail domain.
+MAIL_CHUNK_SIZE = 50
+
+# Events the Users can follow are queued in the db, the
+# `process_notifications` task notifies the followers,
+# NOTIFICATION_BATCH_SIZE events at a time. The subscriptions with
+# hourly or daily delivery get one digest at the end of the hour or day
+# (daily digests are sent at NOTIFICATION_DIGEST_HOUR). The followers who
+# couldn't be notified are retried after NOTIFICATION_RETRY_DELAY seconds,
+# doubled after every attempt, until NOTIFICATION_MAX_ATTEMPTS is reached.
+NOTIFICATION_BATCH_SIZE = 500
+NOTIFICATION_DIGEST_HOUR = 7
+NOTIFICATION_MAX_ATTEMPTS = 5
+NOTIFICATION_RETRY_DELAY = 300
+
+# Requests to more than one Authority (mass requests) are sent by the
+# `send_mass_request` task, MASS_REQUEST_CHUNK_SIZE Authorities at a time.
+MASS_REQUEST_CHUNK_SIZE = 50
+
 # Directory for saving attachments from incoming e-mails.
 ATTACHMENT_DIR = os.path.join(MEDIA_ROOT, 'attachments/')
 
@@ -278,6 +336,11 @@ SESSION_EXPIRE_AFTER = 1209600 # 2 weeks
 # Use django database as a broker
 BROKER_URL = 'django://'
 
+# Task results are only kept for the tasks that report their progress
+# (such as `send_mass_request`), all the others ignore them.
+CELERY_RESULT_BACKEND = 'djcelery.backends.database:DatabaseBackend'
+CELERY_IGNORE_RESULT = True
+
 # Haystack for elasticsearch
 HAYSTACK_CONNECTIONS = {
     'default': {
@@ -289,6 +352,25 @@ HAYSTACK_CONNECTIONS = {
 HAYSTACK_CUSTOM_HIGHLIGHTER = 'apps.backend.StretchHighlighter'
 HAYSTACK_SEARCH_RESULTS_PER_PAGE = PAGINATE_BY
 
+# Changed objects are queued and put to the search index every minute by
+# the `update_search_index` task, SEARCH_INDEX_BATCH_SIZE at a time. The
+# task holds the lock for SEARCH_INDEX_LOCK_TIMEOUT seconds at most.
+SEARCH_INDEX_BATCH_SIZE = 500
+SEARCH_INDEX_LOCK_TIMEOUT = 3600
+
+# Similar Requests on the thread page (SIMILAR_REQUESTS_NUMBER of them)
+# are cached for SIMILAR_REQUESTS_CACHE_TIMEOUT seconds, or until
+# the Request is updated in the search index. The cache is in the db,
+# to be shared by the web and celery processes.
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.db.DatabaseCache',
+        'LOCATION': 'sezam_cache',
+    }
+}
+SIMILAR_REQUESTS_NUMBER = 10
+SIMILAR_REQUESTS_CACHE_TIMEOUT = 3600
+
 # Passwords, etc.
 from sezam.conf import *
 